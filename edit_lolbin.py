@@ -3,10 +3,30 @@ import os
 import subprocess
 import shutil
 import stat
+import argparse
+import hashlib
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Directory to move the binaries to
+# Directory to move the binaries to, readable and writable by root only
 DEST_DIR = "/tmp/safe"
 
+# Where each moved binary came from, its owner and mode, so it can be put back exactly
+MANIFEST_FILE = "manifest.json"
+
+# Binaries restored at once
+RESTORE_WORKERS = 8
+
+# Threads listing directories and hashing files when scanning
+SCAN_WORKERS = 8
+
+# Any of the executable bits
+EXEC_BITS = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
 # Function to check if a command exists
 def command_exists(cmd):
     return shutil.which(cmd) is not None
@@ -20,36 +40,178 @@ GTFOBINS = [
     "easy_install", "nc", "cpan"
 ]
 
+# name -> executable paths in PATH, built once by index_path
+_path_index = None
+
+# Function to index every executable in the PATH directories and their subdirectories in one pass
+def index_path():
+    index = {}
+    seen = set()
+    pending = [d for d in os.environ.get("PATH", "").split(os.pathsep) if d]
+    while pending:
+        directory = pending.pop(0)
+        # /bin is often a symlink to /usr/bin, list each directory once
+        real = os.path.realpath(directory)
+        if real in seen:
+            continue
+        seen.add(real)
+
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif os.access(entry.path, os.X_OK):  # Check if executable
+                            index.setdefault(entry.name, []).append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return index
+
 # Function to locate a binary in the PATH
 def locate_bins(binary):
-    paths = []
-    for path_dir in os.environ["PATH"].split(os.pathsep):
-        for root, _, files in os.walk(path_dir):
-            if binary in files:
-                bin_path = os.path.join(root, binary)
-                if os.access(bin_path, os.X_OK):  # Check if executable
-                    paths.append(bin_path)
-    return paths
+    global _path_index
+    if _path_index is None:
+        _path_index = index_path()
+    return list(_path_index.get(binary, []))
+
+# Function to check that nobody but root, or whoever runs the script, can write to a file or directory.
+# Anyone else could plant binaries and a manifest that root then puts back as setuid executables
+def trusted(st):
+    return st.st_uid in (0, os.geteuid()) and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+# Function to create the destination directory with mode 0700, or make sure an existing one is safe to use
+def prepare_dest_dir():
+    try:
+        os.mkdir(DEST_DIR, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(DEST_DIR)
+    if not stat.S_ISDIR(st.st_mode) or not trusted(st):
+        print(f"Refusing to use {DEST_DIR}: it must be a directory owned by root and not writable by group or others")
+        return False
+    # older versions created it readable by everyone
+    if stat.S_IMODE(st.st_mode) != 0o700:
+        os.chmod(DEST_DIR, 0o700)
+    return True
+
+# Function to check that a path read from the manifest or the destination directory really is in it
+def in_dest_dir(path):
+    return os.path.normpath(path).startswith(DEST_DIR.rstrip("/") + "/")
+
+# Function to read the manifest of moved binaries, a list of entries
+def load_manifest():
+    path = os.path.join(DEST_DIR, MANIFEST_FILE)
+    try:
+        # a symlink planted in place of the manifest is not followed
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        print(f"Error reading the manifest: {e}")
+        return []
+
+    with os.fdopen(fd) as f:
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or not trusted(st):
+            print(f"Ignoring the manifest {path}: it must be a file owned by root and not writable by group or others")
+            return []
+        try:
+            return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading the manifest: {e}")
+            return []
+
+# Function to write the manifest, replaced at once so it is never half written
+def save_manifest(manifest):
+    path = os.path.join(DEST_DIR, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
 
 # Function to move a GTFOBin to the destination directory and make it non-executable
-def move_bin(binary):
-    if command_exists(binary):
-        for bin_path in locate_bins(binary):
-            try:
-                shutil.move(bin_path, DEST_DIR)
-                dest_path = os.path.join(DEST_DIR, os.path.basename(bin_path))
-                # Remove executable permission
-                os.chmod(dest_path, os.stat(dest_path).st_mode & ~stat.S_IEXEC)
-                print(f"Moved {binary} to {DEST_DIR} and made it non-executable")
-            except Exception as e:
-                print(f"Error moving {binary}: {e}")
-    else:
+def move_bin(binary, manifest):
+    bin_paths = locate_bins(binary)
+    if not bin_paths:
         print(f"{binary} not found on this system.")
+        return
+
+    for bin_path in bin_paths:
+        # kept under its original path, copies from several PATH directories don't collide
+        dest_path = os.path.join(DEST_DIR, bin_path.lstrip("/"))
+        try:
+            st = os.lstat(bin_path)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            shutil.move(bin_path, dest_path)
+            # Remove executable permission, a symlink is moved as it is, chmod would change its target
+            if not stat.S_ISLNK(st.st_mode):
+                os.chmod(dest_path, stat.S_IMODE(st.st_mode) & ~(stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+            manifest.append({
+                "name": binary,
+                "original": bin_path,
+                "stored": dest_path,
+                "mode": stat.S_IMODE(st.st_mode),
+                "uid": st.st_uid,
+                "gid": st.st_gid,
+                "link": stat.S_ISLNK(st.st_mode),
+                "moved": time.time(),
+            })
+            save_manifest(manifest)
+            _path_index[binary].remove(bin_path)
+            print(f"Moved {bin_path} to {dest_path} and made it non-executable")
+        except Exception as e:
+            print(f"Error moving {binary}: {e}")
+
+# Function to put one moved binary back where it came from, with its owner and mode
+def restore_entry(entry):
+    original = entry["original"]
+    if not in_dest_dir(entry["stored"]):
+        print(f"Not restoring {entry['name']}, {entry['stored']} is not in {DEST_DIR}")
+        return False
+    if os.path.lexists(original):
+        print(f"Not restoring {entry['name']}, {original} exists")
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(original), exist_ok=True)
+        shutil.move(entry["stored"], original)
+        if not entry.get("link"):
+            # a move across filesystems copies the file, the copy belongs to whoever ran the script
+            os.chown(original, entry["uid"], entry["gid"])
+            # Add executable permission back, after chown which clears setuid bits
+            os.chmod(original, entry["mode"])
+        else:
+            os.lchown(original, entry["uid"], entry["gid"])
+        print(f"Moved {entry['name']} back to {original} and restored its permissions")
+        return True
+    except Exception as e:
+        print(f"Error restoring {entry['name']}: {e}")
+        return False
 
-# Function to restore a GTFOBin to its original location and make it executable
+# Function to restore GTFOBins to their original locations and make them executable, in parallel
+def restore_bins(binaries, manifest, workers=RESTORE_WORKERS):
+    entries = [entry for entry in manifest if entry["name"] in binaries]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        restored = list(pool.map(restore_entry, entries))
+
+    done = [entry for entry, ok in zip(entries, restored) if ok]
+    manifest[:] = [entry for entry in manifest if entry not in done]
+    save_manifest(manifest)
+
+    # moved before there was a manifest, they only exist as DEST_DIR/<name>
+    for binary in binaries:
+        if not any(entry["name"] == binary for entry in entries):
+            restore_bin(binary)
+
+# Function to restore a GTFOBin moved without a manifest to /usr/bin and make it executable
 def restore_bin(binary):
     bin_path = os.path.join(DEST_DIR, binary)
     if os.path.isfile(bin_path):
+        if not in_dest_dir(bin_path) or not trusted(os.lstat(bin_path)):
+            print(f"Not restoring {binary}, {bin_path} is not owned by root or is writable by group or others")
+            return
         try:
             dest_path = os.path.join("/usr/bin", binary)
             shutil.move(bin_path, dest_path)
@@ -61,37 +223,324 @@ def restore_bin(binary):
     else:
         print(f"{binary} not found in {DEST_DIR}")
 
+# Function to list the GTFOBins found in PATH and the ones that were moved
+def list_bins(manifest):
+    for binary in dict.fromkeys(GTFOBINS):
+        for bin_path in locate_bins(binary):
+            print(f"{binary:<12} in PATH   {bin_path}")
+    for entry in manifest:
+        moved = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["moved"]))
+        print(f"{entry['name']:<12} moved     {entry['original']} -> {entry['stored']} ({oct(entry['mode'])}, {entry['uid']}:{entry['gid']}, {moved})")
+
+# Function to expand 'all' to every GTFOBin, or every moved one when restoring
+def selected_bins(bin_name, manifest=None):
+    if bin_name != "all":
+        return [bin_name]
+    if manifest is not None:
+        legacy = [binary for binary in GTFOBINS if os.path.isfile(os.path.join(DEST_DIR, binary))]
+        return list(dict.fromkeys([entry["name"] for entry in manifest] + legacy))
+    return list(dict.fromkeys(GTFOBINS))
+
+# Function to hash a file, None if it can't be read
+def sha256_file(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+# Function to hash the GTFOBins of this system, in PATH and moved ones, to recognize renamed copies
+# Returns size -> {sha256: name}, only files of one of these sizes need to be hashed when scanning
+def known_hashes(manifest):
+    known = {}
+    paths = [(binary, os.path.realpath(bin_path)) for binary in dict.fromkeys(GTFOBINS) for bin_path in locate_bins(binary)]
+    paths += [(entry["name"], entry["stored"]) for entry in manifest if not entry.get("link")]
+    for binary, path in paths:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            continue
+        digest = sha256_file(path)
+        if digest:
+            known.setdefault(size, {}).setdefault(digest, binary)
+    return known
+
+# Walks whole filesystems with a pool of os.scandir threads and streams what it finds as JSON Lines.
+# Directories are handed out last in first out, so the queue only holds the pending siblings along the
+# current paths instead of a whole level of the tree, and only files whose size matches a known GTFOBin are hashed.
+class Scanner:
+    def __init__(self, roots, output, known, index=None, workers=SCAN_WORKERS, changed_only=False, skip=()):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.output = output
+        self.known = known
+        self.names = set(GTFOBINS)
+        # path -> [inode, size, mtime_ns, sha256, flags] of the last scan, see load_index
+        self.previous = index or {}
+        self.index = {}
+        self.workers = max(1, workers)
+        self.changed_only = changed_only
+        self.skip = set(os.path.abspath(path) for path in skip)
+
+        self.directories = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # directories queued or being listed, the walk is done when it drops to 0
+        self.outstanding = 0
+        self.files = 0
+        self.dirs = 0
+        self.hashed = 0
+        self.reused = 0
+        self.findings = 0
+        self.errors = 0
+
+    # Write one JSON line, lines from different threads never interleave
+    def _emit(self, record):
+        line = json.dumps(record) + "\n"
+        with self.write_lock:
+            self.output.write(line)
+
+    # Hash a file, unless the last scan hashed it and its inode, size and mtime did not change since
+    def _hash(self, path, st):
+        entry = self.previous.get(path)
+        if entry and entry[3] and entry[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+            with self.lock:
+                self.reused += 1
+            return entry[3]
+        with self.lock:
+            self.hashed += 1
+        return sha256_file(path)
+
+    # Check one file, report it if it is a GTFOBin, SUID/SGID or a world writable executable
+    def _check(self, path, name, st):
+        flags = []
+        digest = None
+        gtfobin = None
+        executable = st.st_mode & EXEC_BITS
+
+        if stat.S_ISLNK(st.st_mode):
+            # the target is checked where it is, the name of a link is enough to run it
+            if name in self.names:
+                flags.append("gtfobin-name")
+                gtfobin = name
+        elif stat.S_ISREG(st.st_mode) and executable:
+            if name in self.names:
+                flags.append("gtfobin-name")
+                gtfobin = name
+            hashes = self.known.get(st.st_size)
+            if hashes:
+                digest = self._hash(path, st)
+                if digest in hashes and hashes[digest] != name:
+                    flags.append("gtfobin-hash")
+                    gtfobin = gtfobin or hashes[digest]
+            if st.st_mode & stat.S_ISUID:
+                flags.append("suid")
+            if st.st_mode & stat.S_ISGID:
+                flags.append("sgid")
+            if st.st_mode & stat.S_IWOTH:
+                flags.append("world-writable")
+
+        if not flags:
+            if digest:
+                # not reported, but its hash is kept for the next scan
+                with self.lock:
+                    self.index[path] = [st.st_ino, st.st_size, st.st_mtime_ns, digest, flags]
+            return
+
+        previous = self.previous.get(path)
+        if previous is None or not previous[4]:
+            status = "new"
+        elif previous[:3] == [st.st_ino, st.st_size, st.st_mtime_ns] and previous[4] == flags:
+            status = "unchanged"
+        else:
+            status = "changed"
+
+        with self.lock:
+            self.index[path] = [st.st_ino, st.st_size, st.st_mtime_ns, digest, flags]
+            self.findings += 1
+
+        if self.changed_only and status == "unchanged":
+            return
+
+        record = {"path": path, "flags": flags, "status": status, "mode": oct(stat.S_IMODE(st.st_mode)),
+                  "uid": st.st_uid, "gid": st.st_gid, "size": st.st_size, "mtime": st.st_mtime}
+        if gtfobin:
+            record["gtfobin"] = gtfobin
+        if digest:
+            record["sha256"] = digest
+        if stat.S_ISLNK(st.st_mode):
+            try:
+                record["target"] = os.readlink(path)
+            except OSError:
+                pass
+        self._emit(record)
+
+    def _walk(self):
+        while True:
+            item = self.directories.get()
+            if item is None:
+                return
+
+            directory, device = item
+            subdirectories = 0
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                # stay on the filesystem of the root, other mounts are scanned when they are given as roots
+                                if entry.path not in self.skip and entry.stat(follow_symlinks=False).st_dev == device:
+                                    with self.lock:
+                                        self.outstanding += 1
+                                    self.directories.put((entry.path, device))
+                                    subdirectories += 1
+                                continue
+
+                            self._check(entry.path, entry.name, entry.stat(follow_symlinks=False))
+                        except OSError:
+                            with self.lock:
+                                self.errors += 1
+                        with self.lock:
+                            self.files += 1
+            except OSError:
+                with self.lock:
+                    self.errors += 1
+
+            with self.lock:
+                self.dirs += 1
+                self.outstanding -= 1
+                done = self.outstanding == 0
+
+            if done:
+                # every directory was listed, stop the workers
+                for _ in range(self.workers):
+                    self.directories.put(None)
+
+    # Scan every root, then report the findings of the last scan that are gone
+    def run(self):
+        start = time.time()
+        for root in self.roots:
+            try:
+                device = os.lstat(root).st_dev
+            except OSError as e:
+                print(f"Error scanning {root}: {e}", file=sys.stderr)
+                continue
+
+            self.outstanding = 1
+            self.directories.put((root, device))
+            threads = [threading.Thread(target=self._walk, daemon=True) for _ in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        for path, entry in self.previous.items():
+            if entry[4] and not self.index.get(path, [None] * 5)[4] and any(path == root or path.startswith(root.rstrip("/") + "/") for root in self.roots):
+                self._emit({"path": path, "flags": entry[4], "status": "removed"})
+
+        elapsed = time.time() - start
+        print(f"Scanned {self.files} files in {self.dirs} directories in {elapsed:.1f}s ({self.files / max(elapsed, 0.001):.0f} files/sec), "
+              f"{self.findings} findings, {self.hashed} hashed, {self.reused} hashes reused, {self.errors} errors", file=sys.stderr)
+
+# Function to read the index of the last scan, path -> [inode, size, mtime_ns, sha256, flags]
+def load_index(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"Error reading the scan index: {e}", file=sys.stderr)
+        return {}
+
+# Function to save the index of a scan, the findings and the hashes of the files of the roots it scanned
+def save_index(path, scanner):
+    index = {p: entry for p, entry in scanner.previous.items()
+             if not any(p == root or p.startswith(root.rstrip("/") + "/") for root in scanner.roots)}
+    index.update(scanner.index)
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".tmp", path)
+
+# Function to scan filesystems for GTFOBins, renamed copies of them, SUID/SGID and world writable executables
+def scan(roots, output_file=None, index_file=None, workers=SCAN_WORKERS, changed_only=False, manifest=()):
+    known = known_hashes(manifest)
+    index = load_index(index_file) if index_file else {}
+    output = open(output_file, "w") if output_file else sys.stdout
+    try:
+        # the moved binaries are not executable anymore, they don't need to be reported
+        scanner = Scanner(roots, output, known, index, workers, changed_only, skip=[DEST_DIR])
+        scanner.run()
+    finally:
+        if output_file:
+            output.close()
+        else:
+            output.flush()
+
+    if index_file:
+        save_index(index_file, scanner)
+    return scanner
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Move GTFOBins out of PATH and make them non-executable, or put them back. "
+                                                 "Asks what to do when run without options.")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--move", metavar="NAME", help="Move a binary, or 'all' GTFOBins")
+    action.add_argument("--restore", metavar="NAME", help="Restore a binary, or 'all' moved binaries")
+    action.add_argument("--list", action="store_true", help="List the GTFOBins in PATH and the moved ones")
+    action.add_argument("--scan", nargs="*", metavar="DIR",
+                        help="Scan whole filesystems (default: /) for GTFOBins, renamed copies of them, SUID/SGID and "
+                             "world writable executables, without crossing into other mounts, as JSON Lines")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"Binaries restored at once (default: {RESTORE_WORKERS}), or threads scanning (default: {SCAN_WORKERS})")
+    parser.add_argument("--output", default=None, help="Write the scan report to this file instead of stdout")
+    parser.add_argument("--index", default=None, help="Index of the last scan, unchanged files are not hashed again and findings get a status")
+    parser.add_argument("--changed", action="store_true", help="Only report findings that are new, changed or removed since the last scan")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+
     # Create the destination directory if it does not exist
-    if not os.path.isdir(DEST_DIR):
-        os.makedirs(DEST_DIR)
+    if not prepare_dest_dir():
+        return
+    manifest = load_manifest()
+
+    if args.list:
+        list_bins(manifest)
+        return
+    if args.move:
+        for bin in selected_bins(args.move):
+            move_bin(bin, manifest)
+        return
+    if args.restore:
+        restore_bins(selected_bins(args.restore, manifest), manifest, args.workers or RESTORE_WORKERS)
+        return
+    if args.scan is not None:
+        scan(args.scan or ["/"], args.output, args.index, args.workers or SCAN_WORKERS, args.changed, manifest)
+        return
 
     # Prompt the user for action
     print("Choose an action:")
     print("1. Move GTFOBins to a different location and make them non-executable")
     print("2. Restore GTFOBins to their original locations and make them executable")
-    
+
     try:
         choice = int(input("Enter your choice (1 or 2): "))
-        
+
         if choice == 1:
             bin_name = input("Enter the name of the binary to move (or 'all' to move all GTFOBins): ")
-            if bin_name == "all":
-                for bin in GTFOBINS:
-                    move_bin(bin)
-            else:
-                move_bin(bin_name)
+            for bin in selected_bins(bin_name):
+                move_bin(bin, manifest)
         elif choice == 2:
             bin_name = input("Enter the name of the binary to restore (or 'all' to restore all GTFOBins): ")
-            if bin_name == "all":
-                for bin in GTFOBINS:
-                    restore_bin(bin)
-            else:
-                restore_bin(bin_name)
+            restore_bins(selected_bins(bin_name, manifest), manifest, args.workers or RESTORE_WORKERS)
         else:
             print("Invalid choice. Please run the script again and choose 1 or 2.")
     except ValueError:
         print("Please enter a number (1 or 2).")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
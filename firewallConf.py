@@ -4,54 +4,603 @@
 # Imports
 import os
 import argparse
+import collections
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+# Where ufw keeps the added rules, /etc/default/ufw says if IPv6 is enabled
+UFW_DIR = "/etc/ufw"
+UFW_DEFAULTS = "/etc/default/ufw"
+
+# The rules are one section of user.rules and user6.rules, everything else in them is left to ufw
+RULES_START = "### RULES ###"
+RULES_END = "### END RULES ###"
+TUPLE_PREFIX = "### tuple ### "
+
+ANY_V4 = "0.0.0.0/0"
+ANY_V6 = "::/0"
+
+# One ufw rule. port is a port, a range like 1000:2000 or a comma separated list, src and dst are CIDRs
+Rule = collections.namedtuple("Rule", ["action", "direction", "proto", "port", "src", "dst", "comment"])
+
+def rule(action, port="any", proto="any", direction="in", src="any", dst="any", comment=""):
+	return Rule(action, direction, proto, str(port), src, dst, comment)
+
+# Run a command, through sudo unless we are root
+def run(args, check=True):
+	if os.geteuid() != 0:
+		args = ["sudo"] + args
+	return subprocess.run(args, check=check, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
 
 # Get firewall status
 def getFirewallStatus():
-	os.system("sudo ufw status verbose numbered")
+	print(run(["ufw", "status", "verbose", "numbered"], check=False).stdout)
 
-# Enables UFW
+def firewallActive():
+	return "Status: active" in run(["ufw", "status"], check=False).stdout
+
+# Enables UFW, it loads the rules when it starts
 def enableFirewall():
-	os.system("sudo ufw enable")
-	os.system("sudo ufw start")
+	if not firewallActive():
+		run(["ufw", "--force", "enable"])
 	getFirewallStatus()
 
+# Read a file only root can read, "" if it does not exist
+def readFile(path):
+	if os.geteuid() == 0 or os.access(path, os.R_OK):
+		try:
+			with open(path) as f:
+				return f.read()
+		except FileNotFoundError:
+			return ""
+	res = run(["cat", path], check=False)
+	return res.stdout if res.returncode == 0 else ""
+
+# Replace a file at once, a reader sees either the old or the new content
+def writeFile(path, content):
+	fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) if os.geteuid() == 0 else None, prefix=".firewallConf_")
+	with os.fdopen(fd, "w") as f:
+		f.write(content)
+	if os.geteuid() == 0:
+		if os.path.exists(path):
+			shutil.copymode(path, tmp)
+		os.replace(tmp, path)
+	else:
+		run(["install", "-m", "0640", tmp, path + ".new"])
+		run(["mv", "-f", path + ".new", path])
+		os.unlink(tmp)
+
+def ipv6Enabled(defaultsFile):
+	for line in readFile(defaultsFile).splitlines():
+		if line.strip().startswith("IPV6="):
+			return line.split("=", 1)[1].strip().strip('"').lower() == "yes"
+	return False
+
+# Which of user.rules (v4) and user6.rules (v6) a rule belongs in, rules for any address go in both
+def ruleFamilies(r, v6Enabled):
+	families = set()
+	for addr in (r.src, r.dst):
+		if addr != "any":
+			families.add("v6" if ":" in addr else "v4")
+	if not families:
+		families = {"v4", "v6"} if v6Enabled else {"v4"}
+	if families == {"v6"} and not v6Enabled:
+		return set()
+	return families
+
+# The tuple comment and the iptables lines of a rule, the same as ufw writes them
+def formatRule(r, family):
+	anyAddr = ANY_V6 if family == "v6" else ANY_V4
+	src = anyAddr if r.src == "any" else r.src
+	dst = anyAddr if r.dst == "any" else r.dst
+	lines = [TUPLE_PREFIX + " ".join([r.action, r.proto, r.port, dst, "any", src, r.direction])]
+	if r.comment:
+		lines[0] += " comment=" + r.comment.encode().hex()
+
+	args = ""
+	if dst != anyAddr:
+		args += " -d " + dst
+	if r.port != "any":
+		args += (" -m multiport --dports " if "," in r.port or ":" in r.port else " --dport ") + r.port
+	if src != anyAddr:
+		args += " -s " + src
+
+	if r.action == "allow":
+		target = " -j ACCEPT"
+	elif r.action == "reject":
+		target = " -j REJECT"
+	elif r.action == "limit":
+		target = " -j ufw-user-limit"
+	else:
+		target = " -j DROP"
+
+	chain = "-A ufw-user-input" if r.direction == "in" else "-A ufw-user-output"
+	# a port without a protocol matches tcp and udp
+	protos = ["tcp", "udp"] if r.proto == "any" and r.port != "any" else ["all" if r.proto == "any" else r.proto]
+	for proto in protos:
+		lines.append(chain + " -p " + proto + args + target)
+		if r.action == "limit":
+			lines.append(chain + " -p " + proto + args + " -j ufw-user-limit-accept")
+	return lines
+
+# Parse one tuple comment, None for the ones this script does not write, like the rules of application profiles
+def parseTuple(line):
+	fields = line[len(TUPLE_PREFIX):].split()
+	comment = ""
+	if fields and fields[-1].startswith("comment="):
+		try:
+			comment = bytes.fromhex(fields.pop()[len("comment="):]).decode()
+		except ValueError:
+			pass
+	# rules of application profiles have two more fields
+	if len(fields) != 7:
+		return None
+	action, proto, dport, dst, _, src, direction = fields
+	return canonicalRule(Rule(action, direction, proto, dport, src, dst, comment))
+
+# A rule as it is read back from the rules files, where an address range covering a whole family is "any"
+def canonicalRule(r):
+	src = "any" if r.src in (ANY_V4, ANY_V6) else r.src
+	dst = "any" if r.dst in (ANY_V4, ANY_V6) else r.dst
+	return r._replace(src=src, dst=dst)
+
+# Parse the rules of user.rules or user6.rules from their tuple comments
+def parseRules(text):
+	rules = []
+	for line in text.splitlines():
+		if line.startswith(TUPLE_PREFIX):
+			r = parseTuple(line)
+			if r is not None:
+				rules.append(r)
+	return rules
+
+# The blocks of the rules section this script can't parse, each a tuple comment and its iptables lines.
+# They are written back as they are.
+def foreignBlocks(text):
+	blocks = []
+	block = None
+	for line in text.splitlines():
+		if line.startswith(TUPLE_PREFIX):
+			block = [line] if parseTuple(line) is None else None
+			if block:
+				blocks.append(block)
+		elif block is not None and line.startswith("-A "):
+			block.append(line)
+		else:
+			block = None
+	return blocks
+
+# Replace the rules section of user.rules or user6.rules
+def renderRules(text, rules, family):
+	lines = text.splitlines()
+	try:
+		start = lines.index(RULES_START)
+		end = lines.index(RULES_END)
+	except ValueError:
+		raise ValueError("No {} section".format(RULES_START))
+
+	section = [""]
+	for r in rules:
+		section += formatRule(r, family) + [""]
+	# after the rules of the script, which win where they overlap
+	for block in foreignBlocks("\n".join(lines[start:end])):
+		section += block + [""]
+	return "\n".join(lines[:start + 1] + section + lines[end:]) + "\n"
+
+# The rules to add and remove to get from the current rules to the desired ones
+def diffRules(current, desired):
+	currentSet = set(current)
+	desiredSet = set(desired)
+	added = [r for r in desired if r not in currentSet]
+	removed = [r for r in current if r not in desiredSet]
+	return added, removed
+
+def describeRule(r):
+	text = "{} {}".format(r.action, r.direction)
+	if r.proto != "any":
+		text += " proto " + r.proto
+	if r.src != "any":
+		text += " from " + r.src
+	if r.dst != "any":
+		text += " to " + r.dst
+	if r.port != "any":
+		text += " port " + r.port
+	if r.comment:
+		text += ' comment "{}"'.format(r.comment)
+	return text
+
+# Apply a whole ruleset in one step: the rules files are written once and ufw reloads them once.
+# Nothing is written when the rules are already in place, so running it again changes nothing.
+# If the reload fails the previous files are put back.
+def applyRules(desired, dryRun=False, ufwDir=UFW_DIR, defaultsFile=UFW_DEFAULTS):
+	desired = list(collections.OrderedDict.fromkeys(desired))
+	v6 = ipv6Enabled(defaultsFile)
+	skipped = [r for r in desired if not ruleFamilies(r, v6)]
+	if skipped:
+		print("Skipping {} IPv6 rules, IPv6 is disabled in {}".format(len(skipped), defaultsFile))
+		desired = [r for r in desired if ruleFamilies(r, v6)]
+	files = {"v4": os.path.join(ufwDir, "user.rules")}
+	if v6:
+		files["v6"] = os.path.join(ufwDir, "user6.rules")
+
+	old = {family: readFile(path) for family, path in files.items()}
+	if not old["v4"]:
+		print("{} does not exist, is ufw installed?".format(files["v4"]))
+		return False
+
+	changed = {}
+	current = []
+	kept = 0
+	for family, path in files.items():
+		rules = parseRules(old[family])
+		current += rules
+		kept += len(foreignBlocks(old[family]))
+		# compared as they are read back, a list entry of 0.0.0.0/0 stays in user.rules only
+		wanted = [canonicalRule(r) for r in desired if family in ruleFamilies(r, v6)]
+		# the order matters, the first matching rule wins
+		if rules != wanted:
+			changed[family] = renderRules(old[family], wanted, family)
+
+	added, removed = diffRules(list(collections.OrderedDict.fromkeys(current)), [canonicalRule(r) for r in desired])
+	for r in removed:
+		print("- " + describeRule(r))
+	for r in added:
+		print("+ " + describeRule(r))
+	if removed:
+		print("{} rules marked - are not in the ruleset of this script and are removed, add them to an allow or deny list to keep them".format(len(removed)))
+	if kept:
+		print("Keeping {} rules this script does not manage, like the rules of application profiles".format(kept))
+
+	if not changed:
+		print("Firewall rules are up to date ({} rules)".format(len(desired)))
+		return True
+	if dryRun:
+		print("Dry run, {} rules to add, {} to remove{}".format(len(added), len(removed), ", reordered" if not added and not removed else ""))
+		return True
+
+	for family, content in changed.items():
+		writeFile(files[family], content)
+
+	if firewallActive():
+		res = run(["ufw", "reload"], check=False)
+		if res.returncode != 0:
+			print("ufw reload failed, restoring the previous rules:\n" + res.stdout)
+			for family in changed:
+				writeFile(files[family], old[family])
+			run(["ufw", "reload"], check=False)
+			return False
+	print("Applied {} rules, {} added, {} removed".format(len(desired), len(added), len(removed)))
+	return True
+
+def setLogging(level, ufwDir=UFW_DIR, dryRun=False):
+	for line in readFile(os.path.join(ufwDir, "ufw.conf")).splitlines():
+		if line.strip() == "LOGLEVEL={}".format(level):
+			return
+	print("Logging: {}".format(level))
+	if not dryRun:
+		run(["ufw", "logging", level])
+
+# Look up the port of a service in /etc/services
+def servicePort(name, proto="tcp"):
+	return str(socket.getservbyname(name, proto))
+
 # Default firewall configuration (doesn't change)
-def defaultConfig():
+def defaultRules():
+	return [
+		# Anti-lockout rule
+		rule("allow", servicePort("ssh"), "tcp", comment="Allow SSH"),
+
+		# TODO: DNS?
+		rule("allow", 53, comment="Allow DNS"),
+
+		# Block Telnet
+		rule("deny", servicePort("telnet"), "tcp", comment="Deny Telnet in"),
+		rule("deny", servicePort("telnet"), "tcp", direction="out", comment="Deny Telnet out"),
+
+		# Block common Metasploit ports
+		rule("deny", 4444, comment="Deny Metasploit"),
+		rule("deny", 9001, comment="Deny Metasploit"),
+	]
+
+def defaultConfig(dryRun=False, ufwDir=UFW_DIR, extraRules=()):
 	# Enable logging
-	os.system("sudo ufw logging medium")
-	os.system("sudo ufw logging on")
-	
-	# Anti-lockout rule
-	os.system('sudo ufw allow in ssh comment "Allow SSH"')
+	setLogging("medium", ufwDir, dryRun)
+	return applyRules(defaultRules() + list(extraRules), dryRun, ufwDir)
 
-	# TODO: DNS?
-	os.system('sudo ufw allow in dns comment "Allow DNS"')
+# Allow and deny lists
+# A list file holds ports (22, 22/tcp), port ranges (6000-6100/udp, 6000:6100) and addresses or CIDRs
+# (10.0.0.0/8, 2001:db8::/32), separated by spaces, commas or lines, # starts a comment.
+# Ports become incoming rules on those ports, addresses incoming rules from those sources.
+PORT_ENTRY = re.compile(r"(\d+)(?:[-:](\d+))?(?:/(tcp|udp|any))?$")
+ADDRESS_BITS = {"v4": 32, "v6": 128}
 
-	# Block Telnet
-	os.system('sudo ufw deny telnet     comment "Deny Telnet in"')
-	os.system('sudo ufw deny out telnet comment "Deny Telnet out"')
+# Ports in one multiport rule, iptables allows 15 and a range takes 2
+MULTIPORT_SLOTS = 15
 
-	# Block common Metasploit ports
-	os.system('sudo ufw deny 4444 comment "Deny Metasploit"')
-	os.system('sudo ufw deny 9001 comment "Deny Metasploit"')
+# Parse one entry into (kind, proto, first, last), kind is ports, v4 or v6 and addresses are integers
+def parseEntry(entry):
+	# most entries of long lists are IPv4 addresses, they skip the port pattern
+	match = None if "." in entry else PORT_ENTRY.match(entry)
+	if match:
+		first = int(match.group(1))
+		last = int(match.group(2) or first)
+		if not 0 < first <= last <= 65535:
+			raise ValueError("Invalid port range: {}".format(entry))
+		return "ports", match.group(3) or "any", first, last
 
-# MAIN
-if __name__ == "__main__":
-	# Get input from user
-	parser = argparse.ArgumentParser()
+	address, _, prefix = entry.partition("/")
+	if ":" in address:
+		kind, family, bits = "v6", socket.AF_INET6, 128
+	else:
+		kind, family, bits = "v4", socket.AF_INET, 32
+	try:
+		value = int.from_bytes(socket.inet_pton(family, address), "big")
+	except OSError:
+		raise ValueError("Invalid port or address: {}".format(entry))
+	if not prefix:
+		return kind, None, value, value
+	if not prefix.isdigit() or int(prefix) > bits:
+		raise ValueError("Invalid prefix: {}".format(entry))
+
+	host = (1 << (bits - int(prefix))) - 1
+	return kind, None, value & ~host, value | host
+
+# Read list files into {(kind, proto): [(first, last), ...]}
+def readLists(files):
+	ranges = collections.defaultdict(list)
+	count = 0
+	for path in files:
+		with open(path) as f:
+			text = f.read()
+		if "#" in text:
+			text = re.sub(r"#[^\n]*", "", text)
+		for entry in text.replace(",", " ").split():
+			try:
+				kind, proto, first, last = parseEntry(entry)
+			except ValueError as e:
+				# only look for the line of the entry when it is wrong
+				lineNo = next(i for i, line in enumerate(text.splitlines(), 1) if entry in line.replace(",", " ").split())
+				raise ValueError("{}:{}: {}".format(path, lineNo, e))
+			ranges[(kind, proto)].append((first, last))
+			count += 1
+	return ranges, count
+
+# Sort ranges, dropping duplicates and merging the ones that overlap or are adjacent
+def mergeRanges(ranges):
+	merged = []
+	end = -2
+	for first, last in sorted(ranges):
+		if first > end + 1:
+			merged.append((first, last))
+			end = last
+		elif last > end:
+			merged[-1] = (merged[-1][0], last)
+			end = last
+	return merged
+
+# Parts of sorted merged ranges not covered by other sorted merged ranges
+def subtractRanges(ranges, covered):
+	result = []
+	i = 0
+	for first, last in ranges:
+		while i < len(covered) and covered[i][1] < first:
+			i += 1
+		j = i
+		while first <= last and j < len(covered) and covered[j][0] <= last:
+			if covered[j][0] > first:
+				result.append((first, covered[j][0] - 1))
+			first = max(first, covered[j][1] + 1)
+			j += 1
+		if first <= last:
+			result.append((first, last))
+	return result
+
+# Overlaps of two sorted merged range lists
+def overlapRanges(a, b):
+	result = []
+	i = j = 0
+	while i < len(a) and j < len(b):
+		first = max(a[i][0], b[j][0])
+		last = min(a[i][1], b[j][1])
+		if first <= last:
+			result.append((first, last))
+		if a[i][1] < b[j][1]:
+			i += 1
+		else:
+			j += 1
+	return result
+
+# Normalise the ranges of one action: merged per kind, tcp and udp ports covered by "any" ports dropped
+def normaliseRanges(ranges):
+	merged = {key: mergeRanges(r) for key, r in ranges.items()}
+	anyPorts = merged.get(("ports", "any"), [])
+	for proto in ("tcp", "udp"):
+		if ("ports", proto) in merged:
+			merged[("ports", proto)] = subtractRanges(merged[("ports", proto)], anyPorts)
+	return {key: r for key, r in merged.items() if r}
 
+def formatAddress(kind, value):
+	if kind == "v6":
+		return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, "big"))
+	return socket.inet_ntop(socket.AF_INET, value.to_bytes(4, "big"))
 
-	# TODO: Check if UFW is installed
+def formatRange(kind, proto, first, last):
+	if kind == "ports":
+		text = str(first) if first == last else "{}-{}".format(first, last)
+		return text + ("/" + proto if proto != "any" else "")
+	return formatAddress(kind, first) + ("-" + formatAddress(kind, last) if first != last else "")
 
+# Ranges allowed and denied at once: ports of any protocol overlap tcp and udp ports, addresses of the same family
+def findConflicts(allow, deny):
+	conflicts = []
+	for (kind, proto), allowed in sorted(allow.items(), key=str):
+		for (denyKind, denyProto), denied in sorted(deny.items(), key=str):
+			if kind != denyKind or (kind == "ports" and "any" not in (proto, denyProto) and proto != denyProto):
+				continue
+			shared = proto if proto != "any" else denyProto
+			for first, last in overlapRanges(allowed, denied):
+				conflicts.append(formatRange(kind, shared, first, last))
+	return conflicts
 
-	# TODO: Parse file with of ports
+# The ports rules open or close to every source, as normalised ranges per action
+def portRanges(rules):
+	ranges = {"allow": collections.defaultdict(list), "deny": collections.defaultdict(list)}
+	for r in rules:
+		if r.direction != "in" or r.src != "any" or r.dst != "any" or r.port == "any":
+			continue
+		action = "allow" if r.action in ("allow", "limit") else "deny"
+		for part in r.port.split(","):
+			first, _, last = part.partition(":")
+			ranges[action][("ports", r.proto)].append((int(first), int(last or first)))
+	return {action: normaliseRanges(r) for action, r in ranges.items()}
 
+# List entries the default rules come before and decide otherwise: ports of the other action, and the ports
+# the other action opens or closes to every source, which list addresses can't change
+def findShadowed(allow, deny, defaults):
+	defaultRanges = portRanges(defaults)
+	shadowed = []
+	for name, ranges, other, verb in (("allow", allow, defaultRanges["deny"], "denied"), ("deny", deny, defaultRanges["allow"], "allowed")):
+		pair = (ranges, other) if name == "allow" else (other, ranges)
+		for entry in findConflicts(*pair):
+			shadowed.append("{} of the {} list is {} by the default rules".format(entry, name, verb))
+		if other and any(kind != "ports" for kind, _ in ranges):
+			ports = ", ".join(formatRange("ports", proto, first, last) for (_, proto), r in sorted(other.items(), key=str) for first, last in r)
+			shadowed.append("the addresses of the {} list stay {} on {} by the default rules".format(name, verb, ports))
+	return shadowed
+
+# Drop the ports the default rules already open or close the same way, tcp and udp ports included in "any" ports
+def dropDefaults(ranges, defaultRanges):
+	kept, skipped = dict(ranges), []
+	anyPorts = defaultRanges.get(("ports", "any"), [])
+	for (kind, proto), r in sorted(ranges.items(), key=str):
+		if kind != "ports":
+			continue
+		covered = mergeRanges(defaultRanges.get((kind, proto), []) + (anyPorts if proto != "any" else []))
+		skipped += [formatRange(kind, proto, first, last) for first, last in overlapRanges(r, covered)]
+		kept[(kind, proto)] = subtractRanges(r, covered)
+	return {key: r for key, r in kept.items() if r}, skipped
+
+# Smallest list of CIDRs covering an address range
+def rangeToCidrs(first, last, bits):
+	cidrs = []
+	while first <= last:
+		# the largest block aligned at first that fits in the range
+		size = min((first & -first).bit_length() - 1 if first else bits, (last - first + 1).bit_length() - 1)
+		cidrs.append((first, bits - size))
+		first += 1 << size
+	return cidrs
+
+# Pack port ranges into multiport lists of at most MULTIPORT_SLOTS ports
+def packPorts(ranges):
+	lists, current, slots = [], [], 0
+	for first, last in ranges:
+		cost = 1 if first == last else 2
+		if slots + cost > MULTIPORT_SLOTS:
+			lists.append(current)
+			current, slots = [], 0
+		current.append(str(first) if first == last else "{}:{}".format(first, last))
+		slots += cost
+	if current:
+		lists.append(current)
+	return [",".join(ports) for ports in lists]
+
+# The rules of one action from its normalised ranges
+def rangeRules(action, ranges, comment):
+	rules = []
+	for proto in ("any", "tcp", "udp"):
+		for ports in packPorts(ranges.get(("ports", proto), [])):
+			# ufw needs a protocol for port lists and ranges
+			if proto == "any" and ("," in ports or ":" in ports):
+				rules.append(rule(action, ports, "tcp", comment=comment))
+				rules.append(rule(action, ports, "udp", comment=comment))
+			else:
+				rules.append(rule(action, ports, proto, comment=comment))
+
+	for kind, family in (("v4", socket.AF_INET), ("v6", socket.AF_INET6)):
+		bits = ADDRESS_BITS[kind]
+		for first, last in ranges.get((kind, None), []):
+			size = last - first + 1
+			# most ranges of long lists are a single CIDR already
+			if size & (size - 1) == 0 and first & (size - 1) == 0:
+				cidrs = [(first, bits + 1 - size.bit_length())]
+			else:
+				cidrs = rangeToCidrs(first, last, bits)
+			for address, prefix in cidrs:
+				cidr = socket.inet_ntop(family, address.to_bytes(bits // 8, "big"))
+				if prefix != bits:
+					cidr += "/{}".format(prefix)
+				rules.append(Rule(action, "in", "any", "any", cidr, "any", comment))
+	return rules
+
+# Compile allow and deny list files into a minimal rule set.
+# Conflicts abort unless prefer says which action wins, its rules then come first as ufw uses the first match.
+# The rules go after defaults, the entries those decide otherwise are reported and the ones they already
+# decide the same way are left out.
+def compileLists(allowFiles=(), denyFiles=(), prefer=None, defaults=()):
+	allowRanges, allowCount = readLists(allowFiles)
+	denyRanges, denyCount = readLists(denyFiles)
+	allow = normaliseRanges(allowRanges)
+	deny = normaliseRanges(denyRanges)
+
+	for entry in findShadowed(allow, deny, defaults):
+		print("Shadowed: " + entry)
+
+	conflicts = findConflicts(allow, deny)
+	if conflicts:
+		for conflict in conflicts[:20]:
+			print("Conflict: {} is both allowed and denied".format(conflict))
+		if len(conflicts) > 20:
+			print("... and {} more conflicts".format(len(conflicts) - 20))
+		if prefer is None:
+			raise ValueError("{} conflicts between the allow and deny lists, use --prefer allow or --prefer deny".format(len(conflicts)))
+
+	defaultRanges = portRanges(defaults)
+	allow, skippedAllow = dropDefaults(allow, defaultRanges["allow"])
+	deny, skippedDeny = dropDefaults(deny, defaultRanges["deny"])
+	for name, skipped in (("allow", skippedAllow), ("deny", skippedDeny)):
+		for entry in skipped:
+			print("Skipping {} of the {} list, the default rules already {} it".format(entry, name, name))
+
+	allowRules = rangeRules("allow", allow, "Allow list")
+	denyRules = rangeRules("deny", deny, "Deny list")
+	rules = allowRules + denyRules if prefer == "allow" else denyRules + allowRules
+	print("Compiled {} list entries into {} rules".format(allowCount + denyCount, len(rules)))
+	return rules
+
+# MAIN
+if __name__ == "__main__":
+	# Get input from user
+	parser = argparse.ArgumentParser(description="Apply the default firewall rules and the allow and deny lists to ufw in one reload. "
+	                                             "The rules section of ufw is replaced: rules added with ufw allow/deny that are not in "
+	                                             "this ruleset are removed, rules of application profiles are kept. Use --dry-run to "
+	                                             "see what would be removed.")
+	parser.add_argument("--dry-run", action="store_true", help="Show the rules that would be added and removed, change nothing")
+	parser.add_argument("--ufw-dir", default=UFW_DIR, help="Directory of the ufw rules files (default: {})".format(UFW_DIR))
+	parser.add_argument("--allow", action="append", default=[], metavar="FILE", help="File of ports, port ranges and CIDRs to allow in, can be repeated")
+	parser.add_argument("--deny", action="append", default=[], metavar="FILE", help="File of ports, port ranges and CIDRs to deny in, can be repeated")
+	parser.add_argument("--prefer", choices=["allow", "deny"], default=None, help="Which list wins where they conflict (default: abort)")
+	args = parser.parse_args()
 
-	# Perform default configuration
-	defaultConfig()
+	# Check if UFW is installed
+	if not shutil.which("ufw") and not args.dry_run:
+		print("ufw is not installed")
+		sys.exit(1)
 
+	# Parse files of ports and addresses
+	try:
+		listRules = compileLists(args.allow, args.deny, args.prefer, defaultRules())
+	except (OSError, ValueError) as e:
+		print(e)
+		sys.exit(1)
 
-	# TODO: Perform configuration based on user input
+	# Perform default configuration, with the rules of the lists after it
+	if not defaultConfig(args.dry_run, args.ufw_dir, listRules):
+		sys.exit(1)
 
 	# Enable UFW
-	enableFirewall()
\ No newline at end of file
+	if not args.dry_run:
+		enableFirewall()
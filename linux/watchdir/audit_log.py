@@ -0,0 +1,346 @@
+"""
+Streaming reader of the auditd log.
+
+auditctl.init_auditd adds a rule tagging every access to the watched directories with config.AUDITDKEY.
+The AuditTail follows /var/log/audit/audit.log like `tail -F`, from where it is when watchdir starts,
+across rotations and truncations, and parses the records of that key as they are written:
+
+- a SYSCALL record with our key starts a group and holds pid, uid, auid, exe and comm
+- CWD and PATH records with the same serial add the working directory and the paths it touched
+- the EOE record (or the group getting too old) ends the group, its paths are indexed
+
+log_change looks up the process that touched a file within a time window around the inotify event.
+Records of other keys are skipped after looking at the first few bytes of the line, and the pending
+groups and the path index are bounded, so memory stays flat however busy the audit log is.
+"""
+
+from collections import OrderedDict, deque
+from util import log
+import os
+import re
+import threading
+import time
+
+
+AUDIT_LOG = "/var/log/audit/audit.log"
+
+# field=value, value is either quoted or runs until the next space
+_FIELD = re.compile(r'(\w+)=("[^"]*"|\S+)')
+# fields that auditd hex encodes when they contain spaces or special characters
+_ENCODED_FIELDS = ("name", "cwd", "exe", "comm", "proctitle")
+_HEX = re.compile(r"^(?:[0-9A-F]{2})+$")
+
+# the audit uid of processes that never logged in, e.g. daemons started at boot
+UNSET_AUID = "4294967295"
+
+READ_SIZE = 1024 * 1024
+
+
+def _value(field:str, value:str) -> str:
+    if value.startswith('"'):
+        return value[1:-1]
+    if field in _ENCODED_FIELDS and _HEX.match(value):
+        return bytes.fromhex(value).decode(errors="replace")
+    return value
+
+
+def parse_fields(line:str) -> dict:
+    """
+    Parse the field=value pairs of an audit record.
+    :param line: The record, without the enriched fields auditd appends after a \\x1d
+    :return: field -> decoded value
+    """
+    return {field: _value(field, value) for field, value in _FIELD.findall(line)}
+
+
+def _header(line:str):
+    """
+    :return: (record type, "timestamp:serial") of a record, or None if the line is not a record
+    """
+    if not line.startswith("type="):
+        return None
+
+    space = line.find(" ", 5)
+    start = line.find("msg=audit(", space)
+    end = line.find(")", start)
+    if space < 0 or start < 0 or end < 0:
+        return None
+
+    return line[5:space], line[start + 10:end]
+
+
+def format_process(process:dict) -> str:
+    """
+    :param process: A process from AuditTail.lookup
+    :return: The process as `pid=.. uid=.. auid=.. exe=.. comm=..`
+    """
+    auid = process.get("auid")
+    return "pid={} uid={} auid={} exe={} comm={}".format(
+        process.get("pid"), process.get("uid"), "unset" if auid == UNSET_AUID else auid, process.get("exe"), process.get("comm"))
+
+
+class _Group:
+    __slots__ = ("timestamp", "process", "cwd", "paths")
+
+    def __init__(self, timestamp:float, process:dict):
+        self.timestamp = timestamp
+        self.process = process
+        self.cwd = None
+        self.paths = []
+
+
+class AuditTail:
+    """
+    Follows the audit log and indexes the paths touched by records with our key.
+    """
+
+    def __init__(self, key:str, log_file:str=AUDIT_LOG, window:float=5, max_paths:int=50000, max_groups:int=4096, poll_interval:float=0.5):
+        """
+        :param key: The audit rule key to follow, see config.AUDITDKEY
+        :param log_file: The audit log
+        :param window: Seconds between an audit record and an inotify event for them to be matched
+        :param max_paths: Paths kept in the index, the least recently touched ones are dropped first
+        :param max_groups: Record groups waiting for their EOE record
+        :param poll_interval: Seconds between reads of the log
+        """
+        self.key = key
+        self.key_field = 'key="{}"'.format(key)
+        self.log_file = log_file
+        self.window = window
+        self.max_paths = max_paths
+        self.max_groups = max_groups
+        self.poll_interval = poll_interval
+
+        self.file = None
+        self.inode = None
+        self.offset = 0
+        self.partial = b""
+        # when the last poll started, every record written before it is indexed
+        self.last_poll = 0.0
+        # serial -> _Group, in the order they started
+        self.groups = OrderedDict()
+        # path -> deque of (timestamp, process), least recently touched first
+        self.paths = OrderedDict()
+
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = None
+
+        self.lines = 0
+        self.matched = 0
+        self.rotations = 0
+        self.lookups = 0
+        self.hits = 0
+        # lookups that had to read the log first
+        self.polls = 0
+
+    def open(self, from_end:bool=True) -> bool:
+        """
+        Open the audit log.
+        :param from_end: Skip what is already in the log, only records written from now on are read
+        :return: True if the log is open, False otherwise.
+        """
+        try:
+            f = open(self.log_file, "rb")
+        except OSError as e:
+            log("Failed to open audit log {}: {}".format(self.log_file, e), "WARNING")
+            return False
+
+        if self.file:
+            self.file.close()
+
+        self.file = f
+        self.inode = os.fstat(f.fileno()).st_ino
+        self.offset = f.seek(0, os.SEEK_END) if from_end else 0
+        self.partial = b""
+        return True
+
+    def start(self) -> bool:
+        """
+        Open the audit log and follow it from a background thread.
+        :return: True if the log is followed, False otherwise.
+        """
+        if not self.open():
+            return False
+
+        self.thread = threading.Thread(target=self._run, name="audit-tail", daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                log("Error reading audit log {}: {}".format(self.log_file, e), "ERROR")
+
+    def _reopen_if_rotated(self) -> bool:
+        try:
+            st = os.stat(self.log_file)
+        except OSError:
+            # rotated away and not created again yet
+            return False
+
+        if st.st_ino != self.inode:
+            # everything up to the end of the old file was read already, the new one is read from its start
+            self.rotations += 1
+            return self.open(from_end=False)
+
+        if st.st_size < self.offset:
+            # truncated in place
+            self.rotations += 1
+            self.file.seek(0)
+            self.offset = 0
+            self.partial = b""
+            return True
+
+        return False
+
+    def poll(self) -> int:
+        """
+        Read and parse everything written to the log since the last poll.
+        :return: The number of lines read
+        """
+        with self.lock:
+            if self.file is None and not self.open():
+                return 0
+
+            started = time.time()
+            count = 0
+            while True:
+                data = self.file.read(READ_SIZE)
+                if not data:
+                    # at the end, read the new file if the log was rotated
+                    if self._reopen_if_rotated():
+                        continue
+                    break
+
+                self.offset += len(data)
+                data = self.partial + data
+                end = data.rfind(b"\n") + 1
+                self.partial = data[end:]
+                if not end:
+                    continue
+
+                lines = data[:end - 1].decode(errors="replace").split("\n")
+                for line in lines:
+                    self._parse_line(line)
+                count += len(lines)
+
+            self.lines += count
+            self._expire()
+            self.last_poll = started
+            return count
+
+    def _parse_line(self, line:str):
+        header = _header(line)
+        if header is None:
+            return
+
+        record, serial = header
+
+        if record == "SYSCALL":
+            # most of a busy audit log is other rules, don't parse those
+            if self.key_field not in line:
+                return
+            try:
+                timestamp = float(serial.partition(":")[0])
+            except ValueError:
+                return
+            fields = parse_fields(line.partition("\x1d")[0])
+            process = {name: fields.get(name) for name in ("pid", "uid", "auid", "exe", "comm", "syscall")}
+            self.groups[serial] = _Group(timestamp, process)
+            self.matched += 1
+            if len(self.groups) > self.max_groups:
+                self._finish(*self.groups.popitem(last=False))
+            return
+
+        group = self.groups.get(serial)
+        if group is None:
+            return
+
+        if record == "EOE":
+            del self.groups[serial]
+            self._finish(serial, group)
+        elif record == "CWD":
+            group.cwd = parse_fields(line.partition("\x1d")[0]).get("cwd")
+        elif record == "PATH":
+            fields = parse_fields(line.partition("\x1d")[0])
+            name = fields.get("name")
+            # the parent directory item of a create or delete, the file itself is the next item
+            if name and name != "(null)" and fields.get("nametype") != "PARENT":
+                group.paths.append(name)
+
+    def _finish(self, serial:str, group:_Group):
+        entry = (group.timestamp, group.process)
+        for name in group.paths:
+            path = os.path.normpath(name if name.startswith("/") or not group.cwd else os.path.join(group.cwd, name))
+
+            entries = self.paths.get(path)
+            if entries is None:
+                entries = self.paths[path] = deque(maxlen=4)
+                if len(self.paths) > self.max_paths:
+                    self.paths.popitem(last=False)
+            else:
+                self.paths.move_to_end(path)
+            entries.append(entry)
+
+    def _expire(self):
+        # groups whose EOE record never came, auditd writes a group at once so they are complete by now
+        cutoff = time.time() - 2
+        while self.groups:
+            serial, group = next(iter(self.groups.items()))
+            if group.timestamp > cutoff:
+                break
+            del self.groups[serial]
+            self._finish(serial, group)
+
+    def lookup(self, path:str, when:float=None):
+        """
+        Find the process that last touched a path around a given time.
+        :param path: The absolute path
+        :param when: When the change was seen, defaults to now
+        :return: A dict with pid, uid, auid, exe, comm and syscall, or None if no record matches
+        """
+        if when is None:
+            when = time.time()
+
+        # auditd may have written the records after the last poll, a burst of changes seen before it needs no read
+        if self.last_poll < when:
+            self.polls += 1
+            self.poll()
+
+        self.lookups += 1
+        with self.lock:
+            entries = self.paths.get(path)
+            if not entries:
+                return None
+            for timestamp, process in reversed(entries):
+                if abs(when - timestamp) <= self.window:
+                    self.hits += 1
+                    return process
+        return None
+
+    def stats(self) -> dict:
+        """
+        :return: Lines read, groups matched, indexed paths, lookups, the polls they needed and hits
+        """
+        return {
+            "lines": self.lines,
+            "matched": self.matched,
+            "pending": len(self.groups),
+            "paths": len(self.paths),
+            "rotations": self.rotations,
+            "lookups": self.lookups,
+            "polls": self.polls,
+            "hits": self.hits,
+        }
+
+    def close(self):
+        self._stop.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -3,7 +3,13 @@ from util import log
 import config
 import sysctl
 
-def init_auditd():
+def init_auditd(directory=None):
+    """
+    Add an auditd rule logging access to a watched directory.
+    :param directory: The directory, config.WATCH_DIR if not given
+    :return: True if the rule was created, False otherwise.
+    """
+    directory = directory or config.WATCH_DIR
 
     log("Checking dependencies")
     if not check_command("auditctl"):
@@ -14,8 +20,8 @@ def init_auditd():
 
 
     log("Creating auditd rule")
-    if not run_command_sudo("auditctl -w {} -k {}".format(config.WATCH_DIR, config.AUDITDKEY)):
-        if not run_command_sudo("auditctl -a always,exit -F dir={}  -F perm=war -k {}".format(config.WATCH_DIR, config.AUDITDKEY)):
+    if not run_command_sudo(["auditctl", "-w", directory, "-k", config.AUDITDKEY]):
+        if not run_command_sudo(["auditctl", "-a", "always,exit", "-F", "dir={}".format(directory), "-F", "perm=war", "-k", config.AUDITDKEY]):
             log("Failed to create auditd rule", "ERROR")
             return False
         else:
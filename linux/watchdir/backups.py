@@ -0,0 +1,181 @@
+"""
+Incremental backups of the watchdir repo.
+
+Every backup fetches the main branch into one shared bare repo (the snapshot store) and records it as
+refs/snapshots/<timestamp>. A fetch only copies objects the store does not have yet, so the time and disk
+space a backup takes grow with the changes since the last backup, not with the size of the repo.
+
+Snapshots are verified after they are taken and pruned with a keep last / hourly / daily retention policy.
+"""
+
+from util import log
+import calendar
+import console
+import os
+import time
+
+
+SNAPSHOT_PREFIX = "refs/snapshots/"
+# Snapshots that are never removed by the retention policy
+PROTECTED_PREFIX = "refs/backups/"
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+
+def _git(git_dir:str, *args):
+    # fetches and verification of a large repo can take a while, they are not cut short
+    return console.run(["git", "--git-dir", git_dir] + list(args), timeout=0)
+
+
+def init_store(store_dir:str) -> bool:
+    """
+    Create the snapshot store if it does not exist.
+    :param store_dir: The bare repo holding the snapshots
+    :return: True if the store exists, False otherwise.
+    """
+    if os.path.isfile(os.path.join(store_dir, "HEAD")):
+        return True
+
+    os.makedirs(store_dir, exist_ok=True)
+    res = console.run(["git", "init", "-q", "--bare", store_dir])
+    if res.returncode != 0:
+        log("Failed to create backup store: {}".format(res.stderr.strip()), "ERROR")
+        return False
+
+    return True
+
+
+def list_snapshots(store_dir:str) -> list:
+    """
+    List the snapshots in the store, oldest first.
+    :param store_dir: The bare repo holding the snapshots
+    :return: A list of (timestamp, ref, sha) tuples
+    """
+    res = _git(store_dir, "for-each-ref", "--format=%(refname) %(objectname)", SNAPSHOT_PREFIX)
+    if res.returncode != 0:
+        return []
+
+    snapshots = []
+    for line in res.stdout.splitlines():
+        ref, _, sha = line.partition(" ")
+        try:
+            timestamp = calendar.timegm(time.strptime(ref[len(SNAPSHOT_PREFIX):], TIMESTAMP_FORMAT))
+        except ValueError:
+            continue
+        snapshots.append((timestamp, ref, sha))
+
+    snapshots.sort()
+    return snapshots
+
+
+def select_retained(timestamps:list, keep_last:int, keep_hourly:int, keep_daily:int) -> set:
+    """
+    Pick the snapshots to keep.
+    The newest keep_last snapshots are kept, plus the newest snapshot of each of the last keep_hourly hours
+    and keep_daily days that have snapshots.
+    :param timestamps: The snapshot timestamps, in seconds since the epoch
+    :return: The set of timestamps to keep
+    """
+    newest_first = sorted(timestamps, reverse=True)
+    keep = set(newest_first[:keep_last])
+
+    for bucket_format, limit in (("%Y%m%d%H", keep_hourly), ("%Y%m%d", keep_daily)):
+        buckets = set()
+        for timestamp in newest_first:
+            if len(buckets) >= limit:
+                break
+            bucket = time.strftime(bucket_format, time.gmtime(timestamp))
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(timestamp)
+
+    return keep
+
+
+def verify_snapshot(store_dir:str, ref:str, expected:str, previous:str=None) -> bool:
+    """
+    Check that a snapshot points at the expected commit and that every object added since the previous snapshot is in the store.
+    Only the new objects are walked, so verifying costs as much as the backup itself.
+    :param store_dir: The bare repo holding the snapshots
+    :param ref: The snapshot ref
+    :param expected: The commit the snapshot should point at
+    :param previous: The previous snapshot ref, if any
+    :return: True if the snapshot is complete, False otherwise.
+    """
+    res = _git(store_dir, "rev-parse", "--verify", "-q", ref + "^{commit}")
+    if res.returncode != 0 or res.stdout.strip() != expected:
+        log("Snapshot {} does not point at {}".format(ref, expected), "ERROR")
+        return False
+
+    args = ["rev-list", "--objects", "--quiet", ref]
+    if previous:
+        args += ["--not", previous]
+
+    res = _git(store_dir, *args)
+    if res.returncode != 0:
+        log("Snapshot {} is missing objects: {}".format(ref, res.stderr.strip()), "ERROR")
+        return False
+
+    return True
+
+
+def snapshot(repo_dir:str, store_dir:str, name:str=None, branch:str="main"):
+    """
+    Take an incremental snapshot of a repo.
+    :param repo_dir: The git directory to back up
+    :param store_dir: The bare repo holding the snapshots
+    :param name: Store the snapshot under refs/backups/<name> instead of a timestamped ref, it is never pruned
+    :param branch: The branch to back up
+    :return: The snapshot ref, or None on failure
+    """
+    if not init_store(store_dir):
+        return None
+
+    res = _git(repo_dir, "rev-parse", "--verify", "-q", "refs/heads/{}^{{commit}}".format(branch))
+    if res.returncode != 0:
+        log("Nothing to back up, {} has no commits".format(branch), "WARNING")
+        return None
+    sha = res.stdout.strip()
+
+    snapshots = list_snapshots(store_dir)
+    if name is None and snapshots and snapshots[-1][2] == sha:
+        log("No changes since the last backup")
+        return snapshots[-1][1]
+
+    if name:
+        ref = PROTECTED_PREFIX + name
+    else:
+        ref = SNAPSHOT_PREFIX + time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+
+    # fetch only transfers the objects the store does not have yet
+    res = _git(store_dir, "fetch", "-q", "--no-tags", repo_dir, "+refs/heads/{}:{}".format(branch, ref))
+    if res.returncode != 0:
+        log("Failed to back up git directory: {}".format(res.stderr.strip()), "ERROR")
+        return None
+
+    previous = snapshots[-1][1] if snapshots else None
+    if not verify_snapshot(store_dir, ref, sha, previous):
+        _git(store_dir, "update-ref", "-d", ref)
+        return None
+
+    # pack the fetched objects once enough of them piled up, cheap when there is nothing to do
+    _git(store_dir, "gc", "--auto", "--quiet")
+    return ref
+
+
+def prune(store_dir:str, keep_last:int, keep_hourly:int, keep_daily:int) -> int:
+    """
+    Delete the snapshots the retention policy does not keep.
+    :param store_dir: The bare repo holding the snapshots
+    :return: The number of deleted snapshots
+    """
+    snapshots = list_snapshots(store_dir)
+    keep = select_retained([timestamp for timestamp, _, _ in snapshots], keep_last, keep_hourly, keep_daily)
+
+    deleted = 0
+    for timestamp, ref, _ in snapshots:
+        if timestamp in keep:
+            continue
+        if _git(store_dir, "update-ref", "-d", ref).returncode == 0:
+            deleted += 1
+
+    return deleted
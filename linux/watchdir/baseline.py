@@ -0,0 +1,397 @@
+"""
+Parallel baseline import.
+
+The first commit of a watched directory holds every file in it. `git add .` reads and hashes them one at
+a time and rewrites the index, which takes very long on a large tree, and nothing is watched meanwhile.
+
+The Baseline walks the tree with several os.scandir workers, reads and hashes the files on several
+threads (hashlib releases the GIL on large buffers) and streams the blobs into one `git fast-import`,
+which writes them straight into a pack. The tree and the commit are built from the hashes at the end.
+
+Progress is saved at every checkpoint: fast-import writes out its pack and the files stored so far are
+saved to a fingerprint index next to the repo. An interrupted baseline starts over where it left off,
+files that did not change since are not read again. The index becomes the fingerprint index of the repo
+once the baseline is done, so the first events for unchanged files don't hash them again either.
+
+Files of STREAM_SIZE bytes or more are never held in memory: the writer sends them to fast-import piece by
+piece and hashes them on the way.
+"""
+
+from util import log
+from fingerprint import FingerprintIndex
+from git_writer import COMMITTER, _data, _quote_path, blob_sha
+import console
+import hashlib
+import os
+import queue
+import stat
+import subprocess
+import threading
+import time
+
+
+# Files and bytes handed between the threads at once, a queue operation per file costs more than hashing a small one
+BATCH_FILES = 256
+BATCH_BYTES = 16 * 1024 * 1024
+
+# Files at least this large are streamed into fast-import in READ_SIZE pieces instead of being read whole
+STREAM_SIZE = 64 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+# the content of a file the writer streams itself
+_STREAM = object()
+
+STATE_FILE = "baseline.idx"
+# exists while a baseline is running or was interrupted
+MARKER_FILE = "baseline.incomplete"
+
+
+class Baseline:
+    """
+    Imports every file of a watched directory into its repo as the initial commit.
+    """
+
+    def __init__(self, repo, exclude=None, workers:int=4, checkpoint_files:int=50000, checkpoint_bytes:int=1024 ** 3,
+                 progress_interval:float=10):
+        """
+        :param repo: The git_utils.Repo, its git directory must already be initialized
+        :param exclude: Called with (path, is_dir), the path is skipped when it returns True
+        :param workers: Threads walking the tree, and threads reading and hashing files
+        :param checkpoint_files: Files stored between checkpoints
+        :param checkpoint_bytes: Bytes stored between checkpoints
+        :param progress_interval: Seconds between progress logs
+        """
+        self.repo = repo
+        self.watch_dir = repo.watch_dir
+        self.exclude = exclude
+        self.workers = max(1, workers)
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_bytes = checkpoint_bytes
+        self.progress_interval = progress_interval
+
+        base = os.path.dirname(repo.repo_dir)
+        self.marker = os.path.join(base, MARKER_FILE)
+        self.state = FingerprintIndex(os.path.join(base, STATE_FILE))
+
+        self.directories = queue.Queue()
+        self.files = queue.Queue(self.workers * 16)
+        self.blobs = queue.Queue(self.workers * 4)
+        self.lock = threading.Lock()
+        # directories queued or being listed, the walk is done when it drops to 0
+        self.outstanding = 0
+        self.walked = 0
+        self.reused = 0
+        self.stored = 0
+        self.bytes = 0
+        self.failed = 0
+        self.started = None
+        self.process = None
+
+    @staticmethod
+    def incomplete(repo) -> bool:
+        """
+        :param repo: The git_utils.Repo
+        :return: True if a baseline of the repo was started and did not finish
+        """
+        return os.path.exists(os.path.join(os.path.dirname(repo.repo_dir), MARKER_FILE))
+
+    def _walk(self):
+        while True:
+            directory = self.directories.get()
+            if directory is None:
+                return
+
+            files = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+
+                        is_dir = stat.S_ISDIR(st.st_mode)
+                        if entry.path == os.path.join(self.watch_dir, ".git") or (self.exclude and self.exclude(entry.path, is_dir)):
+                            continue
+
+                        if is_dir:
+                            with self.lock:
+                                self.outstanding += 1
+                            self.directories.put(entry.path)
+                        elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                            files.append((entry.path, st))
+                            if len(files) >= BATCH_FILES:
+                                self._queue_files(files)
+                                files = []
+            except OSError as e:
+                log("Failed to list {}: {}".format(directory, e), "WARNING")
+
+            if files:
+                self._queue_files(files)
+
+            with self.lock:
+                self.outstanding -= 1
+                done = self.outstanding == 0
+
+            if done:
+                # every directory was listed, stop the walkers and tell the hashers
+                for _ in range(self.workers):
+                    self.directories.put(None)
+                self.files.put(None)
+
+    def _queue_files(self, files:list):
+        with self.lock:
+            self.walked += len(files)
+        self.files.put(files)
+
+    def _hash(self):
+        while True:
+            files = self.files.get()
+            if files is None:
+                # pass the end on to the next hasher, the last one tells the writer
+                self.files.put(None)
+                self.blobs.put(None)
+                return
+
+            blobs = []
+            size = 0
+            for path, st in files:
+                mode = b"120000" if stat.S_ISLNK(st.st_mode) else (b"100755" if st.st_mode & stat.S_IXUSR else b"100644")
+
+                entry = self.state.entries.get(path)
+                if entry is not None and entry[0] == st.st_ino and entry[1] == st.st_size and entry[2] == st.st_mtime_ns:
+                    # stored before the baseline was interrupted
+                    blobs.append((path, st, mode, entry[3], None))
+                    continue
+
+                try:
+                    if stat.S_ISLNK(st.st_mode):
+                        content = os.fsencode(os.readlink(path))
+                    else:
+                        # large files are stored as the stubs of the repo's policy, see largefiles.py
+                        content = self.repo.policy.content(path, st) if self.repo.policy else None
+                        if content is None and st.st_size >= STREAM_SIZE:
+                            # the writer reads it, only the stat is passed on
+                            blobs.append((path, st, mode, None, _STREAM))
+                            continue
+                        if content is None:
+                            with open(path, "rb") as f:
+                                content = f.read()
+                except OSError as e:
+                    log("Failed to read {}: {}".format(path, e), "WARNING")
+                    self.failed += 1
+                    continue
+
+                # the id of the bytes that are stored, even if the file changed after the stat
+                blobs.append((path, st, mode, bytes.fromhex(blob_sha(content)), content))
+                size += len(content)
+                if size >= BATCH_BYTES:
+                    self.blobs.put(blobs)
+                    blobs = []
+                    size = 0
+
+            if blobs:
+                self.blobs.put(blobs)
+
+    def _start_fast_import(self) -> bool:
+        try:
+            self.process = subprocess.Popen(["git", "--git-dir", self.repo.repo_dir, "fast-import", "--quiet", "--date-format=raw"],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except OSError as e:
+            log("Failed to start git fast-import: {}".format(e), "ERROR")
+            return False
+        return True
+
+    def _stream_blob(self, path:str, st:os.stat_result):
+        """
+        Send a large file to fast-import in pieces, hashing them on the way.
+        The data header holds the size of the stat, a file that shrinks or fails to read meanwhile is padded and
+        left out of the commit, the next start commits it as a new file.
+        :param path: The absolute path of the file
+        :param st: Its lstat result
+        :return: The digest of the blob, or None if the file was not stored
+        """
+        try:
+            f = open(path, "rb")
+        except OSError as e:
+            log("Failed to read {}: {}".format(path, e), "WARNING")
+            return None
+
+        write = self.process.stdin.write
+        digest = hashlib.sha1(b"blob " + str(st.st_size).encode() + b"\0")
+        write(b"blob\ndata " + str(st.st_size).encode() + b"\n")
+        remaining = st.st_size
+        complete = True
+        with f:
+            while remaining:
+                try:
+                    block = f.read(min(READ_SIZE, remaining)) if complete else b""
+                except OSError as e:
+                    log("Failed to read {}: {}".format(path, e), "WARNING")
+                    block = b""
+                if not block:
+                    complete = False
+                    block = bytes(min(READ_SIZE, remaining))
+                digest.update(block)
+                write(block)
+                remaining -= len(block)
+        write(b"\n")
+
+        if not complete:
+            log("{} shrank or could not be read, it is committed on the next start".format(path), "WARNING")
+            return None
+        return digest.digest()
+
+    def _checkpoint(self, pending:list):
+        # fast-import writes its pack, once progress echoes back the blobs are safe in the repo
+        self.process.stdin.write(b"checkpoint\nprogress baseline\n")
+        self.process.stdin.flush()
+        self.process.stdout.readline()
+
+        with self.state.lock:
+            for path, st, digest in pending:
+                self.state.entries[path] = (st.st_ino, st.st_size, st.st_mtime_ns, digest)
+            self.state.dirty = True
+        self.state.save()
+        del pending[:]
+
+    def _progress(self, final:bool=False):
+        elapsed = max(time.time() - self.started, 0.001)
+        log("Baseline of {}{}: {} files stored ({} reused), {:.1f} MiB, {} walked, {:.0f} files/sec, {:.1f} MiB/sec".format(
+            self.watch_dir, " done" if final else "", self.stored, self.reused, self.bytes / 1024 ** 2, self.walked,
+            self.stored / elapsed, self.bytes / 1024 ** 2 / elapsed))
+
+    def run(self) -> bool:
+        """
+        Import the tree and commit it to the main branch.
+        :return: True if the initial commit was written, False otherwise.
+        """
+        self.started = time.time()
+        open(self.marker, "a").close()
+        if self.state.entries:
+            log("Resuming baseline of {}, {} files were stored already".format(self.watch_dir, len(self.state.entries)))
+
+        if not self._start_fast_import():
+            return False
+
+        self.outstanding = 1
+        self.directories.put(self.watch_dir)
+        threads = [threading.Thread(target=self._walk, name="baseline-walk-{}".format(i), daemon=True) for i in range(self.workers)]
+        threads += [threading.Thread(target=self._hash, name="baseline-hash-{}".format(i), daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        tree = []
+        # the stat index of the repo once the baseline is done, see reconcile.py
+        stats = {}
+        written = set()
+        pending = []
+        since_checkpoint = 0
+        bytes_since_checkpoint = 0
+        last_progress = time.time()
+        finished = 0
+        write = self.process.stdin.write
+
+        try:
+            while finished < self.workers:
+                blobs = self.blobs.get()
+                if blobs is None:
+                    finished += 1
+                    continue
+
+                for path, st, mode, digest, content in blobs:
+                    if content is _STREAM:
+                        digest = self._stream_blob(path, st)
+                        if digest is None:
+                            self.failed += 1
+                            continue
+
+                    tree.append((path, mode, digest))
+                    stats[path] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+                    if content is None:
+                        self.reused += 1
+                        continue
+
+                    if content is _STREAM:
+                        written.add(digest)
+                        bytes_since_checkpoint += st.st_size
+                        self.bytes += st.st_size
+                    # identical files are only sent once
+                    elif digest not in written:
+                        written.add(digest)
+                        write(b"blob\n" + _data(content))
+                        bytes_since_checkpoint += len(content)
+                        self.bytes += len(content)
+
+                    self.stored += 1
+                    since_checkpoint += 1
+                    pending.append((path, st, digest))
+
+                if since_checkpoint >= self.checkpoint_files or bytes_since_checkpoint >= self.checkpoint_bytes:
+                    self._checkpoint(pending)
+                    since_checkpoint = 0
+                    bytes_since_checkpoint = 0
+
+                if time.time() - last_progress >= self.progress_interval:
+                    self._progress()
+                    last_progress = time.time()
+
+            if not tree:
+                log("No files in {}".format(self.watch_dir), "WARNING")
+                self._close()
+                self._finish(stats)
+                return True
+
+            tree.sort()
+            stream = [
+                b"commit refs/heads/main\n",
+                "committer {} {} +0000\n".format(COMMITTER, int(time.time())).encode(),
+                _data("Initial commit\n\nBaseline of {} files\n".format(len(tree)).encode()),
+            ]
+            for path, mode, digest in tree:
+                stream.append(b"M " + mode + b" " + digest.hex().encode() + b" " + _quote_path(os.path.relpath(path, self.watch_dir)) + b"\n")
+            stream.append(b"\n")
+            write(b"".join(stream))
+            self._checkpoint(pending)
+        except (BrokenPipeError, OSError) as e:
+            log("Baseline of {} failed, it resumes on the next start: {}".format(self.watch_dir, e), "ERROR")
+            self._close()
+            return False
+
+        self._close()
+        self._progress(True)
+
+        # the commit moved the branch without touching the index, build it so `git status` works
+        console.run(["git", "-C", self.watch_dir, "reset", "-q"], timeout=0)
+        self._finish(stats)
+        return True
+
+    def _close(self):
+        if not self.process:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except OSError:
+            self.process.kill()
+        self.process = None
+
+    def _finish(self, stats:dict):
+        # the stored fingerprints are exactly the committed content, the repo can skip hashing them again
+        if self.repo.fingerprints:
+            with self.repo.fingerprints.lock:
+                self.repo.fingerprints.entries.update(self.state.entries)
+                self.repo.fingerprints.dirty = True
+            self.repo.fingerprints.save()
+
+        # the next start only has to look at the files that changed after their stat was taken
+        if self.repo.stat_index:
+            self.repo.stat_index.replace(stats)
+            self.repo.stat_index.save()
+
+        for file in (self.state.index_file, self.marker):
+            try:
+                os.unlink(file)
+            except OSError:
+                pass
+
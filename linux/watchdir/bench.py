@@ -0,0 +1,654 @@
+"""
+Benchmarks for watchdir.
+
+Run a single benchmark with:
+    python3 bench.py <name> [count]
+
+Each benchmark prints its results with util.log, nothing is written outside of a temporary directory.
+"""
+
+from collections import deque
+from util import log
+import audit_log
+import baseline
+import capabilities
+import config
+import console
+import datetime
+import event_source
+import git_utils
+import hashlib
+import history
+import largefiles
+import maintenance
+import logger
+import reconcile
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+def _cpu_time() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _write_files(directory:str, count:int):
+    for i in range(count):
+        with open(os.path.join(directory, "file_{}".format(i)), "w") as f:
+            f.write("x")
+
+
+class _CommandCounter:
+    """
+    Counts the commands run through console while it is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._start = 0
+
+    @staticmethod
+    def _total() -> int:
+        return sum(entry["count"] for entry in console.command_stats().values())
+
+    def __enter__(self):
+        self._start = self._total()
+        return self
+
+    def __exit__(self, *args):
+        self.count = self._total() - self._start
+
+
+def _temp_repo(files:int=0) -> str:
+    """
+    Point config and git_utils at a fresh watched directory and repo under a temporary directory.
+    :param files: The number of files to create before the repo is initialized
+    :return: The temporary directory, remove it when done
+    """
+    base = tempfile.mkdtemp(prefix="watchdir_bench_")
+    watch_dir = os.path.join(base, "watch")
+    os.makedirs(watch_dir)
+    _write_files(watch_dir, files)
+
+    config.BACKUP_DIR = os.path.join(base, "backup")
+    config.LOG_DIR = os.path.join(base, "log")
+    os.environ["LOG_FILE"] = os.path.join(config.LOG_DIR, "watchdir.log")
+    os.environ["ACCESS_LOG_FILE"] = os.path.join(config.LOG_DIR, "watchdir.access.log")
+    os.environ["GIT_LOG_FILE"] = os.path.join(config.LOG_DIR, "watchdir.git.log")
+    # init_repo sets the git identity globally, keep it out of the real home directory
+    os.environ["HOME"] = base
+
+    config.init(watch_dir)
+    git_utils.init()
+    git_utils.init_repo()
+    return base
+
+
+def _commit_count() -> int:
+    # commits streamed into fast-import only show up on the branch after a checkpoint
+    writer = git_utils.repos[0].writer if git_utils.repos else None
+    if writer:
+        writer.checkpoint()
+    return int(os.popen("git -C {} rev-list --count main 2>/dev/null".format(config.WATCH_DIR)).read().strip() or 0)
+
+
+def bench_commit_batching(count:int=500):
+    """
+    Compare forks, commit objects and wall time for a burst of changes with and without commit batching.
+    :param count: The number of files changed in the burst
+    """
+    for window in (0, 1):
+        base = _temp_repo()
+        try:
+            config.COMMIT_BATCH_WINDOW = window
+            commits_before = _commit_count()
+
+            start = time.time()
+            with _CommandCounter() as counter:
+                for i in range(count):
+                    file = os.path.join(config.WATCH_DIR, "file_{}".format(i))
+                    with open(file, "w") as f:
+                        f.write(str(i))
+                    git_utils.commit("CLOSE_WRITE,CLOSE", file)
+                git_utils.flush_commits()
+            elapsed = time.time() - start
+
+            log("window={:<4} {:>6} changes {:>6} commands {:>6} commits {:>8.2f}s {:>8.0f} changes/sec".format(
+                window, count, counter.count, _commit_count() - commits_before, elapsed, count / elapsed))
+        finally:
+            git_utils.close()
+            shutil.rmtree(base, ignore_errors=True)
+
+
+def bench_git_writer(count:int=500):
+    """
+    Compare commits/sec of the git CLI and the long lived fast-import writer, one commit per change.
+    :param count: The number of commits
+    """
+    for git_writer in ("cli", "fast-import"):
+        config.GIT_WRITER = git_writer
+        base = _temp_repo()
+        try:
+            config.COMMIT_BATCH_WINDOW = 0
+            commits_before = _commit_count()
+
+            start = time.time()
+            with _CommandCounter() as counter:
+                for i in range(count):
+                    file = os.path.join(config.WATCH_DIR, "file_{}".format(i))
+                    with open(file, "w") as f:
+                        f.write(str(i))
+                    git_utils.commit("CLOSE_WRITE,CLOSE", file)
+                git_utils.close()
+            elapsed = time.time() - start
+
+            log("{:<12} {:>6} commits {:>6} commands {:>8.2f}s {:>8.0f} commits/sec".format(
+                git_writer, _commit_count() - commits_before, counter.count, elapsed, count / elapsed))
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+class _LegacyLogger:
+    """
+    The Logger as it was before the single flusher rewrite, kept for comparison.
+    A timer is cancelled and created on every call, messages are md5 hashed and the file is opened for every line.
+    """
+
+    def __init__(self, debounce_time=2, log_to_console=False, log_file=None):
+        self.debounce_time = debounce_time
+        self.log_cache = {}
+        self.queue = deque()
+        self.log_file = log_file
+        self.log_to_console = log_to_console
+        self.timer = None
+
+    def log(self, message, level="INFO"):
+        log_hash = hashlib.md5("{}{}".format(message, level).encode()).hexdigest()
+        current_time = time.time()
+
+        if log_hash in self.log_cache:
+            self.log_cache[log_hash]['count'] += 1
+            self.log_cache[log_hash]['last_seen'] = current_time
+        else:
+            self.log_cache[log_hash] = {'message': message, 'level': level, 'count': 1, 'last_seen': current_time}
+            self.queue.append(log_hash)
+
+        if self.timer:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.debounce_time, self._clean_cache)
+        self.timer.start()
+        self._clean_cache()
+
+    def _clean_cache(self, force=False):
+        current_time = time.time()
+        while self.queue:
+            log_hash = self.queue[0]
+            log = self.log_cache[log_hash]
+            if not force and current_time - log['last_seen'] < self.debounce_time:
+                break
+
+            self.queue.popleft()
+            log_time = datetime.datetime.fromtimestamp(log['last_seen']).strftime('%m-%d %I:%M:%S')
+            with open(self.log_file, 'a') as f:
+                f.write("[{}] [{}] [{}] {}\n".format(log_time, log['count'], log['level'], log['message']))
+            del self.log_cache[log_hash]
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+        self._clean_cache(True)
+
+
+def bench_logger(count:int=50000):
+    """
+    Compare messages/sec and allocations of the Logger with the old timer per call implementation.
+    Half of the messages repeat, the other half are unique, with a short debounce window so both
+    the merging and the writing paths are exercised.
+    :param count: The number of messages logged
+    """
+    directory = tempfile.mkdtemp(prefix="watchdir_bench_")
+    try:
+        for name, cls in (("legacy", _LegacyLogger), ("current", logger.Logger)):
+            log_file = os.path.join(directory, "{}.log".format(name))
+            instance = cls(0.1, log_file=log_file)
+
+            tracemalloc.start()
+            start = time.time()
+            for i in range(count):
+                instance.log("MODIFY - /etc/file_{}".format(i if i % 2 else 0))
+            instance.close()
+            elapsed = time.time() - start
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            log("{:<8} {:>8} messages {:>10.0f} messages/sec peak {:>8.1f} KiB retained {:>8.1f} KiB".format(
+                name, count, count / elapsed, peak / 1024, retained / 1024))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_log_rotation(count:int=500000):
+    """
+    Compare messages/sec of a Logger that never rotates with one rotating every 4 MiB and compressing the
+    segments in the background, then read every line back across the segments.
+    :param count: The number of messages logged, all unique
+    """
+    directory = tempfile.mkdtemp(prefix="watchdir_bench_")
+    try:
+        for name, options in (("plain", {}), ("rotating", {"max_bytes": 4 * 1024 * 1024, "backups": 0, "compress": True})):
+            log_file = os.path.join(directory, "{}.access.log".format(name))
+            instance = logger.Logger(0.1, log_file=log_file, **options)
+
+            start = time.time()
+            for i in range(count):
+                instance.log("File /etc/dir_{}/file_{} was accessed".format(i % 100, i))
+            instance.close()
+            elapsed = time.time() - start
+            logger.compressor.wait()
+            compressed = time.time() - start
+
+            size = sum(os.path.getsize(segment) for segment in logger.segments(log_file) + [log_file])
+            start = time.time()
+            lines = sum(1 for _ in logger.read_lines(log_file))
+            log("{:<8} {:>8} messages {:>10.0f} messages/sec, {:.2f}s until compressed, {} segments {:.1f} MiB, read {} lines in {:.2f}s".format(
+                name, count, count / elapsed, compressed, len(logger.segments(log_file)), size / 1024 ** 2, lines, time.time() - start))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_event_sources(count:int=20000):
+    """
+    Compare events/sec and CPU time per event of the event source backends.
+    :param count: The number of files to write, each one produces CREATE, MODIFY and CLOSE_WRITE
+    """
+    backends = [event_source.InotifywaitBackend.name]
+    if event_source.native_available():
+        backends.insert(0, event_source.InotifyBackend.name)
+
+    for backend in backends:
+        directory = tempfile.mkdtemp(prefix="watchdir_bench_")
+        try:
+            source = event_source.get_event_source(directory, backend)
+            try:
+                source.open()
+            except OSError as e:
+                log("Skipping {} backend: {}".format(backend, e), "WARNING")
+                continue
+
+            # give inotifywait time to set up its watches
+            time.sleep(0.5)
+
+            received = [0, 0]
+            done = threading.Event()
+
+            def consume():
+                while not done.is_set():
+                    for event in source.read_events(0.5):
+                        received[0] += 1
+                        if "CLOSE_WRITE" in event.event:
+                            received[1] += 1
+                            if received[1] >= count:
+                                done.set()
+
+            reader = threading.Thread(target=consume, daemon=True)
+            cpu_start = _cpu_time()
+            start = time.time()
+            reader.start()
+
+            _write_files(directory, count)
+            done.wait(60)
+            elapsed = time.time() - start
+
+            done.set()
+            reader.join()
+            source.close()
+            cpu = _cpu_time() - cpu_start
+
+            events = max(received[0], 1)
+            log("{:<12} {:>8} events {:>10.0f} events/sec {:>8.2f} us CPU/event overflows={}".format(
+                backend, received[0], received[0] / elapsed, cpu / events * 1e6, source.overflows))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_audit_tail(count:int=200000):
+    """
+    Lines/sec and memory of the audit log tailer on a busy log.
+    One record group in ten has our key, the rest belong to other rules, and every group touches a different path
+    so the path index runs into its limit.
+    :param count: The number of record groups written to the log
+    """
+    directory = tempfile.mkdtemp(prefix="watchdir_bench_")
+    try:
+        log_file = os.path.join(directory, "audit.log")
+        open(log_file, "w").close()
+        tail = audit_log.AuditTail(config.AUDITDKEY, log_file, max_paths=10000)
+        tail.open()
+
+        now = time.time()
+        with open(log_file, "w") as f:
+            for serial in range(count):
+                key = config.AUDITDKEY if serial % 10 == 0 else "other-rule"
+                header = "msg=audit({:.3f}:{})".format(now, serial)
+                f.write('type=SYSCALL {}: arch=c000003e syscall=257 success=yes exit=3 pid={} auid=1000 uid=0 comm="vim" exe="/usr/bin/vim" key="{}"\n'.format(header, serial, key))
+                f.write('type=CWD {}: cwd="/root"\n'.format(header))
+                f.write('type=PATH {}: item=0 name="/etc/file_{}" inode={} nametype=NORMAL\n'.format(header, serial, serial))
+                f.write('type=PROCTITLE {}: proctitle=76696D\n'.format(header))
+                f.write('type=EOE {}: \n'.format(header))
+
+        tracemalloc.start()
+        start = time.time()
+        lines = tail.poll()
+        elapsed = time.time() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        found = sum(1 for serial in range(count - 1000, count, 10) if tail.lookup("/etc/file_{}".format(serial), now))
+        stats = tail.stats()
+        tail.close()
+
+        log("{:>8} lines {:>10.0f} lines/sec {:>6} groups matched {:>6} paths indexed peak {:>8.1f} KiB retained {:>8.1f} KiB, {}/100 recent paths found with {} polls".format(
+            lines, lines / elapsed, stats["matched"], stats["paths"], peak / 1024, retained / 1024, found, stats["polls"]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_capabilities(count:int=10):
+    """
+    Compare probing the tools with a `which` fork per tool against the capabilities module, cold and cached.
+    :param count: The number of times each probe runs
+    """
+    directory = tempfile.mkdtemp(prefix="watchdir_bench_")
+    config.BACKUP_DIR = directory
+    try:
+        probes = (
+            ("which", lambda: [console.run(["which", name]).returncode == 0 for name in capabilities.TOOLS]),
+            ("cold", lambda: capabilities.probe(force=True)),
+            ("cached", lambda: (capabilities.invalidate(), capabilities.probe())),
+        )
+        for name, probe in probes:
+            start = time.time()
+            for _ in range(count):
+                probe()
+            elapsed = time.time() - start
+            log("{:<8} {:>4} tools {:>10.2f} ms/probe".format(name, len(capabilities.TOOLS), elapsed / count * 1000))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_baseline(count:int=20000, size:int=1):
+    """
+    Compare the initial commit with `git add .` and `git commit` against the parallel baseline import.
+    :param count: The number of files in the watched directory, spread over directories of 100 files
+    :param size: The size of each file in bytes, random so every file is stored
+    """
+    for name in ("git add", "baseline"):
+        base = _temp_repo()
+        try:
+            for i in range(0, count, 100):
+                directory = os.path.join(config.WATCH_DIR, "dir_{}".format(i // 100))
+                os.makedirs(directory)
+                for j in range(min(100, count - i)):
+                    with open(os.path.join(directory, "file_{}".format(j)), "wb") as f:
+                        f.write(os.urandom(size))
+            repo = git_utils.repos[0]
+            os.unlink(os.path.join(config.WATCH_DIR, ".git"))
+            shutil.rmtree(repo.repo_dir)
+
+            start = time.time()
+            if name == "git add":
+                repo.init_repo()
+            else:
+                repo.init_repo(import_files=False)
+                baseline.Baseline(repo, workers=config.BASELINE_WORKERS or 1, progress_interval=float("inf")).run()
+            elapsed = time.time() - start
+
+            files = int(os.popen("git -C {} ls-files | wc -l".format(config.WATCH_DIR)).read().strip() or 0)
+            log("{:<8} {:>7} files {:>8.2f}s {:>8.0f} files/sec {:>8.1f} MiB/sec".format(
+                name, files, elapsed, files / elapsed, files * size / 1024 ** 2 / elapsed))
+        finally:
+            git_utils.close()
+            shutil.rmtree(base, ignore_errors=True)
+
+
+def _dir_size(*directories) -> int:
+    size = 0
+    for directory in directories:
+        for parent, _, files in os.walk(directory):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(parent, name)).st_size
+                except OSError:
+                    pass
+    return size
+
+
+def bench_large_files(count:int=10, size:int=32):
+    """
+    Compare repo growth and commit latency of a large file stored in full, as metadata only and chunked,
+    when it grows by appends (a log) and when a few bytes of it are rewritten in place (a database).
+    :param count: The number of changes committed
+    :param size: The size of the file in MiB
+    """
+    mode_before, size_before = config.LARGE_FILE_MODE, config.LARGE_FILE_SIZE
+    try:
+        for workload in ("append", "edit"):
+            for mode in largefiles.MODES:
+                config.LARGE_FILE_MODE = mode
+                config.LARGE_FILE_SIZE = 1
+                base = _temp_repo()
+                try:
+                    repo = git_utils.repos[0]
+                    path = os.path.join(config.WATCH_DIR, "large.bin")
+                    with open(path, "wb") as f:
+                        f.write(os.urandom(size * 1024 * 1024))
+                    repo._commit_files("initial", [path])
+                    _commit_count()
+                    initial = _dir_size(repo.repo_dir, os.path.join(config.BACKUP_DIR, repo.git_dir_basename, "chunks"))
+
+                    elapsed = 0
+                    for i in range(count):
+                        if workload == "append":
+                            with open(path, "ab") as f:
+                                f.write(os.urandom(64 * 1024))
+                        else:
+                            with open(path, "r+b") as f:
+                                f.seek(i * 997 * 1024 % (size * 1024 * 1024))
+                                f.write(os.urandom(4096))
+
+                        start = time.time()
+                        repo._commit_files("change {}".format(i), [path])
+                        # the pack is only written at the checkpoint
+                        _commit_count()
+                        elapsed += time.time() - start
+
+                    growth = _dir_size(repo.repo_dir, os.path.join(config.BACKUP_DIR, repo.git_dir_basename, "chunks")) - initial
+                    log("{:<7} {:<8} {:>4} commits {:>9.1f} ms/commit {:>9.2f} MiB growth".format(
+                        workload, mode, count, elapsed / count * 1000, growth / 1024 ** 2))
+                finally:
+                    git_utils.close()
+                    shutil.rmtree(base, ignore_errors=True)
+    finally:
+        config.LARGE_FILE_MODE, config.LARGE_FILE_SIZE = mode_before, size_before
+
+
+def bench_history(count:int=100000):
+    """
+    Compare changes/sec recorded in the history database with a transaction per change and with the
+    batched History writer, and the time of the queries of the history subcommand on the result.
+    :param count: The number of changes recorded
+    """
+    directory = tempfile.mkdtemp(prefix="watchdir_bench_")
+    try:
+        paths = ["/etc/dir_{}/file_{}".format(i % 100, i % 5000) for i in range(count)]
+
+        connection = history.connect(os.path.join(directory, "single.db"))
+        single = min(count, 5000)
+        start = time.time()
+        for path in paths[:single]:
+            with connection:
+                connection.execute("INSERT INTO events (time, root, path, event) VALUES (?, ?, ?, ?)", (time.time(), "/etc", path, "MODIFIED"))
+        elapsed = time.time() - start
+        connection.close()
+        log("{:<8} {:>8} changes {:>10.0f} changes/sec".format("single", single, single / elapsed))
+
+        db_file = os.path.join(directory, "batched.db")
+        recorder = history.History(db_file, max_queue=count + 1)
+        recorder.start()
+        start = time.time()
+        recording = start
+        for path in paths:
+            recorder.record("/etc", "MODIFIED", path, process={"pid": "1", "uid": "0", "exe": "/usr/bin/vi"})
+        queued = time.time() - start
+        recorder.close()
+        elapsed = time.time() - start
+        stats = recorder.stats()
+        log("{:<8} {:>8} changes {:>10.0f} changes/sec, {:.0f} changes/sec queued, {} batches avg {:.2f}ms, {} dropped".format(
+            "batched", count, count / elapsed, count / queued, stats["batches"], stats["avg_batch_ms"], stats["dropped"]))
+
+        connection = history.connect(db_file)
+        for name, query in (("timeline", lambda: list(history.timeline(connection, paths[0]))),
+                            ("timeline dir", lambda: list(history.timeline(connection, "/etc/dir_7"))),
+                            ("churn", lambda: history.churn(connection, 20)),
+                            ("export 1%", lambda: list(history.export(connection, recording + queued * 0.99)))):
+            start = time.time()
+            rows = len(query())
+            log("{:<12} {:>8} rows {:>9.2f} ms".format(name, rows, (time.time() - start) * 1000))
+        connection.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _time_git(*args) -> float:
+    start = time.time()
+    console.run(["git", "--git-dir", git_utils.repos[0].repo_dir] + list(args), timeout=0)
+    return time.time() - start
+
+
+def bench_maintenance(count:int=1000):
+    """
+    Compare object counts, disk usage and the time of object heavy git commands before and after repacking a repo
+    that piled up loose objects (cli writer) or a pack per checkpoint (fast-import writer).
+    :param count: The number of commits, each one checkpointed
+    """
+    for git_writer, kind in (("cli", maintenance.INCREMENTAL), ("cli", maintenance.FULL), ("fast-import", maintenance.FULL)):
+        config.GIT_WRITER = git_writer
+        base = _temp_repo(100)
+        try:
+            config.COMMIT_BATCH_WINDOW = 0
+            repo = git_utils.repos[0]
+            for i in range(count):
+                file = os.path.join(config.WATCH_DIR, "file_{}".format(i % 100))
+                with open(file, "a") as f:
+                    f.write("change {}\n".format(i))
+                git_utils.commit("CLOSE_WRITE,CLOSE", file)
+                if repo.writer:
+                    repo.writer.checkpoint()
+
+            for state in ("before", "after"):
+                if state == "after":
+                    start = time.time()
+                    repo.maintain(kind)
+                    log("{:<12} {:<12} repacked in {:.2f}s".format(git_writer, kind, time.time() - start))
+                counts = maintenance.count_objects(repo.repo_dir)
+                objects = _time_git("rev-list", "--objects", "--all")
+                history = _time_git("log", "-p", "-n", "500")
+                log("{:<12} {:<12} {:<6} {:>7} loose {:>5} packs {:>8.1f} MiB rev-list --objects {:>7.3f}s log -p {:>7.3f}s".format(
+                    git_writer, kind, state, counts["loose"], counts["packs"], maintenance.disk_usage(counts) / 1024 ** 2, objects, history))
+
+            # the writer is started again by the next commit
+            with open(os.path.join(config.WATCH_DIR, "file_0"), "a") as f:
+                f.write("after repack\n")
+            git_utils.commit("CLOSE_WRITE,CLOSE", os.path.join(config.WATCH_DIR, "file_0"))
+            git_utils.close()
+            log("{:<12} {:<12} {} commits".format(git_writer, kind, _commit_count()))
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+def bench_reconcile(count:int=100000, changes:int=100):
+    """
+    Compare finding the changes made while watchdir was not running with `git status` and with the stat index
+    scan of reconcile.py, then commit them.
+    :param count: The number of files in the watched directory, spread over directories of 100 files
+    :param changes: Files modified, added, deleted and touched each while nothing watches the directory
+    """
+    base = _temp_repo()
+    try:
+        for i in range(0, count, 100):
+            directory = os.path.join(config.WATCH_DIR, "dir_{}".format(i // 100))
+            os.makedirs(directory)
+            for j in range(min(100, count - i)):
+                with open(os.path.join(directory, "file_{}".format(j)), "w") as f:
+                    f.write("{} {}\n".format(i, j))
+        repo = git_utils.repos[0]
+        os.unlink(os.path.join(config.WATCH_DIR, ".git"))
+        shutil.rmtree(repo.repo_dir)
+        repo.init_repo(import_files=False)
+        baseline.Baseline(repo, workers=config.BASELINE_WORKERS or 1, progress_interval=float("inf")).run()
+        git_utils.close()
+
+        step = max(1, count // changes)
+        for n, i in enumerate(range(0, count, step)):
+            file = os.path.join(config.WATCH_DIR, "dir_{}".format(i // 100), "file_{}".format(i % 100))
+            if n % 4 == 0:
+                with open(file, "a") as f:
+                    f.write("offline change\n")
+            elif n % 4 == 1:
+                with open(file + ".new", "w") as f:
+                    f.write("new\n")
+            elif n % 4 == 2:
+                os.unlink(file)
+            else:
+                os.utime(file, None)
+
+        # git status on a cold index, as after a restart
+        os.unlink(os.path.join(git_utils.Repo(config.ROOTS[0]).repo_dir, "index"))
+        console.run(["git", "-C", config.WATCH_DIR, "reset", "-q"], timeout=0)
+        start = time.time()
+        files = git_utils.Repo(config.ROOTS[0])._changed_files(config.WATCH_DIR)
+        log("{:<10} {:>7} files {:>8.2f}s {:>5} changed".format("git status", count, time.time() - start, len(files)))
+        git_utils.close()
+
+        git_utils.init()
+        repo = git_utils.repos[0]
+        start = time.time()
+        reconcile.reconcile(repo, workers=config.RECONCILE_WORKERS or 1)
+        elapsed = time.time() - start
+        git_utils.close()
+        log("{:<10} {:>7} files {:>8.2f}s, {} commits, clean: {}".format(
+            "reconcile", count, elapsed, _commit_count(),
+            not os.popen("git -C {} status --porcelain".format(config.WATCH_DIR)).read().strip()))
+    finally:
+        git_utils.close()
+        shutil.rmtree(base, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "event_sources": bench_event_sources,
+    "commit_batching": bench_commit_batching,
+    "git_writer": bench_git_writer,
+    "logger": bench_logger,
+    "log_rotation": bench_log_rotation,
+    "audit_tail": bench_audit_tail,
+    "capabilities": bench_capabilities,
+    "baseline": bench_baseline,
+    "large_files": bench_large_files,
+    "history": bench_history,
+    "maintenance": bench_maintenance,
+    "reconcile": bench_reconcile,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: bench.py <{}> [count]".format("|".join(BENCHMARKS)))
+        sys.exit(1)
+
+    args = [int(arg) for arg in sys.argv[2:]]
+    BENCHMARKS[sys.argv[1]](*args)
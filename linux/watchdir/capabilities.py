@@ -0,0 +1,230 @@
+"""
+Capability detection for watchdir.
+
+Finds the tools watchdir needs (git, inotifywait, auditctl, ...), the package manager and the service
+manager in a single pass over PATH, listing every directory once instead of forking `which` per tool.
+The result is cached in the backup directory and reused on the next start as long as PATH is the same
+and none of its directories changed (installing a package changes the mtime of its bin directory).
+
+console, sysctl and auditctl all ask this module, so each tool is only looked up once per process.
+"""
+
+from util import log
+import config
+import json
+import os
+import threading
+import time
+
+
+# Package managers in order of preference, with the command installing a package
+PACKAGE_MANAGERS = [
+    ("apt", "apt install {} -y"),
+    ("apt-get", "apt-get install {} -y"),
+    ("yum", "yum install {} -y"),
+    ("dnf", "dnf install {} -y"),
+    ("zypper", "zypper install {} -y"),
+    ("pacman", "pacman -S --noconfirm {}"),
+    ("apk", "apk add {}"),
+    ("emerge", "emerge install {} -y"),
+]
+
+# Service managers in order of preference, with the command restarting a service
+SERVICE_MANAGERS = [
+    ("systemctl", "systemctl restart {}"),
+    ("service", "service {} restart"),
+    ("initctl", "initctl restart {}"),
+    ("rc-service", "rc-service {} restart"),
+    ("sv", "sv restart {}"),
+    ("openrc-service", "openrc-service {} restart"),
+    ("launchctl", "launchctl stop {} && launchctl start {}"),
+    ("rcctl", "rcctl restart {}"),
+    ("s6-svc", "s6-svc -r /run/s6/services/{}"),
+    ("supervisorctl", "supervisorctl restart {}"),
+    ("runit", "sv restart {}"),
+    ("daemontools", "svc -t /service/{}"),
+    ("sysv-rc-conf", "sysv-rc-conf {} restart"),
+    ("update-rc.d", "update-rc.d {} defaults"),
+    ("chkconfig", "chkconfig {} on"),
+]
+
+# Tools resolved up front, anything else is resolved on first use and added to the cache
+TOOLS = ["git", "inotifywait", "auditctl", "ausearch", "ufw", "brew"] + \
+        [name for name, _ in PACKAGE_MANAGERS] + [name for name, _ in SERVICE_MANAGERS]
+
+CACHE_FILE = "capabilities.json"
+CACHE_VERSION = 1
+
+_lock = threading.Lock()
+# name -> absolute path or None, for the current PATH
+_tools = None
+# directory -> set of executable names in it, only built when the cache can't be used
+_listings = None
+_path = None
+_mtimes = None
+
+# time spent probing, for the startup log
+probe_time = 0.0
+
+
+def _path_dirs() -> list:
+    dirs = []
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        directory = directory or "."
+        if directory not in dirs:
+            dirs.append(directory)
+    return dirs
+
+
+def _dir_mtimes(dirs:list) -> dict:
+    mtimes = {}
+    for directory in dirs:
+        try:
+            mtimes[directory] = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtimes[directory] = None
+    return mtimes
+
+
+def _cache_file() -> str:
+    return os.path.join(config.BACKUP_DIR, CACHE_FILE)
+
+
+def _load_cache(path:str, mtimes:dict):
+    try:
+        with open(_cache_file()) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cache.get("version") != CACHE_VERSION or cache.get("path") != path or cache.get("mtimes") != mtimes:
+        return None
+    return cache.get("tools")
+
+
+def _save_cache():
+    if not os.path.isdir(config.BACKUP_DIR):
+        return
+
+    cache = {"version": CACHE_VERSION, "path": _path, "mtimes": _mtimes, "tools": _tools}
+    tmp = _cache_file() + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, _cache_file())
+    except OSError as e:
+        log("Failed to save capability cache: {}".format(e), "WARNING")
+
+
+def _listing(directory:str) -> set:
+    names = _listings.get(directory)
+    if names is None:
+        names = set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    names.add(entry.name)
+        except OSError:
+            pass
+        _listings[directory] = names
+    return names
+
+
+def _resolve(name:str):
+    # the first executable in PATH, like which
+    for directory in _path.split(os.pathsep) if _path else []:
+        directory = directory or "."
+        if name in _listing(directory):
+            candidate = os.path.join(directory, name)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return os.path.abspath(candidate)
+    return None
+
+
+def probe(force:bool=False) -> dict:
+    """
+    Resolve every tool in TOOLS, from the cache if it is still valid.
+    :param force: Ignore the cache and look at PATH again
+    :return: tool -> absolute path, None for tools that are not installed
+    """
+    global _tools, _listings, _path, _mtimes, probe_time
+
+    with _lock:
+        path = os.environ.get("PATH", os.defpath)
+        if _tools is not None and not force and path == _path:
+            return _tools
+
+        start = time.time()
+        dirs = _path_dirs()
+        mtimes = _dir_mtimes(dirs)
+
+        tools = None if force else _load_cache(path, mtimes)
+        _path = path
+        _mtimes = mtimes
+        _listings = {}
+
+        if tools is None:
+            tools = {}
+            _tools = tools
+            for name in TOOLS:
+                tools[name] = _resolve(name)
+            _save_cache()
+        else:
+            _tools = tools
+
+        probe_time += time.time() - start
+        return _tools
+
+
+def which(name:str):
+    """
+    Find a command in PATH without forking.
+    :param name: The command
+    :return: Its absolute path, or None if it is not installed
+    """
+    tools = probe()
+    if name in tools:
+        return tools[name]
+
+    with _lock:
+        tools[name] = _resolve(name)
+        _save_cache()
+        return tools[name]
+
+
+def has(name:str) -> bool:
+    """
+    :param name: The command
+    :return: True if the command is installed, False otherwise.
+    """
+    return which(name) is not None
+
+
+def package_manager():
+    """
+    :return: (name, install command) of the first package manager found, or None
+    """
+    for name, command in PACKAGE_MANAGERS:
+        if has(name):
+            return name, command
+    return None
+
+
+def service_manager():
+    """
+    :return: (name, restart command) of the first service manager found, or None
+    """
+    for name, command in SERVICE_MANAGERS:
+        if has(name):
+            return name, command
+    return None
+
+
+def invalidate():
+    """
+    Forget what was found, e.g. after a package was installed, the next lookup looks at PATH again.
+    """
+    global _tools
+
+    with _lock:
+        _tools = None
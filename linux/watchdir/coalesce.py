@@ -0,0 +1,208 @@
+"""
+Per path event coalescing.
+
+A single save or copy produces a burst of events for the same file (CREATE, MODIFY, ATTRIB, CLOSE_WRITE, ...).
+The Coalescer keeps the pending state of every path and collapses the burst into one logical change once
+the file has been quiet for a while or was closed after writing:
+
+- CREATED: the file did not exist before
+- MODIFIED: the content changed, also used when a temporary file is renamed over the file
+- METADATA: only the attributes changed (chmod, chown, touch)
+- DELETED: the file was deleted or moved out of the watched directory
+- RENAMED: the file was moved within the watched directory, old_path holds where it came from
+
+A file that is created and deleted again before it settles produces no change at all.
+"""
+
+from collections import OrderedDict
+from event_source import Event
+import threading
+import time
+
+
+CREATED = "CREATED"
+MODIFIED = "MODIFIED"
+METADATA = "METADATA"
+DELETED = "DELETED"
+RENAMED = "RENAMED"
+
+
+class _Pending:
+    __slots__ = ("created", "deleted", "content", "attrib", "closed", "old_path", "is_dir", "last_seen")
+
+    def __init__(self, now:float, is_dir:bool):
+        self.created = False
+        self.deleted = False
+        self.content = False
+        self.attrib = False
+        self.closed = False
+        self.old_path = None
+        self.is_dir = is_dir
+        self.last_seen = now
+
+    def change(self) -> str:
+        if self.deleted:
+            return DELETED
+        if self.old_path:
+            return RENAMED
+        if self.created:
+            return CREATED
+        if self.attrib and not self.content:
+            return METADATA
+        return MODIFIED
+
+
+class Coalescer:
+    """
+    Collapses the events of each path into one logical change.
+    """
+
+    def __init__(self, quiet_period:float=0.5, max_pending:int=10000):
+        """
+        :param quiet_period: Seconds without events before a path is considered settled
+        :param max_pending: The number of paths kept pending, the oldest one is emitted early when there are more
+        """
+        self.quiet_period = quiet_period
+        # closed files only wait a fraction of the quiet period, enough for a following rename in the same burst
+        self.close_grace = quiet_period / 10
+        self.max_pending = max_pending
+        # path -> _Pending, ordered by last_seen so ready stops at the first path that did not settle
+        self.pending = OrderedDict()
+        # cookie -> (old path, pending state) of MOVED_FROM events waiting for their MOVED_TO
+        self.moves = {}
+        self.lock = threading.Lock()
+        self.received = 0
+        self.emitted = 0
+        self.forced = 0
+
+    def _state(self, path:str, now:float, is_dir:bool) -> _Pending:
+        state = self.pending.get(path)
+        if state is None:
+            state = _Pending(now, is_dir)
+            self.pending[path] = state
+        else:
+            self.pending.move_to_end(path)
+        state.last_seen = now
+        return state
+
+    def feed(self, event:Event):
+        """
+        Add a raw event to the pending state of its path.
+        :param event: The event from the event source
+        """
+        now = time.time()
+        names = event.event
+        path = event.path
+        is_dir = "ISDIR" in names
+
+        with self.lock:
+            self.received += 1
+
+            if "MOVED_FROM" in names:
+                previous = self.pending.pop(path, None)
+                state = self._state(path, now, is_dir)
+                if previous:
+                    state.created = previous.created
+                    state.old_path = previous.old_path
+                # moved out of the directory unless a MOVED_TO with the same cookie follows
+                state.deleted = True
+                if len(self.moves) >= self.max_pending:
+                    self.moves.clear()
+                self.moves[event.cookie] = (path, previous)
+                return
+
+            if "MOVED_TO" in names:
+                move = self.moves.pop(event.cookie, None) if event.cookie else None
+                state = self._state(path, now, is_dir)
+                state.deleted = False
+                if move is None:
+                    # moved in from outside of the watched directory
+                    state.created = True
+                    return
+
+                old_path, previous = move
+                self.pending.pop(old_path, None)
+                if previous and previous.created and not previous.old_path:
+                    # a new temporary file renamed over this one, the usual way editors save
+                    state.content = True
+                else:
+                    state.old_path = previous.old_path if previous and previous.old_path else old_path
+                return
+
+            state = self._state(path, now, is_dir)
+
+            if "CREATE" in names:
+                if state.deleted:
+                    # deleted and created again, the file was replaced
+                    state.deleted = False
+                    state.content = True
+                else:
+                    state.created = True
+            elif "DELETE" in names:
+                if state.created and not state.old_path:
+                    # never settled, nothing to report
+                    del self.pending[path]
+                    return
+                state.deleted = True
+
+            if "MODIFY" in names:
+                state.content = True
+            if "ATTRIB" in names:
+                state.attrib = True
+            if "CLOSE_WRITE" in names:
+                state.closed = True
+
+    def ready(self, now:float=None) -> list:
+        """
+        Take the changes of the paths that settled.
+        :param now: The current time
+        :return: A list of Events whose event is one of the logical changes, with ",ISDIR" appended for directories
+        """
+        if now is None:
+            now = time.time()
+
+        quiet_cutoff = now - self.quiet_period
+        close_cutoff = now - self.close_grace
+        changes = []
+
+        with self.lock:
+            if not self.pending:
+                return changes
+
+            over = len(self.pending) - self.max_pending
+            settled = []
+            for path, state in self.pending.items():
+                if over > 0:
+                    over -= 1
+                    self.forced += 1
+                elif state.last_seen > close_cutoff:
+                    # every path after it was seen later, none of them settled either
+                    break
+                elif state.last_seen > quiet_cutoff and not state.closed:
+                    continue
+                settled.append((path, state))
+
+            for path, state in settled:
+                del self.pending[path]
+                change = state.change()
+                if state.is_dir:
+                    change += ",ISDIR"
+                changes.append(Event(change, path, 0, state.old_path if change.startswith(RENAMED) else None))
+
+            # moves whose MOVED_TO never came are already pending as deletions
+            if self.moves and not self.pending:
+                self.moves.clear()
+
+        self.emitted += len(changes)
+        return changes
+
+    def stats(self) -> dict:
+        """
+        :return: Pending paths, raw events received and logical changes emitted
+        """
+        return {
+            "pending": len(self.pending),
+            "received": self.received,
+            "emitted": self.emitted,
+            "forced": self.forced,
+        }
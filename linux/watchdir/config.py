@@ -1,5 +1,6 @@
 from util import exit_with_error, log
 from sys import argv
+import configparser
 import os
 import hashlib
 import shutil
@@ -15,31 +16,242 @@ LOG_DIR = os.getenv("LOG_DIR", "/var/log/watchdir")
 WATCH_DIR_LOG_FILE = None
 WATCH_ACCESS_LOG_FILE = None
 WATCH_GIT_LOG_FILE = None
+# Log files are rotated once they reach LOG_MAX_BYTES or LOG_MAX_AGE seconds, 0 disables either,
+# LOG_BACKUPS rotated segments of each are kept (0 keeps all), gzipped unless LOG_COMPRESS is False
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 64 * 1024 * 1024))
+LOG_MAX_AGE = float(os.getenv("LOG_MAX_AGE", 86400))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 14))
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "True") == "True"
 BACKUP_INTERVAL = 3600
+# Retention of backup snapshots: the newest BACKUP_KEEP_LAST, plus the newest of each of the last hours and days
+BACKUP_KEEP_LAST = int(os.getenv("BACKUP_KEEP_LAST", 6))
+BACKUP_KEEP_HOURLY = int(os.getenv("BACKUP_KEEP_HOURLY", 24))
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", 7))
+# Event source backend: auto, native or inotifywait
+EVENT_BACKEND = os.getenv("EVENT_BACKEND", "auto")
+# Events the pipeline queue holds before events are dropped and their directory is rescanned
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 10000))
+# Threads filtering, logging and committing events
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 1))
+# Seconds between pipeline statistics in the log
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", 60))
+# Seconds a file has to be quiet before its events are collapsed into one change, 0 disables coalescing
+COALESCE_QUIET = float(os.getenv("COALESCE_QUIET", 0.5))
+# Files waiting for their quiet period before the oldest one is handled early
+COALESCE_MAX_PENDING = int(os.getenv("COALESCE_MAX_PENDING", 10000))
+# gitignore style file with extra exclude rules, and rules given on the command line
+FILTER_FILE = os.getenv("FILTER_FILE")
+FILTER_EXCLUDES = []
+FILTER_INCLUDES = []
+# Changes seen within COMMIT_BATCH_WINDOW seconds are committed together, 0 commits every change on its own
+COMMIT_BATCH_WINDOW = float(os.getenv("COMMIT_BATCH_WINDOW", 2))
+# A batch is committed early once it holds this many files
+COMMIT_BATCH_SIZE = int(os.getenv("COMMIT_BATCH_SIZE", 500))
+# How commits are written: fast-import streams them into one long lived git process, cli runs git add/commit
+GIT_WRITER = os.getenv("GIT_WRITER", "fast-import")
+# Skip commits of files whose content did not change, using a persisted index of file fingerprints
+FINGERPRINT_INDEX = os.getenv("FINGERPRINT_INDEX", "True") == "True"
+# Seconds between updates of the branch ref when using fast-import
+GIT_CHECKPOINT_INTERVAL = float(os.getenv("GIT_CHECKPOINT_INTERVAL", 30))
+# Seconds between checks whether a repo needs repacking, see maintenance.py, 0 disables it
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", 60))
+# Loose objects that trigger an incremental repack, and packs that trigger a full one
+MAINTENANCE_LOOSE_OBJECTS = int(os.getenv("MAINTENANCE_LOOSE_OBJECTS", 5000))
+MAINTENANCE_PACKS = int(os.getenv("MAINTENANCE_PACKS", 50))
+# Seconds without a commit after which a repo is repacked as soon as there is anything to pack
+MAINTENANCE_IDLE = float(os.getenv("MAINTENANCE_IDLE", 300))
+# Files larger than LARGE_FILE_SIZE bytes are stored as LARGE_FILE_MODE: full, meta (size and hash only) or chunked
+# (deduplicated chunks next to the repo), 0 stores every file in full
+LARGE_FILE_SIZE = int(os.getenv("LARGE_FILE_SIZE", 16 * 1024 * 1024))
+LARGE_FILE_MODE = os.getenv("LARGE_FILE_MODE", "chunked")
+# gitignore style patterns of files always stored in full, as metadata only or chunked, whatever their size
+FULL_FILES = os.getenv("FULL_FILES", "").split()
+META_FILES = os.getenv("META_FILES", "").split()
+CHUNKED_FILES = os.getenv("CHUNKED_FILES", "").split()
+# Threads walking and hashing a new watched directory for its initial commit, 0 uses `git add .` instead
+BASELINE_WORKERS = int(os.getenv("BASELINE_WORKERS", min(8, os.cpu_count() or 1)))
+# Threads scanning and hashing a watched directory at start for the changes made while watchdir was not running,
+# 0 disables it, see reconcile.py
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", min(8, os.cpu_count() or 1)))
+# Seconds a command may run before it is killed, 0 waits forever
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", 300))
+# Prometheus textfile in LOG_DIR and unix socket serving the metrics, empty disables them
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "watchdir.prom")
+METRICS_SOCKET = os.getenv("METRICS_SOCKET", "")
+# Seconds between writes of the metrics textfile
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 15))
+# The auditd log followed to find the process behind each change, empty disables it
+AUDIT_LOG = os.getenv("AUDIT_LOG", "/var/log/audit/audit.log")
+# Seconds between an audit record and a change for the record to be attributed to it
+AUDIT_WINDOW = float(os.getenv("AUDIT_WINDOW", 5))
+# SQLite database in LOG_DIR recording every change, see history.py, empty disables it
+HISTORY_DB = os.getenv("HISTORY_DB", "history.db")
 
-def init(directory_to_watch):
-    global WATCH_DIR, BASE_DIR, BASE_NAME, LOG_DIR, WATCH_DIR_LOG_FILE, WATCH_ACCESS_LOG_FILE, WATCH_GIT_LOG_FILE, BACKUP_INTERVAL
+# Every watched directory, see Root
+ROOTS = []
 
-    if not directory_to_watch:
+
+class Root:
+    """
+    Settings of one watched directory: its log files and extra filter rules.
+    """
+
+    def __init__(self, directory:str, excludes:list=None, includes:list=None, filter_file:str=None):
+        self.watch_dir = os.path.abspath(os.path.expanduser(directory))
+        self.base_dir = os.path.basename(self.watch_dir)
+        # named after the whole path, /etc/app and /opt/app get their own repo and logs
+        self.base_name = self.base_dir + "_" + hashlib.md5(self.watch_dir.encode()).hexdigest()
+        # the name older versions used, only the basename was hashed, see migrate_root
+        self.legacy_name = self.base_dir + "_" + hashlib.md5(self.base_dir.encode()).hexdigest()
+        self.use_name(self.base_name)
+        self.excludes = excludes or []
+        self.includes = includes or []
+        self.filter_file = filter_file
+
+    def use_name(self, base_name:str):
+        """
+        Name the repo and the log files of the directory.
+        :param base_name: The name of its directory in BACKUP_DIR and the prefix of its log files
+        """
+        self.base_name = base_name
+        self.log_file = os.path.join(LOG_DIR, "{}.log".format(base_name))
+        self.access_log_file = os.path.join(LOG_DIR, "{}.access.log".format(base_name))
+        self.git_log_file = os.path.join(LOG_DIR, "{}.git.log".format(base_name))
+
+
+def log_rotation() -> dict:
+    """
+    :return: The rotation settings of the log files, as keyword arguments of logger.Logger
+    """
+    return {"max_bytes": LOG_MAX_BYTES, "max_age": LOG_MAX_AGE, "backups": LOG_BACKUPS, "compress": LOG_COMPRESS}
+
+
+# Options of the [watchdir] section of the config file, and how to parse them
+CONFIG_FILE_OPTIONS = {
+    "backend": ("EVENT_BACKEND", str),
+    "git_writer": ("GIT_WRITER", str),
+    "batch_window": ("COMMIT_BATCH_WINDOW", float),
+    "batch_size": ("COMMIT_BATCH_SIZE", int),
+    "queue_size": ("PIPELINE_QUEUE_SIZE", int),
+    "workers": ("PIPELINE_WORKERS", int),
+    "quiet_period": ("COALESCE_QUIET", float),
+    "max_pending": ("COALESCE_MAX_PENDING", int),
+    "filter_file": ("FILTER_FILE", str),
+    "audit_log": ("AUDIT_LOG", str),
+    "audit_window": ("AUDIT_WINDOW", float),
+    "command_timeout": ("COMMAND_TIMEOUT", float),
+    "baseline_workers": ("BASELINE_WORKERS", int),
+    "reconcile_workers": ("RECONCILE_WORKERS", int),
+    "large_file_size": ("LARGE_FILE_SIZE", int),
+    "large_file_mode": ("LARGE_FILE_MODE", str),
+    "full_files": ("FULL_FILES", str.split),
+    "meta_files": ("META_FILES", str.split),
+    "chunked_files": ("CHUNKED_FILES", str.split),
+    "metrics_textfile": ("METRICS_TEXTFILE", str),
+    "metrics_socket": ("METRICS_SOCKET", str),
+    "metrics_interval": ("METRICS_INTERVAL", float),
+    "history_db": ("HISTORY_DB", str),
+    "log_max_bytes": ("LOG_MAX_BYTES", int),
+    "log_max_age": ("LOG_MAX_AGE", float),
+    "log_backups": ("LOG_BACKUPS", int),
+    "maintenance_interval": ("MAINTENANCE_INTERVAL", float),
+    "maintenance_loose_objects": ("MAINTENANCE_LOOSE_OBJECTS", int),
+    "maintenance_packs": ("MAINTENANCE_PACKS", int),
+    "maintenance_idle": ("MAINTENANCE_IDLE", float),
+}
+
+
+def load_config_file(path:str) -> list:
+    """
+    Load an INI style config file.
+
+        [watchdir]
+        backend = native
+        batch_window = 2
+
+        [/etc]
+        exclude = *.bak
+                  cups/
+
+        [/var/www]
+
+    The [watchdir] section sets the global options, every other section is a directory to watch,
+    with optional exclude/include patterns (one per line) and filter_file.
+    :param path: The config file
+    :return: A list of Root settings for the directories in the file
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    if not parser.read(path):
+        exit_with_error("Config file does not exist: {}".format(path))
+
+    roots = []
+    for section in parser.sections():
+        options = parser[section]
+
+        if section == "watchdir":
+            for key, value in options.items():
+                if key not in CONFIG_FILE_OPTIONS:
+                    exit_with_error("Unknown option in {}: {}".format(path, key))
+                name, parse = CONFIG_FILE_OPTIONS[key]
+                globals()[name] = parse(value)
+            continue
+
+        roots.append(Root(section,
+                          excludes=options.get("exclude", "").split(),
+                          includes=options.get("include", "").split(),
+                          filter_file=options.get("filter_file")))
+
+    return roots
+
+
+def init(directories_to_watch, roots:list=None):
+    """
+    Set up the watched directories.
+    :param directories_to_watch: A directory or a list of directories to watch
+    :param roots: Root settings, from a config file, watched as well
+    """
+    global WATCH_DIR, BASE_DIR, BASE_NAME, LOG_DIR, WATCH_DIR_LOG_FILE, WATCH_ACCESS_LOG_FILE, WATCH_GIT_LOG_FILE, BACKUP_INTERVAL, ROOTS
+
+    if isinstance(directories_to_watch, str):
+        directories_to_watch = [directories_to_watch]
+
+    ROOTS = list(roots or []) + [Root(directory) for directory in directories_to_watch or []]
+
+    if not ROOTS:
         exit_with_error("Please provide a directory to watch")
 
-    WATCH_DIR = os.path.abspath(directory_to_watch)
-    
-    # Check if directory exists
-    if WATCH_DIR.startswith("~"):
-        WATCH_DIR = os.path.expanduser(WATCH_DIR)
-    elif WATCH_DIR.startswith("."):
-        WATCH_DIR = os.path.abspath(WATCH_DIR)
-    
-    if not os.path.isdir(WATCH_DIR):
-        exit_with_error("Directory does not exist: {}".format(WATCH_DIR))
-
-    BASE_DIR = os.path.basename(WATCH_DIR)
-    BASE_NAME = BASE_DIR + "_" + hashlib.md5(BASE_DIR.encode()).hexdigest()
-    
-    WATCH_DIR_LOG_FILE = os.getenv("LOG_FILE", "/var/log/watchdir/{}.log".format(BASE_NAME))
-    WATCH_ACCESS_LOG_FILE = os.getenv("ACCESS_LOG_FILE", "/var/log/watchdir/{}.access.log".format(BASE_NAME))
-    WATCH_GIT_LOG_FILE = os.getenv("GIT_LOG_FILE", "/var/log/watchdir/{}.git.log".format(BASE_NAME))
+    seen = set()
+    for root in ROOTS:
+        # Check if directory exists
+        if not os.path.isdir(root.watch_dir):
+            exit_with_error("Directory does not exist: {}".format(root.watch_dir))
+
+        if root.watch_dir in seen:
+            exit_with_error("Directory given twice: {}".format(root.watch_dir))
+        seen.add(root.watch_dir)
+
+    # every event belongs to exactly one root, so roots can't be nested
+    for root in ROOTS:
+        for other in ROOTS:
+            if other is not root and root.watch_dir.startswith(other.watch_dir.rstrip("/") + "/"):
+                exit_with_error("{} is inside {}, watch one or the other".format(root.watch_dir, other.watch_dir))
+
+    for root in ROOTS:
+        migrate_root(root)
+
+    # the environment overrides only make sense for a single directory
+    if len(ROOTS) == 1:
+        ROOTS[0].log_file = os.getenv("LOG_FILE", ROOTS[0].log_file)
+        ROOTS[0].access_log_file = os.getenv("ACCESS_LOG_FILE", ROOTS[0].access_log_file)
+        ROOTS[0].git_log_file = os.getenv("GIT_LOG_FILE", ROOTS[0].git_log_file)
+
+    # the first directory, for tools that only handle one
+    WATCH_DIR = ROOTS[0].watch_dir
+    BASE_DIR = ROOTS[0].base_dir
+    BASE_NAME = ROOTS[0].base_name
+    WATCH_DIR_LOG_FILE = ROOTS[0].log_file
+    WATCH_ACCESS_LOG_FILE = ROOTS[0].access_log_file
+    WATCH_GIT_LOG_FILE = ROOTS[0].git_log_file
 
     if os.getuid() != 0:
         exit_with_error("Please run this script as sudo")
@@ -55,18 +267,90 @@ def init(directory_to_watch):
     else:
         BACKUP_INTERVAL = 3600
 
+def migrate_root(root:Root):
+    """
+    Rename the repo and logs of a directory watched by an older version, which named them after the basename
+    of the directory only, to the name used now. Nothing is done once the new name exists.
+    :param root: The watched directory
+    """
+    old_dir = os.path.join(BACKUP_DIR, root.legacy_name)
+    new_dir = os.path.join(BACKUP_DIR, root.base_name)
+    if os.getuid() != 0 or root.legacy_name == root.base_name or not os.path.isdir(old_dir) or os.path.exists(new_dir):
+        return
+
+    # directories with the same basename share the old name, it belongs to the one whose .git file points into it
+    git_file = os.path.join(root.watch_dir, ".git")
+    try:
+        with open(git_file) as f:
+            git_dir = f.read().strip()
+    except OSError:
+        return
+    old_repo = os.path.join(old_dir, "current.git")
+    if not git_dir.startswith("gitdir: ") or os.path.realpath(git_dir[len("gitdir: "):]) != os.path.realpath(old_repo):
+        return
+
+    log("Moving the repo of {} from {} to {}".format(root.watch_dir, old_dir, new_dir))
+    try:
+        os.rename(old_dir, new_dir)
+    except OSError as e:
+        log("Failed to move {}: {}, keeping the old name".format(old_dir, e), "ERROR")
+        root.use_name(root.legacy_name)
+        return
+
+    tmp = git_file + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write("gitdir: {}\n".format(os.path.join(new_dir, "current.git")))
+        os.replace(tmp, git_file)
+    except OSError as e:
+        log("Failed to update {}: {}, keeping the old name".format(git_file, e), "ERROR")
+        os.rename(new_dir, old_dir)
+        root.use_name(root.legacy_name)
+        return
+
+    # the log files and their rotated segments
+    if os.path.isdir(LOG_DIR):
+        for name in os.listdir(LOG_DIR):
+            if name.startswith(root.legacy_name + "."):
+                new_name = root.base_name + name[len(root.legacy_name):]
+                if not os.path.exists(os.path.join(LOG_DIR, new_name)):
+                    os.rename(os.path.join(LOG_DIR, name), os.path.join(LOG_DIR, new_name))
+
+
 def print_config():
 
 
-    log("WATCH_DIR: {}".format(WATCH_DIR))
+    for root in ROOTS:
+        log("WATCH_DIR: {}".format(root.watch_dir))
+        log("    LOG_FILE: {}".format(root.log_file))
+        log("    ACCESS_LOG_FILE: {}".format(root.access_log_file))
+        log("    GIT_LOG_FILE: {}".format(root.git_log_file))
     log("AUDITDKEY: {}".format(AUDITDKEY))
     log("LOG_DIR: {}".format(LOG_DIR))
-    log("WATCH_DIR_LOG_FILE: {}".format(WATCH_DIR_LOG_FILE))
-    log("WATCH_ACCESS_LOG_FILE: {}".format(WATCH_ACCESS_LOG_FILE))
-    log("WATCH_GIT_LOG_FILE: {}".format(WATCH_GIT_LOG_FILE))
+    log("LOG_ROTATION: {} bytes, {}s, {} kept, compressed {}".format(LOG_MAX_BYTES, LOG_MAX_AGE, LOG_BACKUPS, LOG_COMPRESS))
     log("DEBUG: {}".format(DEBUG))
     log("BACKUP_DIR: {}".format(BACKUP_DIR))
     log("BACKUP_INTERVAL: {}".format(BACKUP_INTERVAL))
+    log("BACKUP_KEEP: last {}, hourly {}, daily {}".format(BACKUP_KEEP_LAST, BACKUP_KEEP_HOURLY, BACKUP_KEEP_DAILY))
+    log("EVENT_BACKEND: {}".format(EVENT_BACKEND))
+    log("PIPELINE_QUEUE_SIZE: {}".format(PIPELINE_QUEUE_SIZE))
+    log("PIPELINE_WORKERS: {}".format(PIPELINE_WORKERS))
+    log("COALESCE_QUIET: {}".format(COALESCE_QUIET))
+    log("FILTER_FILE: {}".format(FILTER_FILE))
+    log("COMMIT_BATCH_WINDOW: {}".format(COMMIT_BATCH_WINDOW))
+    log("COMMIT_BATCH_SIZE: {}".format(COMMIT_BATCH_SIZE))
+    log("GIT_WRITER: {}".format(GIT_WRITER))
+    log("FINGERPRINT_INDEX: {}".format(FINGERPRINT_INDEX))
+    log("MAINTENANCE: every {}s, {} loose objects, {} packs, idle after {}s".format(
+        MAINTENANCE_INTERVAL, MAINTENANCE_LOOSE_OBJECTS, MAINTENANCE_PACKS, MAINTENANCE_IDLE))
+    log("AUDIT_LOG: {}".format(AUDIT_LOG))
+    log("COMMAND_TIMEOUT: {}".format(COMMAND_TIMEOUT))
+    log("BASELINE_WORKERS: {}".format(BASELINE_WORKERS))
+    log("RECONCILE_WORKERS: {}".format(RECONCILE_WORKERS))
+    log("LARGE_FILES: larger than {} bytes stored as {}, full {}, meta {}, chunked {}".format(
+        LARGE_FILE_SIZE, LARGE_FILE_MODE, FULL_FILES, META_FILES, CHUNKED_FILES))
+    log("METRICS: textfile {}, socket {}".format(METRICS_TEXTFILE or "disabled", METRICS_SOCKET or "disabled"))
+    log("HISTORY_DB: {}".format(HISTORY_DB or "disabled"))
 
 
 def clean_up():
@@ -1,68 +1,209 @@
+import capabilities
 import config
 import util
+from collections import namedtuple
 import os
 import platform
-from subprocess import getstatusoutput
-# Runs command as sudo
-def run_command_sudo(command)-> bool:
-
-    if os.geteuid() != 0:
-        res = getstatusoutput("sudo {}".format(command))
-
-        if config.DEBUG:
-            util.log(res[1])
-        return res[0] == 0
-
-
-    elif os.geteuid() == 0:
-        res = getstatusoutput(command)
-
-        if config.DEBUG:
-            util.log(res[1])
-        return res[0] == 0
+import resource
+import shlex
+import subprocess
+import threading
+import time
+
+
+# returncode is None when the command could not be started, timed_out is set when it was killed after its timeout
+# wall and cpu are in seconds, cpu is the user + system time of the command itself, None when it is not known
+CommandResult = namedtuple("CommandResult", ["argv", "returncode", "stdout", "stderr", "wall", "cpu", "timed_out"])
+
+# Seconds a package install may take
+PACKAGE_TIMEOUT = 600
+
+# command type -> [count, failures, timeouts, wall, max wall, cpu], see command_type
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+# The CPU time of a command is what its children used while it ran, it is only known when no other command
+# ran meanwhile: commands in flight, and commands started so far
+_running = 0
+_started = 0
+_running_lock = threading.Lock()
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def command_type(argv:list) -> str:
+    """
+    The key a command is recorded under in the stats table: the program, plus the subcommand for git.
+    :param argv: The command
+    :return: e.g. "git add" or "auditctl"
+    """
+    args = list(argv)
+    if args and args[0] == "sudo":
+        args = args[1:]
+    if not args:
+        return ""
+
+    name = os.path.basename(args[0])
+    if name != "git":
+        return name
+
+    # skip the global options, -C and --git-dir take a value
+    i = 1
+    while i < len(args) and args[i].startswith("-"):
+        i += 2 if args[i] in ("-C", "-c", "--git-dir", "--work-tree") else 1
+    return "git {}".format(args[i]) if i < len(args) else name
+
+
+def _record(argv:list, result:CommandResult):
+    key = command_type(argv)
+    with _stats_lock:
+        entry = _stats.get(key)
+        if entry is None:
+            entry = _stats[key] = [0, 0, 0, 0.0, 0.0, 0.0]
+        entry[0] += 1
+        if result.returncode != 0:
+            entry[1] += 1
+        if result.timed_out:
+            entry[2] += 1
+        entry[3] += result.wall
+        entry[4] = max(entry[4], result.wall)
+        entry[5] += result.cpu or 0.0
+
+
+def run(argv:list, timeout:float=None, sudo:bool=False, input=None, cwd:str=None, text:bool=True) -> CommandResult:
+    """
+    Run a command without a shell, every argument is passed as is, so paths with spaces or quotes are safe.
+    :param argv: The command and its arguments
+    :param timeout: Seconds before the command is killed, config.COMMAND_TIMEOUT if not given, 0 waits forever
+    :param sudo: Run it through sudo when not running as root
+    :param input: Passed to the standard input of the command
+    :param cwd: The working directory of the command
+    :param text: Decode stdout and stderr, otherwise they are bytes
+    :return: The CommandResult, its time is added to the stats table
+    """
+    argv = [str(arg) for arg in argv]
+    if sudo and os.geteuid() != 0:
+        argv = ["sudo"] + argv
+    if timeout is None:
+        timeout = config.COMMAND_TIMEOUT
+    timeout = timeout or None
 
-    else:
-        util.log("Cannot run command as sudo", "ERROR")
-        return False
+    if config.DEBUG:
+        util.log("Running command: {}".format(" ".join(shlex.quote(arg) for arg in argv)))
+
+    global _running, _started
+    with _running_lock:
+        _running += 1
+        _started += 1
+        started = _started
+        alone = _running == 1
+        cpu_start = _children_cpu()
+
+    start = time.time()
+    timed_out = False
+    try:
+        process = subprocess.Popen(argv, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    except OSError as e:
+        with _running_lock:
+            _running -= 1
+        result = CommandResult(argv, None, "" if text else b"", str(e) if text else str(e).encode(), time.time() - start, None, False)
+        _record(argv, result)
+        return result
+
+    if isinstance(input, str):
+        input = input.encode()
+
+    try:
+        stdout, stderr = process.communicate(input, timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        stdout, stderr = process.communicate()
+        timed_out = True
+
+    with _running_lock:
+        # another command may have been reaped meanwhile, its time can't be told apart
+        cpu = _children_cpu() - cpu_start if alone and _started == started else None
+        _running -= 1
+    if text:
+        stdout = stdout.decode(errors="replace")
+        stderr = stderr.decode(errors="replace")
+
+    result = CommandResult(argv, process.returncode, stdout, stderr, time.time() - start, cpu, timed_out)
+    _record(argv, result)
 
-def run_command_sudo_check(command, success_message) -> bool:
     if config.DEBUG:
-        util.log("Running command as sudo: {}".format(command))
+        util.log((stdout + stderr) if text else (stdout + stderr).decode(errors="replace"))
+    if timed_out:
+        util.log("Command timed out after {}s: {}".format(timeout, " ".join(argv)), "WARNING")
 
-    if os.geteuid() != 0:
-        res = getstatusoutput("sudo {}".format(command))
+    return result
 
-        if config.DEBUG:
-            util.log(res[1])
 
-        return res[0] == 0 or success_message in res[1]
+def command_stats() -> dict:
+    """
+    :return: command type -> count, failures, timeouts, total and max wall time, total CPU time of the commands
+             that ran alone
+    """
+    with _stats_lock:
+        return {key: {"count": count, "failures": failures, "timeouts": timeouts, "wall": wall, "max_wall": max_wall, "cpu": cpu}
+                for key, (count, failures, timeouts, wall, max_wall, cpu) in _stats.items()}
 
-    elif os.geteuid() == 0:
-        res = getstatusoutput(command)
 
-        if config.DEBUG:
-            util.log(res[1])
+def format_command_stats() -> str:
+    """
+    :return: The stats table, one line per command type, the slowest first
+    """
+    stats = command_stats()
+    lines = ["{:<20} {:>7} {:>6} {:>8} {:>10} {:>10} {:>10}".format("command", "count", "failed", "timeouts", "avg ms", "max ms", "cpu ms")]
+    for key, entry in sorted(stats.items(), key=lambda item: item[1]["wall"], reverse=True):
+        lines.append("{:<20} {:>7} {:>6} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            key, entry["count"], entry["failures"], entry["timeouts"], entry["wall"] / entry["count"] * 1000,
+            entry["max_wall"] * 1000, entry["cpu"] * 1000))
+    return "\n".join(lines)
 
-        return res[0] == 0 or success_message in res[1]
 
-    else:
-        util.log("Cannot run command as sudo", "ERROR")
-        return False
+def _argv(command) -> list:
+    # the old string commands, split like a shell would, without running one
+    return shlex.split(command) if isinstance(command, str) else list(command)
 
-def run_command(command):
+
+# Runs command as sudo
+def run_command_sudo(command, timeout:float=None) -> bool:
+    """
+    :param command: An argv list, or a command string split with shlex
+    :return: True if the command succeeded, False otherwise.
+    """
+    return run(_argv(command), timeout, sudo=True).returncode == 0
+
+def run_command_sudo_check(command, success_message, timeout:float=None) -> bool:
+    """
+    :param command: An argv list, or a command string split with shlex
+    :param success_message: Output that counts as success even if the command failed
+    :return: True if the command succeeded or printed success_message, False otherwise.
+    """
+    res = run(_argv(command), timeout, sudo=True)
+    return res.returncode == 0 or success_message in res.stdout + res.stderr
+
+def run_command(command, timeout:float=None):
     if config.DEBUG:
         util.log("Running command: {}".format(command))
         return True
 
-    return os.system(command) == 0
+    return run(_argv(command), timeout).returncode == 0
 
 def check_command(command) -> bool:
-    res = getstatusoutput("which {}".format(command))
+    # resolved in-process and cached, see capabilities.py
+    found = capabilities.which(command)
 
     if config.DEBUG:
-        util.log(res[1])
+        util.log("{}: {}".format(command, found))
 
-    return res[0] == 0
+    return found is not None
 
 def install_pkg(pkg):
     if config.DEBUG:
@@ -71,21 +212,13 @@ def install_pkg(pkg):
     system_os = platform.system().lower()
 
     if system_os == "darwin":
-        return run_command("brew install {} -y".format(pkg))
-
-    commands = [
-        ("apt", "apt install {} -y"),
-        ("apt-get", "apt-get install {} -y"),
-        ("yum", "yum install {} -y"),
-        ("dnf", "dnf install {} -y"),
-        ("zypper", "zypper install {} -y"),
-        ("pacman", "pacman -S --noconfirm {}"),
-        ("apk", "apk add {}"),
-        ("emerge", "emerge install {} -y")
-    ]
-
-    for cmd, command in commands:
-        if check_command(cmd):
-            return run_command_sudo(command.format(pkg)) ==  0
-
-    return False
+        installed = run_command(["brew", "install", pkg, "-y"])
+    else:
+        manager = capabilities.package_manager()
+        if manager is None:
+            return False
+        installed = run_command_sudo([part.format(pkg) for part in manager[1].split()], PACKAGE_TIMEOUT)
+
+    # the package added new commands to PATH
+    capabilities.invalidate()
+    return installed
@@ -0,0 +1,496 @@
+"""
+Event sources for watchdir.
+
+An event source watches one or more directory trees and yields Event tuples. Two backends exist:
+
+- native: talks to the kernel inotify API directly through libc, reads raw inotify_event
+  structs in bulk and keeps its own watch descriptor -> path map.
+- inotifywait: the original backend, runs `inotifywait -m -r` and parses its stdout.
+
+The native backend is preferred, inotifywait is kept as a fallback for systems where
+libc or the inotify syscalls cannot be loaded.
+
+Both backends watch every directory with a single inotify instance (or a single inotifywait process),
+so watching many directories costs no extra threads or file descriptors.
+"""
+
+from collections import namedtuple
+from util import log
+from console import check_command
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import subprocess
+
+
+# event is a comma separated list of event names, the same format inotifywait uses for %e
+# cookie links MOVED_FROM and MOVED_TO events, it is 0 when the backend can't provide it
+# old_path is only set on coalesced RENAMED changes, see coalesce.py
+Event = namedtuple("Event", ["event", "path", "cookie", "old_path"], defaults=[0, None])
+
+# Reported when the kernel event queue overflowed and events were lost
+OVERFLOW = "Q_OVERFLOW"
+
+# inotify constants, from <sys/inotify.h>
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# The same set of events main used to pass to inotifywait: modify,attrib,close_write,move,create,delete
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Names in the order inotifywait prints them
+EVENT_NAMES = [
+    (IN_ACCESS, "ACCESS"),
+    (IN_MODIFY, "MODIFY"),
+    (IN_ATTRIB, "ATTRIB"),
+    (IN_CLOSE_WRITE, "CLOSE_WRITE"),
+    (IN_CLOSE_NOWRITE, "CLOSE_NOWRITE"),
+    (IN_OPEN, "OPEN"),
+    (IN_MOVED_FROM, "MOVED_FROM"),
+    (IN_MOVED_TO, "MOVED_TO"),
+    (IN_CREATE, "CREATE"),
+    (IN_DELETE, "DELETE"),
+    (IN_DELETE_SELF, "DELETE_SELF"),
+    (IN_MOVE_SELF, "MOVE_SELF"),
+    (IN_UNMOUNT, "UNMOUNT"),
+    (IN_Q_OVERFLOW, OVERFLOW),
+    (IN_IGNORED, "IGNORED"),
+    (IN_ISDIR, "ISDIR"),
+]
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_STRUCT = struct.Struct("iIII")
+
+# Large enough to drain thousands of events per read() call
+READ_BUFFER_SIZE = 256 * 1024
+
+_mask_name_cache = {}
+
+
+def mask_to_names(mask:int) -> str:
+    """
+    Convert an inotify mask to a comma separated list of event names.
+    :param mask: The inotify event mask
+    :return: The event names, e.g. "CLOSE_WRITE,CLOSE"
+    """
+    names = _mask_name_cache.get(mask)
+    if names is not None:
+        return names
+
+    parts = []
+    for bit, name in EVENT_NAMES:
+        if mask & bit:
+            parts.append(name)
+            # inotifywait also prints CLOSE for both close events, keep the output compatible
+            if bit == IN_CLOSE_NOWRITE or (bit == IN_CLOSE_WRITE and not mask & IN_CLOSE_NOWRITE):
+                parts.append("CLOSE")
+
+    names = ",".join(parts)
+    _mask_name_cache[mask] = names
+    return names
+
+
+def native_available() -> bool:
+    """
+    Check if the native inotify backend can be used on this system.
+    :return: True if libc exposes the inotify syscalls, False otherwise.
+    """
+    try:
+        _load_libc()
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is not None:
+        return _libc
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_init1.restype = ctypes.c_int
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_add_watch.restype = ctypes.c_int
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    libc.inotify_rm_watch.restype = ctypes.c_int
+    _libc = libc
+    return libc
+
+
+class InotifyBackend:
+    """
+    Native inotify event source.
+
+    Reads raw inotify_event structs from the inotify file descriptor in large buffers,
+    keeps a watch descriptor -> directory map and adds watches for new subdirectories as they appear.
+    """
+
+    name = "native"
+
+    def __init__(self, path, mask:int=WATCH_MASK, buffer_size:int=READ_BUFFER_SIZE, exclude_dir=None):
+        """
+        :param path: The directory to watch recursively, or a list of directories
+        :param mask: The inotify events to watch for
+        :param buffer_size: The size of the buffer passed to read()
+        :param exclude_dir: Called with the path of every subdirectory, no watch is added when it returns True
+        """
+        self.paths = _paths(path)
+        self.path = self.paths[0]
+        self.exclude_dir = exclude_dir
+        self.mask = mask | IN_ONLYDIR | IN_DONT_FOLLOW
+        self.buffer_size = buffer_size
+        self.libc = _load_libc()
+        self.fd = -1
+        self.watches = {}
+        self.overflows = 0
+        # cookie -> old path, for directories moved inside the watched tree
+        self._dir_moves = {}
+        self._closed = False
+
+    def open(self):
+        """
+        Create the inotify instance and add the initial recursive watches.
+        """
+        if self.fd >= 0:
+            return
+
+        fd = self.libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1: {}".format(os.strerror(err)))
+
+        self.fd = fd
+        for path in self.paths:
+            self.add_tree(path)
+
+    def add_watch(self, directory:str):
+        """
+        Add a watch for a single directory.
+        :param directory: The directory to watch
+        :return: The watch descriptor, or -1 on failure
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                log("inotify watch limit reached, increase fs.inotify.max_user_watches", "ERROR")
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                log("Failed to watch {}: {}".format(directory, os.strerror(err)), "ERROR")
+            return -1
+
+        self.watches[wd] = directory
+        return wd
+
+    def add_tree(self, directory:str, created:list=None):
+        """
+        Watch a directory and all of its subdirectories.
+        :param directory: The top of the tree to watch
+        :param created: If given, Events for files already in the tree are appended to it.
+                        Used for directories that were created after the watch started,
+                        since files can be written into them before their watch exists.
+        """
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            if self.add_watch(current) < 0:
+                continue
+
+            try:
+                entries = os.scandir(current)
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    if is_dir:
+                        # excluded directories get no watch, so their events are never generated
+                        if self.exclude_dir and self.exclude_dir(entry.path):
+                            continue
+                        stack.append(entry.path)
+                        if created is not None:
+                            created.append(Event("CREATE,ISDIR", entry.path, 0))
+                    elif created is not None:
+                        created.append(Event("CREATE", entry.path, 0))
+                        created.append(Event("CLOSE_WRITE,CLOSE", entry.path, 0))
+
+    def _rename_tree(self, old:str, new:str):
+        prefix = old + os.sep
+        for wd, directory in self.watches.items():
+            if directory == old:
+                self.watches[wd] = new
+            elif directory.startswith(prefix):
+                self.watches[wd] = new + directory[len(old):]
+
+    def _parse(self, data:bytes) -> list:
+        events = []
+        offset = 0
+        size = len(data)
+        header = _EVENT_STRUCT.size
+        unpack = _EVENT_STRUCT.unpack_from
+        watches = self.watches
+
+        while offset + header <= size:
+            wd, mask, cookie, length = unpack(data, offset)
+            offset += header
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflows += 1
+                log("inotify event queue overflowed, events were lost", "WARNING")
+                # the queue is shared, events of every watched directory may be lost
+                for path in self.paths:
+                    events.append(Event(OVERFLOW, path, 0))
+                continue
+
+            directory = watches.get(wd)
+            if directory is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del watches[wd]
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            events.append(Event(mask_to_names(mask), path, cookie))
+
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    # directories moved out of the tree never get a MOVED_TO, don't let them pile up
+                    if len(self._dir_moves) > 1024:
+                        self._dir_moves.clear()
+                    self._dir_moves[cookie] = path
+                elif mask & IN_MOVED_TO and cookie in self._dir_moves:
+                    self._rename_tree(self._dir_moves.pop(cookie), path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    if not (self.exclude_dir and self.exclude_dir(path)):
+                        self.add_tree(path, events)
+
+        return events
+
+    def read_events(self, timeout:float=None) -> list:
+        """
+        Read all pending events with a single read() call.
+        :param timeout: Seconds to wait for events, None waits forever
+        :return: A list of Events, empty if the timeout expired
+        """
+        if self.fd < 0:
+            self.open()
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, self.buffer_size)
+        except BlockingIOError:
+            return []
+
+        return self._parse(data)
+
+    def __iter__(self):
+        self.open()
+        try:
+            while not self._closed:
+                for event in self.read_events(1):
+                    yield event
+        except Exception as e:
+            if not self._closed:
+                log("Error in inotify backend: {}".format(e), "ERROR")
+        finally:
+            self.close()
+
+    def close(self):
+        self._closed = True
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.watches.clear()
+
+
+class InotifywaitBackend:
+    """
+    Fallback event source that parses the output of `inotifywait -m -r`.
+    """
+
+    name = "inotifywait"
+
+    def __init__(self, path, events:str="modify,attrib,close_write,move,create,delete", exclude_dir=None):
+        """
+        :param path: The directory to watch recursively, or a list of directories
+        :param events: The events passed to inotifywait -e
+        :param exclude_dir: Not supported, inotifywait watches every subdirectory and excluded events are filtered afterwards
+        """
+        self.paths = _paths(path)
+        self.path = self.paths[0]
+        self.events = events
+        self.process = None
+        # the start of a line whose end was not read yet
+        self.partial = b""
+        self.overflows = 0
+        self._overflowed = []
+        self._closed = False
+
+    def read_events(self, timeout:float=None) -> list:
+        """
+        Read every complete line inotifywait wrote so far with a single read() call of its pipe.
+        :param timeout: Seconds to wait for events, None waits forever
+        :return: A list of Events, empty if the timeout expired
+        """
+        if self.process is None:
+            self.open()
+
+        if self._overflowed:
+            events, self._overflowed = self._overflowed, []
+            return events
+
+        # the raw pipe, a buffered reader would keep lines the fd no longer reports as readable
+        fd = self.process.stdout.fileno()
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(fd, READ_BUFFER_SIZE)
+        if not data:
+            raise OSError("inotifywait exited with code {}".format(self.process.poll()))
+
+        data = self.partial + data
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+
+        events = []
+        for line in data[:end].split(b"\n"):
+            event = self._parse(os.fsdecode(line))
+            if event:
+                events.append(event)
+            if self._overflowed:
+                events += self._overflowed
+                self._overflowed = []
+        return events
+
+    def open(self):
+        # Check if inotifywait is installed
+        if not check_command("inotifywait"):
+            raise OSError("inotify-tools package is not installed")
+
+        # The -m flag keeps inotifywait running, -r watches the directory recursively
+        # and -e selects the events to watch for
+        self.process = subprocess.Popen(['inotifywait', '-m', '-r', '-q', '-e', self.events, '--format', "%e %w%f", '--'] + self.paths,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.partial = b""
+
+    def _parse(self, line:str):
+        line = line.rstrip("\n")
+        if not line:
+            return None
+
+        # paths can contain spaces, only split on the first one
+        event, _, path = line.partition(" ")
+        if OVERFLOW in event:
+            self.overflows += 1
+            log("inotify event queue overflowed, events were lost", "WARNING")
+            # report the overflow for the other watched directories on the next read
+            self._overflowed = [Event(OVERFLOW, path, 0) for path in self.paths[1:]]
+            return Event(OVERFLOW, self.path, 0)
+
+        return Event(event, path, 0)
+
+    def __iter__(self):
+        try:
+            self.open()
+        except OSError as e:
+            log(str(e), "ERROR")
+            return
+
+        try:
+            while True:
+                for event in self.read_events():
+                    yield event
+        except Exception as e:
+            if not self._closed:
+                log("Error in inotifywait backend: {}".format(e), "ERROR")
+        finally:
+            self.close()
+
+    def close(self):
+        self._closed = True
+        if not self.process:
+            return
+
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+        if self.process.stdout:
+            self.process.stdout.close()
+        self.process = None
+
+
+BACKENDS = {
+    InotifyBackend.name: InotifyBackend,
+    InotifywaitBackend.name: InotifywaitBackend,
+}
+
+
+def resolve_backend(backend:str="auto") -> str:
+    """
+    Pick the backend to use.
+    :param backend: "auto", "native" or "inotifywait"
+    :return: The name of the backend
+    """
+    if backend == "auto":
+        return InotifyBackend.name if native_available() else InotifywaitBackend.name
+
+    if backend not in BACKENDS:
+        raise ValueError("Unknown event backend: {}".format(backend))
+
+    return backend
+
+
+def _paths(path) -> list:
+    if isinstance(path, str):
+        path = [path]
+    return [os.path.abspath(p) for p in path]
+
+
+def get_event_source(path, backend:str="auto", exclude_dir=None):
+    """
+    Create an event source for one or more directories.
+    :param path: The directory to watch recursively, or a list of directories
+    :param backend: "auto", "native" or "inotifywait"
+    :param exclude_dir: Called with the path of every subdirectory, returns True if it should not be watched
+    :return: An iterable event source
+    """
+    return BACKENDS[resolve_backend(backend)](path, exclude_dir=exclude_dir)
@@ -0,0 +1,203 @@
+"""
+Content fingerprint index.
+
+Keeps path -> (inode, size, mtime_ns, content hash) for every committed file, so events that did not change
+the content of a file (touch, chmod, a rewrite with the same bytes) are dropped before they reach git.
+The content is only hashed when the inode, size or mtime changed, and is read in chunks.
+
+The hash is the git blob id of the content, and the index is saved to a compact binary file so it
+survives restarts.
+"""
+
+from util import log
+import hashlib
+import os
+import stat
+import struct
+import threading
+
+
+MAGIC = b"WDFP1\n"
+# inode, size, mtime_ns, blob sha1, path length
+_ENTRY = struct.Struct("<QQq20sH")
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path:str, st:os.stat_result=None) -> bytes:
+    """
+    Compute the git blob id of a file, reading it in chunks.
+    :param path: The file to hash
+    :param st: The lstat result of the file, if already known
+    :return: The binary sha1
+    """
+    if st is None:
+        st = os.lstat(path)
+
+    if stat.S_ISLNK(st.st_mode):
+        target = os.fsencode(os.readlink(path))
+        return hashlib.sha1(b"blob " + str(len(target)).encode() + b"\0" + target).digest()
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        digest = hashlib.sha1(b"blob " + str(size).encode() + b"\0")
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+
+    # the file shrank while it was read, the hash can't match a committed blob
+    if remaining > 0:
+        digest.update(b"\0" * remaining)
+    return digest.digest()
+
+
+class FingerprintIndex:
+    """
+    path -> (inode, size, mtime_ns, blob sha1) of the last committed content of each file.
+    """
+
+    def __init__(self, index_file:str=None):
+        """
+        :param index_file: Where the index is saved, it is loaded right away if it exists
+        """
+        self.index_file = index_file
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.hashed = 0
+
+        if index_file and os.path.isfile(index_file):
+            self.load()
+
+    def changed(self, path:str) -> bool:
+        """
+        Check if the content of a file changed since it was last seen, and remember its new fingerprint.
+        :param path: The absolute path of the file
+        :return: True if the file is new, deleted or its content changed, False otherwise.
+        """
+        try:
+            st = os.lstat(path)
+        except OSError:
+            with self.lock:
+                existed = self.entries.pop(path, None) is not None
+                self.dirty = self.dirty or existed
+                self.misses += 1
+            return True
+
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_ino and entry[1] == st.st_size and entry[2] == st.st_mtime_ns:
+            # chmod, chown or an access, the content can't have changed
+            self.hits += 1
+            return False
+
+        try:
+            digest = hash_file(path, st)
+        except OSError as e:
+            log("Failed to hash {}: {}".format(path, e), "ERROR")
+            self.misses += 1
+            return True
+        self.hashed += 1
+
+        with self.lock:
+            self.entries[path] = (st.st_ino, st.st_size, st.st_mtime_ns, digest)
+            self.dirty = True
+
+        if entry is not None and entry[3] == digest:
+            # touched or rewritten with the same content
+            self.hits += 1
+            return False
+
+        self.misses += 1
+        return True
+
+    def forget(self, path:str):
+        """
+        Drop a path, for example because its commit failed, so the next event for it is not skipped.
+        :param path: The absolute path of the file
+        """
+        with self.lock:
+            if self.entries.pop(path, None) is not None:
+                self.dirty = True
+
+    def load(self):
+        """
+        Load the index from index_file, a missing or damaged file leaves the index empty.
+        """
+        try:
+            with open(self.index_file, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            log("Failed to read fingerprint index {}: {}".format(self.index_file, e), "ERROR")
+            return
+
+        if not data.startswith(MAGIC):
+            log("Ignoring fingerprint index {} with unknown format".format(self.index_file), "WARNING")
+            return
+
+        entries = {}
+        offset = len(MAGIC)
+        size = _ENTRY.size
+        try:
+            while offset < len(data):
+                ino, file_size, mtime_ns, digest, length = _ENTRY.unpack_from(data, offset)
+                offset += size
+                path = os.fsdecode(data[offset:offset + length])
+                offset += length
+                entries[path] = (ino, file_size, mtime_ns, digest)
+        except struct.error:
+            log("Fingerprint index {} is truncated, loaded {} entries".format(self.index_file, len(entries)), "WARNING")
+
+        with self.lock:
+            self.entries = entries
+            self.dirty = False
+
+    def save(self) -> bool:
+        """
+        Write the index to index_file if it changed, the file is replaced atomically.
+        :return: True if the index is saved, False otherwise.
+        """
+        if not self.index_file or not self.dirty:
+            return True
+
+        with self.lock:
+            items = list(self.entries.items())
+            self.dirty = False
+
+        parts = [MAGIC]
+        pack = _ENTRY.pack
+        for path, (ino, size, mtime_ns, digest) in items:
+            raw = os.fsencode(path)
+            parts.append(pack(ino, size, mtime_ns, digest, len(raw)))
+            parts.append(raw)
+
+        tmp = self.index_file + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(b"".join(parts))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.index_file)
+        except OSError as e:
+            log("Failed to save fingerprint index {}: {}".format(self.index_file, e), "ERROR")
+            self.dirty = True
+            return False
+
+        return True
+
+    def stats(self) -> dict:
+        """
+        :return: Entries, hits, misses, hashed files and the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hashed": self.hashed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
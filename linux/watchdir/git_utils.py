@@ -1,166 +1,757 @@
 from console import run_command_sudo, run_command_sudo_check
+import console
 import config
-import hashlib
 import os
 from util import log, exit_with_error
-import shutil
+import backups
+import largefiles
 import logger
+import maintenance
+import metrics
+import reconcile
+from fingerprint import FingerprintIndex
+from git_writer import GitWriter
+from collections import OrderedDict
+import json
+import tempfile
+import threading
 import time
 
 
-base_name = None
-git_dir_basename = None
-repo_dir = None
-git_log = None
+# Paths passed to a single `git add`, keeps the command line well below ARG_MAX
+ADD_CHUNK_SIZE = 200
+
+# Next to the repo: the pid of the watchdir process watching it, the files a restore is writing and the request of
+# a restore to checkpoint the writer, see restore.py
+PID_FILE = "watchdir.pid"
+RESTORE_MARKER = "restore.json"
+CHECKPOINT_REQUEST = "checkpoint.request"
+
+
+class Repo:
+    """
+    The git repo of one watched directory, with its git log, writer, fingerprint index and commit batch.
+    Each watched directory has its own Repo, so a slow commit in one does not hold back the others.
+    """
+
+    def __init__(self, root:config.Root):
+        """
+        :param root: The settings of the watched directory, see config.Root
+        """
+        self.watch_dir = root.watch_dir
+        self.base_name = os.path.basename(root.watch_dir)
+        self.git_dir_basename = root.base_name
+        self.repo_dir = os.path.join(config.BACKUP_DIR, self.git_dir_basename, "current.git")
+        self.git_log = logger.Logger(2, log_file=os.path.join(config.LOG_DIR, root.git_log_file), **config.log_rotation())
+
+        # large files and the ones matching the policy patterns are committed as stubs, see largefiles.py
+        self.policy = largefiles.load_policy(self.watch_dir, os.path.join(config.BACKUP_DIR, self.git_dir_basename, "chunks"),
+                                             {largefiles.FULL: config.FULL_FILES, largefiles.META: config.META_FILES,
+                                              largefiles.CHUNKED: config.CHUNKED_FILES},
+                                             config.LARGE_FILE_SIZE, config.LARGE_FILE_MODE)
+
+        # commits are streamed into one long lived fast-import process instead of forking git for every commit
+        if config.GIT_WRITER == "fast-import":
+            self.writer = GitWriter(self.repo_dir, self.watch_dir, checkpoint_interval=config.GIT_CHECKPOINT_INTERVAL, policy=self.policy)
+        else:
+            self.writer = None
+
+        # called with (sha, files, time the commit was made) once a commit is on the branch, see history.py
+        self.on_commit = None
+        if self.writer:
+            self.writer.on_commit = self._committed
+            self.writer.on_lost = self._lost
+
+        # drops events that did not change the content of a file before they reach git
+        if config.FINGERPRINT_INDEX:
+            self.fingerprints = FingerprintIndex(os.path.join(config.BACKUP_DIR, self.git_dir_basename, "fingerprints.idx"))
+        else:
+            self.fingerprints = None
+
+        # the stat of every file as it was last committed, compared with the tree at start, see reconcile.py
+        if config.RECONCILE_WORKERS > 0:
+            self.stat_index = reconcile.StatIndex(os.path.join(config.BACKUP_DIR, self.git_dir_basename, reconcile.INDEX_FILE))
+        else:
+            self.stat_index = None
+
+        self.commit_count = 0
+        # Serializes git operations between the watcher and the batch flush timer
+        self.lock = threading.RLock()
+        # Paths waiting to be committed, path -> list of events, in the order they were first seen
+        self.pending = OrderedDict()
+        # path -> the process that last changed it, for the commit message of the batch
+        self.pending_details = {}
+        self.pending_timer = None
+        # (time, count) of the last `git count-objects`
+        self._object_count = (0, None)
+        # when the last commit was written, commits since the last repack and the loose objects it left, see maintain
+        self.last_commit = time.time()
+        self.commits_since_repack = 0
+        self.repacked_loose = 0
+        # (mtime, marker) of the restore marker, reloaded when it changes
+        self.restore_marker = os.path.join(config.BACKUP_DIR, self.git_dir_basename, RESTORE_MARKER)
+        self.checkpoint_request = os.path.join(config.BACKUP_DIR, self.git_dir_basename, CHECKPOINT_REQUEST)
+        self._restore = (None, None)
+
+    def check_repo(self):
+        # repo is a separate directory
+        return os.path.isdir(self.repo_dir) and os.path.isfile(os.path.join(self.watch_dir, ".git"))
+
+    def backup_dir(self):
+        # shared bare repo holding every backup snapshot
+        return os.path.join(config.BACKUP_DIR, self.git_dir_basename, "snapshots.git")
+
+    def backup_chunks_dir(self):
+        # the chunks of large files, kept in the snapshot store so it restores on its own
+        return os.path.join(self.backup_dir(), "chunks")
+
+    def backup_init_repo(self):
+        if not os.path.isdir(self.watch_dir):
+            exit_with_error("Watch directory does not exist")
+            return False
+
+        if not os.path.isdir(self.repo_dir):
+            log("Git repo does not exist in the directory", "ERROR")
+            return False
+
+        if not os.path.exists(os.path.join(self.watch_dir, ".git")):
+            log("Git repo does not exist in the directory", "ERROR")
+            return
+
+        self.git_log.log("Creating initial git repo backup")
+        # kept as refs/backups/initial, the retention policy never removes it
+        if not backups.snapshot(self.repo_dir, self.backup_dir(), name="initial"):
+            log("Failed to back up git repo", "ERROR")
+            return False
+
+        log("Initial git repo backup created successfully")
+        return True
 
-def init():
-    global base_name, git_dir_basename, repo_dir, git_log
-    
-    # helper for git_utils that depend on config
-    base_name = os.path.basename(config.WATCH_DIR)
-    git_dir_basename = base_name + "_" + hashlib.md5(base_name.encode()).hexdigest()
-    repo_dir = os.path.join(config.BACKUP_DIR, git_dir_basename, "current.git")
-    git_log = logger.Logger(2, log_file=os.path.join(config.LOG_DIR, config.WATCH_GIT_LOG_FILE))
+    def init_repo(self, import_files:bool=True):
+        """
+        Create the repo of the watched directory and commit every file in it.
+        :param import_files: False only creates the repo, the files are imported by a baseline.Baseline
+        :return: True if the repo was created, False otherwise.
+        """
 
-def check_repo():
-    # repo is a separate directory
-    return os.path.isdir(repo_dir) and os.path.isfile(os.path.join(config.WATCH_DIR, ".git"))
+        if not os.path.isdir(self.watch_dir):
+            exit_with_error("Watch directory does not exist")
 
-def backup_init_repo():
-    init_repo_dir = os.path.join(config.BACKUP_DIR,"init_" + git_dir_basename)
-    if not os.path.isdir(init_repo_dir):
-        git_log.log("Creating initial git repo backup")
-        os.makedirs(init_repo_dir)
+        if self.check_repo():
+            log("Repo already exists")
+            return False
 
-    if not os.path.isdir(config.WATCH_DIR):
-        exit_with_error("Watch directory does not exist")
-        return False
+        if not os.path.isdir(self.repo_dir):
+            os.makedirs(self.repo_dir)
 
-    if not os.path.isdir(repo_dir):
-        log("Git repo does not exist in the directory", "ERROR")
-        return False
+        # every command runs with git -C, the working directory is shared by every watched directory
+        git = ["git", "-C", self.watch_dir]
 
-    if not os.path.exists(os.path.join(config.WATCH_DIR, ".git")):
-        log("Git repo does not exist in the directory", "ERROR")
-        return
+        if not run_command_sudo(["git", "config", "--global", "user.email", "admin@admin.com"]):
+            log("Failed to set git email", "ERROR")
+            return False
 
-    if not run_command_sudo("git clone --mirror {} {}".format(config.WATCH_DIR, init_repo_dir)):
-        log("Failed to clone git repo", "ERROR")
-        return False
+        if not run_command_sudo(["git", "config", "--global", "user.name", "watchdir"]):
+            log("Failed to set git name", "ERROR")
+            return False
 
-    log("Initial git repo backup created successfully")
-    return True
+        if not run_command_sudo(["git", "config", "--global", "--add", "safe.directory", self.watch_dir]):
+            log("Failed to set safe directory", "ERROR")
+            return False
 
-def init_repo():
+        # creates  a separate git directory, but a .git file is created in the watch directory
+        if not run_command_sudo(["git", "init", "--separate-git-dir", self.repo_dir, self.watch_dir]):
+            log("Failed to initialize git repo in separate dir", "ERROR")
+            return False
 
-    if not os.path.isdir(config.WATCH_DIR):
-        exit_with_error("Watch directory does not exist")
+        if not run_command_sudo(git + ["branch", "-m", "main"]):
+            log("Failed to rename branch", "ERROR")
+            return False
 
-    if check_repo():
-        log("Repo already exists")
-        return False
+        if not import_files:
+            log("Git repo created, importing files")
+            return True
 
-    if not os.path.isdir(repo_dir):
-        os.makedirs(repo_dir)
+        if len(os.listdir(self.watch_dir)) == 0:
+            log("No files in the directory", "WARNING")
+            log("Git repo initialized successfully")
+            return True
 
-    old_dir = os.getcwd()
-    os.chdir(config.WATCH_DIR)
+        # the first add reads every file, don't let the command timeout cut it short
+        if not run_command_sudo(git + ["add", "."], 0):
+            log("Failed to add files to git", "ERROR")
+            return False
 
-    if not run_command_sudo("git config --global user.email 'admin@admin.com'"):
-        os.chdir(old_dir)
-        log("Failed to set git email", "ERROR")
-        return False
+        if not run_command_sudo_check(git + ["commit", "-m", "Initial commit"], "nothing to commit", 0):
+            log("Failed to commit files to git", "ERROR")
+            return  False
 
-    if not run_command_sudo("git config --global user.name 'watchdir'"):
-        os.chdir(old_dir)
-        log("Failed to set git name", "ERROR")
-        return False
+        self.backup_init_repo()
+        log("Git repo initialized successfully")
 
-    if not run_command_sudo("git config --global --add safe.directory {}".format(config.WATCH_DIR)):
-        os.chdir(old_dir)
-        log("Failed to set safe directory", "ERROR")
-        return False
+        return True
 
-    # creates  a separate git directory, but a .git file is created in the watch directory
-    if not run_command_sudo("git init --separate-git-dir {} {}".format(repo_dir, config.WATCH_DIR)):
-        os.chdir(old_dir)
-        log("Failed to initialize git repo in separate dir", "ERROR")
-        return False
+    def backup_git_directory(self):
+        """
+        Take an incremental snapshot of the repo and prune old snapshots.
+        Only objects created since the last snapshot are copied.
+        :return: True if the snapshot was taken and verified, False otherwise.
+        """
+        # the snapshot copies the branch, make sure it includes everything streamed so far
+        with self.lock:
+            if self.writer:
+                self.writer.checkpoint()
+
+            start = time.time()
+            # the chunks go first, the stubs of the snapshot never refer to a chunk the store does not have
+            if self.policy:
+                try:
+                    self.policy.store.backup(self.backup_chunks_dir())
+                except OSError as e:
+                    self.git_log.log("Failed to back up the chunks of large files: {}".format(e), "ERROR")
+                    return False
+            ref = backups.snapshot(self.repo_dir, self.backup_dir())
+
+        metrics.BACKUP_SECONDS.set(time.time() - start, self.watch_dir)
+        metrics.BACKUPS.inc(self.watch_dir, "success" if ref else "failure")
+
+        if not ref:
+            self.git_log.log("Failed to backup git directory", "ERROR")
+            return False
+
+        self.git_log.log("Backup {} created in {:.2f}s".format(ref, time.time() - start))
+
+        if self.fingerprints:
+            self.fingerprints.save()
+        if self.stat_index:
+            self.stat_index.save()
+
+        deleted = backups.prune(self.backup_dir(), config.BACKUP_KEEP_LAST, config.BACKUP_KEEP_HOURLY, config.BACKUP_KEEP_DAILY)
+        if deleted:
+            self.git_log.log("Deleted {} old backups".format(deleted))
 
-    if not run_command_sudo("git branch -m main"):
-        os.chdir(old_dir)
-        log("Failed to rename branch", "ERROR")
-        return False
+        return True
 
+    def _after_commit(self):
+        self.commit_count += 1
+        self.commits_since_repack += 1
+        self.last_commit = time.time()
+
+        if self.commit_count > 10:
+            self.backup_git_directory()
+            self.commit_count = 0
+
+    def _stage_stub(self, file:str, stub:bytes) -> bool:
+        # the stub is written as the blob of the file, the file itself is left alone
+        res = console.run(["git", "-C", self.watch_dir, "hash-object", "-w", "--stdin"], sudo=True, input=stub, text=False)
+        if res.returncode != 0:
+            return False
+
+        mode = "100755" if os.stat(file).st_mode & 0o100 else "100644"
+        cacheinfo = "{},{},{}".format(mode, res.stdout.decode().strip(), os.path.relpath(file, self.watch_dir))
+        return run_command_sudo(["git", "-C", self.watch_dir, "update-index", "--add", "--cacheinfo", cacheinfo])
+
+    def _stage_files(self, files:list) -> bool:
+        # git add for files that exist, git rm --cached for deleted ones (ignored if they were never committed)
+        existing = [file for file in files if os.path.lexists(file)]
+        deleted = [file for file in files if not os.path.lexists(file)]
+
+        if self.policy:
+            stubbed = []
+            for file in existing:
+                try:
+                    stub = self.policy.content(file, os.lstat(file))
+                except OSError as e:
+                    self.git_log.log("Failed to read {}: {}".format(file, e), "ERROR")
+                    continue
+                if stub is not None:
+                    if not self._stage_stub(file, stub):
+                        self.git_log.log("Failed to add {} to git".format(file), "ERROR")
+                        return False
+                    stubbed.append(file)
+            existing = [file for file in existing if file not in stubbed]
+
+        for command, paths in ((["add"], existing), (["rm", "--cached", "--ignore-unmatch", "-q"], deleted)):
+            for i in range(0, len(paths), ADD_CHUNK_SIZE):
+                if not run_command_sudo(["git", "-C", self.watch_dir] + command + ["--"] + paths[i:i + ADD_CHUNK_SIZE]):
+                    self.git_log.log("Failed to add files to git", "ERROR")
+                    return False
 
-    if len(os.listdir(config.WATCH_DIR)) == 0:
-        os.chdir(old_dir)
-        log("No files in the directory", "WARNING")
-        log("Git repo initialized successfully")
         return True
 
-    if not run_command_sudo("git add ."):
-        os.chdir(old_dir)
-        log("Failed to add files to git", "ERROR")
-        return False
+    def _commit_files(self, message:str, files:list) -> bool:
+        """
+        Commit the current state of files in one commit, files that no longer exist are removed from the repo.
+        :param message: The commit message
+        :param files: Absolute paths of the changed files
+        :return: True if the files were committed or nothing changed, False otherwise.
+        """
+        start = time.time()
+        # stat before the content is read, a change made meanwhile is found again at the next start
+        stats = self.stat_index.snapshot(files) if self.stat_index else None
+        committed = self._write_commit(message, files)
+        metrics.COMMIT_SECONDS.observe(time.time() - start, self.watch_dir)
+
+        if committed:
+            if stats:
+                self.stat_index.update(stats)
+            metrics.COMMITS.inc(self.watch_dir)
+            metrics.COMMITTED_FILES.inc(self.watch_dir, amount=len(files))
+        else:
+            metrics.COMMIT_FAILURES.inc(self.watch_dir)
+        return committed
+
+    def _committed(self, sha:str, files:list, when:float):
+        if self.on_commit:
+            try:
+                self.on_commit(sha, files, when)
+            except Exception as e:
+                self.git_log.log("Failed to record commit {}: {}".format(sha, e), "ERROR")
+
+    def _write_commit(self, message:str, files:list) -> bool:
+        if self.writer:
+            return self.writer.commit(message, files)
+
+        if not self._stage_files(files):
+            return False
+
+        with tempfile.NamedTemporaryFile("w", prefix="watchdir_commit_", delete=False) as message_file:
+            message_file.write(message)
+
+        try:
+            committed = run_command_sudo_check(["git", "-C", self.watch_dir, "commit", "-F", message_file.name], "nothing to commit")
+        finally:
+            os.unlink(message_file.name)
+
+        if committed and self.on_commit:
+            res = console.run(["git", "-C", self.watch_dir, "rev-parse", "HEAD"])
+            if res.returncode == 0:
+                self._committed(res.stdout.strip(), files, time.time())
+        return committed
+
+    def _lost(self, files:list):
+        # streamed into fast-import but never on the branch, the indexes must not skip them as committed
+        self._commit_failed(files)
+        if self.stat_index:
+            self.stat_index.invalidate(files)
+
+    def _commit_failed(self, files:list):
+        # the next event for these files must not be skipped as unchanged
+        if self.fingerprints:
+            for file in files:
+                self.fingerprints.forget(file)
+
+    def _commit_now(self, event, file, details=None):
+        message = "{} - {}\n".format(event, file)
+        if details:
+            message += "\n{}\n".format(details)
+
+        if not self._commit_files(message, [file]):
+            self.git_log.log("Failed to commit file to git", "ERROR")
+            self._commit_failed([file])
+            return False
+
+        self.git_log.log("{} - {}".format(event, file))
+        self._after_commit()
+        return True
 
-    if not run_command_sudo_check("git commit -m 'Initial commit'", "nothing to commit"):
-        os.chdir(old_dir)
-        log("Failed to commit files to git", "ERROR")
-        return  False
+    def commit(self, event, file, details=None):
+        """
+        Commit a changed file.
+        When batching is enabled (config.COMMIT_BATCH_WINDOW > 0) the file is queued and committed together
+        with every other file changed within the batch window, or once config.COMMIT_BATCH_SIZE paths are queued.
+        A file that no longer exists is removed from the repo.
+        :param event: The event that changed the file
+        :param file: The file that was changed
+        :param details: Added to the commit message, e.g. the process that changed the file
+        :return: True if the file was committed or queued, False otherwise.
+        """
+        if os.path.isdir(file) and not os.path.islink(file):
+            self.git_log.log("Not a file: {}".format(file), "ERROR")
+            return False
+
+        # written by a restore, committed together once it is done, see commit_restore
+        marker = self.read_restore_marker()
+        if marker and file in marker["files"]:
+            return True
+
+        # touch, chmod or a rewrite with the same content, nothing for git to do
+        if self.fingerprints and not self.fingerprints.changed(file):
+            metrics.UNCHANGED.inc(self.watch_dir)
+            if self.stat_index:
+                self.stat_index.update(self.stat_index.snapshot([file]))
+            return True
+
+        if config.COMMIT_BATCH_WINDOW <= 0:
+            with self.lock:
+                return self._commit_now(event, file, details)
+
+        with self.lock:
+            if file in self.pending:
+                if event not in self.pending[file]:
+                    self.pending[file].append(event)
+            else:
+                self.pending[file] = [event]
+            if details:
+                self.pending_details[file] = details
+
+            if len(self.pending) >= config.COMMIT_BATCH_SIZE:
+                return self.flush_commits()
+
+            # The window starts with the first queued event and is not extended by later ones,
+            # so a steady stream of events can't hold a batch back forever
+            if self.pending_timer is None:
+                self.pending_timer = threading.Timer(config.COMMIT_BATCH_WINDOW, self.flush_commits)
+                self.pending_timer.daemon = True
+                self.pending_timer.start()
 
-    backup_init_repo()
-    os.chdir(old_dir)
-    log("Git repo initialized successfully")
+        return True
 
-    return True
+    def flush_commits(self):
+        """
+        Commit every queued file in a single commit.
+        The commit message lists each path with the events seen for it.
+        :return: True if the batch was committed or there was nothing to commit, False otherwise.
+        """
+        with self.lock:
+            if self.pending_timer is not None:
+                self.pending_timer.cancel()
+                self.pending_timer = None
+
+            if not self.pending:
+                return True
+
+            batch = self.pending
+            details = self.pending_details
+            self.pending = OrderedDict()
+            self.pending_details = {}
+
+            files = list(batch)
+            lines = ["{} changed files".format(len(files)), ""]
+            for file in files:
+                line = "{} - {}".format(" ".join(batch[file]), file)
+                if file in details:
+                    line += " ({})".format(details[file])
+                lines.append(line)
+
+            if not self._commit_files("\n".join(lines) + "\n", files):
+                self.git_log.log("Failed to commit files to git", "ERROR")
+                self._commit_failed(files)
+                return False
+
+            self.git_log.log("Committed batch of {} files".format(len(files)))
+            self._after_commit()
 
+        return True
 
-def backup_git_directory():
-    current_time = time.strftime("%Y_%m_%d_%I_%M_%S")
-    backup_dir = os.path.join(config.BACKUP_DIR, git_dir_basename, current_time)
-    if not os.path.isdir(backup_dir):
-        os.makedirs(backup_dir)
+    def read_restore_marker(self):
+        """
+        :return: The marker of a running restore, with the absolute paths it writes in "files", or None
+        """
+        try:
+            mtime = os.stat(self.restore_marker).st_mtime_ns
+        except OSError:
+            self._restore = (None, None)
+            return None
+
+        if mtime != self._restore[0]:
+            try:
+                with open(self.restore_marker) as f:
+                    marker = json.load(f)
+                marker["files"] = set(os.path.join(self.watch_dir, path) for path in marker.get("paths", []))
+            except (OSError, ValueError) as e:
+                self.git_log.log("Failed to read restore marker: {}".format(e), "ERROR")
+                marker = None
+            self._restore = (mtime, marker)
+        return self._restore[1]
+
+    def commit_restore(self) -> bool:
+        """
+        Commit the files written by a restore in one commit, once it is done or the restore process is gone.
+        :return: True if a restore was committed, False otherwise.
+        """
+        marker = self.read_restore_marker()
+        if not marker:
+            return False
+
+        if marker.get("state") != "done":
+            if process_alive(marker.get("pid")):
+                return False
+            self.git_log.log("Restore process {} is gone, committing what it restored".format(marker.get("pid")), "WARNING")
+
+        files = sorted(marker["files"])
+        with self.lock:
+            self.flush_commits()
+            message = "RESTORE - {} files to {}\n\n{}\n".format(len(files), marker.get("commit"), "\n".join(files))
+            committed = self._commit_files(message, files) if files else True
+            if committed:
+                # the next event for a restored file is compared with its restored content
+                if self.fingerprints:
+                    for file in files:
+                        self.fingerprints.changed(file)
+                self.git_log.log("Committed restore of {} files to {}".format(len(files), marker.get("commit")))
+            else:
+                self.git_log.log("Failed to commit restore of {} files".format(len(files)), "ERROR")
+                self._commit_failed(files)
+
+        try:
+            os.unlink(self.restore_marker)
+        except OSError:
+            pass
+        self._restore = (None, None)
+        return committed
+
+    def answer_checkpoint(self) -> bool:
+        """
+        Put every change seen so far on the branch for a restore that asked for it, by committing the batch and
+        checkpointing the writer. The request is removed once that is done, see restore.request_checkpoint.
+        :return: True if a request was answered, False otherwise.
+        """
+        if not os.path.exists(self.checkpoint_request):
+            return False
+
+        with self.lock:
+            done = self.flush_commits() and (self.writer.checkpoint() if self.writer else True)
+        if not done:
+            self.git_log.log("Failed to checkpoint for a restore, it may miss the newest commits", "ERROR")
+            return False
+
+        try:
+            os.unlink(self.checkpoint_request)
+        except OSError:
+            pass
+        return True
 
-    if not run_command_sudo("git clone --mirror {} {}".format(config.WATCH_DIR, backup_dir)):
-        git_log.log("Failed to backup git directory", "ERROR")
-        return False
+    def _changed_files(self, path:str, exclude=None) -> list:
+        """
+        List the files under path that differ from the last commit, including untracked and deleted ones.
+        :param path: A directory inside the watched directory
+        :param exclude: Called with every changed file, it is left out when it returns True
+        :return: Absolute paths of the changed files
+        """
+        res = console.run(["git", "-C", self.watch_dir, "status", "--porcelain", "-z", "--untracked-files=all", "--no-renames", "--", path],
+                          text=False)
+        if res.returncode != 0:
+            self.git_log.log("Failed to get git status: {}".format(res.stderr.decode(errors="replace").strip()), "ERROR")
+            return []
+
+        files = []
+        for entry in res.stdout.split(b"\0"):
+            if len(entry) > 3:
+                file = os.path.join(self.watch_dir, os.fsdecode(entry[3:]))
+                if not (exclude and exclude(file)):
+                    files.append(file)
+        return files
+
+    def resync(self, path:str, exclude=None, reason:str="lost events"):
+        """
+        Commit every change under a directory, used after events for it were lost.
+        :param path: A directory inside the watched directory
+        :param exclude: Called with every changed file, it is not committed when it returns True
+        :param reason: Why the directory is rescanned, for the commit message
+        :return: True if the changes were committed or there were none, False otherwise.
+        """
+        with self.lock:
+            self.flush_commits()
+            # git status compares against the index, which the writer only updates at checkpoints
+            if self.writer:
+                self.writer.checkpoint()
+
+            files = self._changed_files(path, exclude)
+            if not files:
+                return True
+
+            message = "Resync of {} after {}, {} changed files\n\n{}\n".format(path, reason, len(files), "\n".join(files))
+
+            if not self._commit_files(message, files):
+                self.git_log.log("Failed to commit resync of {}".format(path), "ERROR")
+                return False
+
+            self.git_log.log("Resynced {} changed files under {}".format(len(files), path), "WARNING")
+            self._after_commit()
 
-    git_log.log("Backup created successfully")
+        return True
 
-    backup_count = len(os.listdir(os.path.join(config.BACKUP_DIR, git_dir_basename)))
+    def commit_offline(self, files:list) -> bool:
+        """
+        Commit the changes made while watchdir was not running in one commit, see reconcile.py.
+        :param files: Absolute paths of the changed files, deleted ones are removed from the repo
+        :return: True if the changes were committed, False otherwise.
+        """
+        with self.lock:
+            self.flush_commits()
+            message = "Offline changes while watchdir was not running, {} changed files\n\n{}\n".format(len(files), "\n".join(files))
 
-    if backup_count > 6:
-        oldest_backup = os.path.join(config.BACKUP_DIR, git_dir_basename, os.listdir(os.path.join(config.BACKUP_DIR, git_dir_basename))[0])
-        shutil.rmtree(oldest_backup)
-        git_log.log("Deleted oldest backup")
+            if not self._commit_files(message, files):
+                self.git_log.log("Failed to commit {} offline changes".format(len(files)), "ERROR")
+                self._commit_failed(files)
+                return False
 
+            self.git_log.log("Committed {} changes made while watchdir was not running".format(len(files)), "WARNING")
+            self._after_commit()
 
-    return True
+        return True
 
-COMMIT_COUNT = 0 # global variable
+    def object_count(self, max_age:float=60):
+        """
+        Count the objects in the repo, at most once every max_age seconds.
+        :param max_age: Seconds the last count is reused
+        :return: The number of loose and packed objects, None if git failed
+        """
+        checked, count = self._object_count
+        if time.time() - checked < max_age:
+            return count
+
+        res = console.run(["git", "--git-dir", self.repo_dir, "count-objects", "-v"])
+        count = None
+        if res.returncode == 0:
+            fields = dict(line.split(": ", 1) for line in res.stdout.splitlines() if ": " in line)
+            count = int(fields.get("count", 0)) + int(fields.get("in-pack", 0))
+        self._object_count = (time.time(), count)
+        return count
+
+    def maintain(self, kind:str=None) -> bool:
+        """
+        Repack the repo once loose objects or packs piled up, or once it is idle, see maintenance.py.
+        :param kind: maintenance.INCREMENTAL or maintenance.FULL to repack whatever the counts
+        :return: True if the repo was repacked or did not need it, False if git failed
+        """
+        before = maintenance.count_objects(self.repo_dir)
+        if before is None:
+            return False
+
+        idle = self.commits_since_repack > 0 and time.time() - self.last_commit >= config.MAINTENANCE_IDLE
+        kind = kind or maintenance.plan(before, max(0, before["loose"] - self.repacked_loose), idle,
+                                        config.MAINTENANCE_LOOSE_OBJECTS, config.MAINTENANCE_PACKS)
+        if not kind:
+            return True
+
+        # no commit is written while the repo is repacked, the pipeline queues the changes meanwhile
+        with self.lock:
+            if self.writer:
+                # fast-import looks objects up in the packs it wrote, a full repack replaces them,
+                # it is started again by the next commit
+                if kind == maintenance.FULL:
+                    self.writer.close()
+                else:
+                    self.writer.checkpoint()
+
+            start = time.time()
+            repacked = maintenance.repack(self.repo_dir, kind)
+            elapsed = time.time() - start
+            after = maintenance.count_objects(self.repo_dir)
+            if repacked:
+                self.commits_since_repack = 0
+                self.repacked_loose = after["loose"] if after else 0
+
+        metrics.REPACKS.inc(self.watch_dir, kind, "success" if repacked else "failure")
+        metrics.REPACK_SECONDS.inc(self.watch_dir, amount=elapsed)
+        if not repacked or after is None:
+            self.git_log.log("Failed to repack ({}) the git repo".format(kind), "ERROR")
+            return False
+
+        if kind == maintenance.FULL and self.policy:
+            self.prune_chunks()
+
+        reclaimed = maintenance.disk_usage(before) - maintenance.disk_usage(after)
+        metrics.REPACK_RECLAIMED.inc(self.watch_dir, amount=max(0, reclaimed))
+        self._object_count = (time.time(), after["loose"] + after["packed"])
+        self.git_log.log("Repacked ({}) in {:.2f}s: {} loose objects and {} packs before, {} and {} after, {:.1f} MiB reclaimed".format(
+            kind, elapsed, before["loose"], before["packs"], after["loose"], after["packs"], reclaimed / 1024 ** 2))
+        return True
 
-def commit(event, file):
-    if not os.path.isfile(file):
-        git_log.log("File does not exist: {}".format(file), "ERROR")
+    def prune_chunks(self) -> int:
+        """
+        Delete the chunks of large files that no commit of the repo or the snapshot store refers to, in both stores.
+        :return: The number of deleted chunks
+        """
+        referenced = set()
+        for git_dir in (self.repo_dir, self.backup_dir()):
+            if not os.path.isdir(git_dir):
+                continue
+            chunks = largefiles.referenced_chunks(git_dir)
+            if chunks is None:
+                self.git_log.log("Failed to list the chunks {} refers to, keeping every chunk".format(git_dir), "ERROR")
+                return 0
+            referenced |= chunks
+
+        deleted = self.policy.store.prune(referenced) + largefiles.ChunkStore(self.backup_chunks_dir()).prune(referenced)
+        if deleted:
+            self.git_log.log("Deleted {} chunks no commit refers to".format(deleted))
+        return deleted
+
+    def close(self):
+        """
+        Commit anything still queued, stop the git writer and close the git log.
+        """
+        self.flush_commits()
+        if self.writer:
+            with self.lock:
+                self.writer.close()
+        if self.fingerprints:
+            self.fingerprints.save()
+        if self.stat_index:
+            self.stat_index.save()
+        self.git_log.close()
+
+
+def process_alive(pid) -> bool:
+    """
+    :param pid: A process id, from a pid file or a restore marker
+    :return: True if the process is running, False otherwise.
+    """
+    if not isinstance(pid, int) or pid <= 0:
         return False
-
-    if not run_command_sudo("git -C {} add {}".format(config.WATCH_DIR, file)):
-        git_log.log("Failed to add file to git", "ERROR")
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        return True
+    except OSError:
         return False
+    return True
 
-    if not run_command_sudo_check("git -C {} commit -m '{} - {}'".format(config.WATCH_DIR, event, file), "nothing to commit"):
-        git_log.log("Failed to commit file to git", "ERROR")
-        return False
 
-    git_log.log("{} - {}".format(event, file))
+# One Repo per watched directory, in the order of config.ROOTS
+repos = []
 
-    global COMMIT_COUNT
 
-    COMMIT_COUNT += 1
+def init():
+    """
+    Create a Repo for every watched directory in config.ROOTS.
+    :return: The list of repos
+    """
+    global repos
+    repos = [Repo(root) for root in config.ROOTS]
+    return repos
 
-    if COMMIT_COUNT > 10:
-        backup_git_directory()
-        COMMIT_COUNT = 0
 
-    return True
+def close():
+    for repo in repos:
+        repo.close()
+
+
+# The functions below act on the first watched directory, for callers that only handle one
+
+
+def check_repo():
+    return repos[0].check_repo()
+
+
+def init_repo():
+    return repos[0].init_repo()
+
+
+def backup_git_directory():
+    return repos[0].backup_git_directory()
+
+
+def commit(event, file, details=None):
+    return repos[0].commit(event, file, details)
+
+
+def flush_commits():
+    return repos[0].flush_commits()
+
+
+def resync(path:str, exclude=None, reason:str="lost events"):
+    return repos[0].resync(path, exclude, reason)
@@ -0,0 +1,361 @@
+"""
+Long lived git writer.
+
+Keeps a single `git fast-import` process open for the lifetime of the daemon. Blobs and commits are
+streamed into it, so committing a change costs no process startup and no index rewrite. The branch ref
+is only updated at checkpoints, after which the index entries of the paths the checkpoint committed are
+updated to match.
+
+Commits streamed since the last checkpoint are lost if fast-import dies or the branch was moved behind its
+back. Their files are then committed again with their current content on top of the branch, and if even
+that fails they are passed to on_lost, so the indexes of the repo don't treat them as committed.
+"""
+
+from util import log
+from console import run_command_sudo
+import console
+import hashlib
+import os
+import stat
+import subprocess
+import threading
+import time
+
+
+COMMITTER = "watchdir <admin@admin.com>"
+NULL_SHA = b"0" * 40
+
+
+def _quote_path(path:str) -> bytes:
+    """
+    Quote a path for the fast-import stream, only needed for paths starting with a quote or containing newlines.
+    :param path: The path relative to the work tree
+    :return: The path as it should be written to the stream
+    """
+    raw = os.fsencode(path)
+    if not raw.startswith(b'"') and b"\n" not in raw:
+        return raw
+
+    escaped = raw.replace(b"\\", b"\\\\").replace(b'"', b'\\"').replace(b"\n", b"\\n")
+    return b'"' + escaped + b'"'
+
+
+def blob_sha(content:bytes) -> str:
+    """
+    Compute the git object id of a blob.
+    :param content: The content of the blob
+    :return: The hex sha1 git would give the blob
+    """
+    return hashlib.sha1(b"blob " + str(len(content)).encode() + b"\0" + content).hexdigest()
+
+
+def _data(content:bytes) -> bytes:
+    return b"data " + str(len(content)).encode() + b"\n" + content + b"\n"
+
+
+class GitWriter:
+    """
+    Streams commits into a repo through one `git fast-import` process.
+    """
+
+    def __init__(self, git_dir:str, work_tree:str, branch:str="main", checkpoint_interval:float=30, policy=None):
+        """
+        :param git_dir: The git directory of the repo
+        :param work_tree: The watched directory, paths are committed relative to it
+        :param branch: The branch commits are added to
+        :param checkpoint_interval: Seconds after a commit before the branch ref is updated
+        :param policy: A largefiles.FilePolicy, files it does not store in full are committed as its stubs
+        """
+        self.git_dir = git_dir
+        self.work_tree = work_tree
+        self.branch = branch
+        self.ref = "refs/heads/{}".format(branch)
+        self.checkpoint_interval = checkpoint_interval
+        self.policy = policy
+        # called with (sha, files, time) for every commit once it is on the branch
+        self.on_commit = None
+        # called with the files of commits that never reached the branch and could not be committed again
+        self.on_lost = None
+        # mark -> files and time of the commits streamed since the last checkpoint
+        self.marks = {}
+        # the commit the index of the work tree matches, None refreshes the whole index at the next checkpoint
+        self.index_tip = None
+        # set while lost commits are streamed again, they are not retried a second time
+        self.restreaming = False
+        self.process = None
+        self.lock = threading.RLock()
+        self.timer = None
+        self.mark = 0
+        self.checkpointed_mark = 0
+        self.commits = 0
+
+    def _tip(self):
+        res = console.run(["git", "--git-dir", self.git_dir, "rev-parse", "--verify", "-q", self.ref + "^{commit}"])
+        return res.stdout.strip() if res.returncode == 0 else None
+
+    def start(self):
+        """
+        Start the fast-import process.
+        :return: True if the process is running, False otherwise.
+        """
+        with self.lock:
+            if self.process and self.process.poll() is None:
+                return True
+
+            self.parent = self._tip()
+            try:
+                self.process = subprocess.Popen(["git", "--git-dir", self.git_dir, "fast-import", "--quiet", "--date-format=raw"],
+                                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            except OSError as e:
+                log("Failed to start git fast-import: {}".format(e), "ERROR")
+                self.process = None
+                return False
+
+            self.mark = 0
+            self.checkpointed_mark = 0
+            self.marks = {}
+            # a previous process may have died between a checkpoint and the index update
+            self.index_tip = None
+            return True
+
+    def _head(self):
+        # the last streamed commit, or the branch tip before anything was streamed
+        if self.mark:
+            return ":{}".format(self.mark)
+        return self.parent
+
+    def _ls(self, head:str, relative:str):
+        """
+        Ask fast-import for the mode and object id of a path in a commit.
+        :return: (mode, sha), or None if the path is not in the commit
+        """
+        self.process.stdin.write(b"ls " + head.encode() + b" " + _quote_path(relative) + b"\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline().decode(errors="replace")
+        if line.startswith("missing "):
+            return None
+
+        fields = line.split(None, 3)
+        if len(fields) < 3:
+            return None
+        return fields[0], fields[2]
+
+    def _file_command(self, path:str, head:str) -> bytes:
+        relative = os.path.relpath(path, self.work_tree)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            if head and self._ls(head, relative) is None:
+                return b""
+            return b"D " + _quote_path(relative) + b"\n"
+
+        try:
+            if stat.S_ISLNK(st.st_mode):
+                mode = b"120000"
+                content = os.fsencode(os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                mode = b"100755" if st.st_mode & stat.S_IXUSR else b"100644"
+                content = self.policy.content(path, st) if self.policy else None
+                if content is None:
+                    with open(path, "rb") as f:
+                        content = f.read()
+            else:
+                return b""
+        except OSError as e:
+            log("Failed to read {}: {}".format(path, e), "ERROR")
+            return b""
+
+        # skip files whose content and mode are already committed, like `git commit` reporting nothing to commit
+        if head and self._ls(head, relative) == (mode.decode(), blob_sha(content)):
+            return b""
+
+        return b"M " + mode + b" inline " + _quote_path(relative) + b"\n" + _data(content)
+
+    def commit(self, message:str, files:list) -> bool:
+        """
+        Commit the current content of files. Files that no longer exist are removed from the tree.
+        :param message: The commit message
+        :param files: Absolute paths of the changed files
+        :return: True if the commit was streamed or there was nothing to commit, False otherwise.
+        """
+        with self.lock:
+            # fast-import exited since the last commit, what it did not checkpoint is streamed again first
+            if self.process and self.process.poll() is not None:
+                self._lost("git fast-import exited")
+            if not self.start():
+                return False
+
+            head = self._head()
+            commands = []
+            try:
+                for file in files:
+                    command = self._file_command(file, head)
+                    if command:
+                        commands.append(command)
+            except (BrokenPipeError, OSError) as e:
+                log("git fast-import stopped: {}".format(e), "ERROR")
+                self._lost("git fast-import stopped")
+                return False
+
+            if not commands:
+                return True
+
+            self.mark += 1
+            stream = [
+                "commit {}\n".format(self.ref).encode(),
+                "mark :{}\n".format(self.mark).encode(),
+                "committer {} {} +0000\n".format(COMMITTER, int(time.time())).encode(),
+                _data(message.encode()),
+            ]
+            # fast-import continues from its own tip after the first commit
+            if self.parent:
+                stream.append("from {}\n".format(self.parent).encode())
+                self.parent = None
+            stream.extend(commands)
+            stream.append(b"\n")
+
+            try:
+                self.process.stdin.write(b"".join(stream))
+            except (BrokenPipeError, OSError) as e:
+                log("git fast-import stopped: {}".format(e), "ERROR")
+                # this commit is reported as failed, the ones before it are streamed again
+                self.mark -= 1
+                self._lost("git fast-import stopped")
+                return False
+
+            self.marks[self.mark] = (files, time.time())
+            self.commits += 1
+            self._schedule_checkpoint()
+            return True
+
+    def _schedule_checkpoint(self):
+        if self.timer is not None:
+            return
+
+        self.timer = threading.Timer(self.checkpoint_interval, self.checkpoint)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def checkpoint(self) -> bool:
+        """
+        Make fast-import write its pack and update the branch, then refresh the index of the work tree.
+        :return: True if the branch points at the last streamed commit, False otherwise.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if not self.process or self.mark == self.checkpointed_mark:
+                return True
+
+            marks = range(self.checkpointed_mark + 1, self.mark + 1) if self.on_commit else [self.mark]
+            try:
+                # get-mark prints the sha of each commit, progress echoes back once the checkpoint is done
+                self.process.stdin.write(b"checkpoint\n" + "".join("get-mark :{}\n".format(mark) for mark in marks).encode() +
+                                         "progress checkpoint {}\n".format(self.mark).encode())
+                self.process.stdin.flush()
+                shas = [self.process.stdout.readline().decode().strip() for _ in marks]
+                self.process.stdout.readline()
+            except (BrokenPipeError, OSError) as e:
+                log("git fast-import stopped: {}".format(e), "ERROR")
+                return self._lost("git fast-import stopped")
+
+            sha = shas[-1]
+
+            # fast-import refuses to move a branch that was changed behind its back (a manual reset for example),
+            # start over from the new tip so the next commit builds on it
+            if self._tip() != sha:
+                log("{} was changed outside of watchdir, restarting git writer".format(self.branch), "WARNING")
+                return self._lost("{} was changed outside of watchdir".format(self.branch))
+
+            self.checkpointed_mark = self.mark
+            # The branch moved without touching the index, bring it up to date so `git status` stays meaningful
+            self._sync_index(sha)
+
+            if self.on_commit:
+                for mark, commit_sha in zip(marks, shas):
+                    files, when = self.marks.get(mark, ([], time.time()))
+                    self.on_commit(commit_sha, files, when)
+            self.marks = {}
+            return True
+
+    def _sync_index(self, sha:str):
+        """
+        Update the index of the work tree to the branch, which fast-import moved without touching it.
+        Only the paths changed since the last update are written, the index entries get no stat data so
+        `git status` checks just those files. The first update after a start refreshes the whole index.
+        :param sha: The commit the branch points at
+        """
+        if self.index_tip is not None:
+            res = console.run(["git", "--git-dir", self.git_dir, "diff-tree", "-r", "-z", "--no-renames", self.index_tip, sha], text=False)
+            if res.returncode == 0:
+                fields = res.stdout.split(b"\0")
+                entries = []
+                for header, path in zip(fields[0::2], fields[1::2]):
+                    # :<old mode> <new mode> <old sha> <new sha> <status>
+                    _, mode, _, new_sha, status = header.lstrip(b":").split(b" ")
+                    if status == b"D":
+                        entries.append(b"0 " + NULL_SHA + b"\t" + path)
+                    else:
+                        entries.append(mode + b" " + new_sha + b"\t" + path)
+
+                if not entries or console.run(["git", "-C", self.work_tree, "update-index", "-z", "--index-info"], sudo=True,
+                                              input=b"\0".join(entries) + b"\0", text=False).returncode == 0:
+                    self.index_tip = sha
+                    return
+
+        if run_command_sudo(["git", "-C", self.work_tree, "reset", "-q"]):
+            self.index_tip = sha
+
+    def _lost(self, reason:str) -> bool:
+        """
+        The commits streamed since the last checkpoint never reached the branch. Commit their files again with
+        their current content on top of the branch, or pass them to on_lost if that fails too.
+        :param reason: Why they were lost, for the commit message
+        :return: True if they were committed again, False otherwise.
+        """
+        files = []
+        for mark in sorted(self.marks):
+            files.extend(self.marks[mark][0])
+        files = list(dict.fromkeys(files))
+        self.marks = {}
+        self.checkpointed_mark = self.mark
+        self._stop()
+
+        # lost again while they are streamed again, the first call reports them
+        if not files or self.restreaming:
+            return False
+
+        self.restreaming = True
+        try:
+            message = "Recommit of {} files after {}\n\n{}\n".format(len(files), reason, "\n".join(files))
+            if self.commit(message, files) and self.checkpoint():
+                log("Committed {} files again after {}".format(len(files), reason), "WARNING")
+                return True
+        finally:
+            self.restreaming = False
+
+        log("Lost the commits of {} files after {}".format(len(files), reason), "ERROR")
+        if self.on_lost:
+            self.on_lost(files)
+        return False
+
+    def _stop(self):
+        if not self.process:
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait(30)
+        except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+    def close(self):
+        """
+        Checkpoint and stop the fast-import process.
+        """
+        with self.lock:
+            self.checkpoint()
+            self._stop()
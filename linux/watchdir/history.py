@@ -0,0 +1,353 @@
+"""
+Indexed history of every change watchdir handled.
+
+Each change that reaches log_change is recorded in an SQLite database (WAL mode, so queries never block the
+writer) with its time, path, event, the commit it ended up in and the process the audit log attributed it to.
+The database is indexed on path and time, so the timeline of a path or everything in a time range is a
+single index lookup however long watchdir has been running.
+
+Recording a change only puts it on a queue; one writer thread inserts what is queued in a single transaction
+every second or every BATCH_SIZE rows, so the pipeline never waits for the disk. Commit ids are filled in
+once the commit is on the branch, see git_utils.Repo.on_commit.
+
+    python3 main.py history timeline /etc/passwd --since "2026-10-18 02:00" --until "2026-10-18 02:15"
+    python3 main.py history churn --top 20 --since 1d
+    python3 main.py history export --since 2h --format csv > changes.csv
+"""
+
+from util import log, exit_with_error
+import argparse
+import config
+import csv
+import json
+import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+
+BATCH_SIZE = 500
+# changes waiting for the writer before new ones are dropped
+MAX_QUEUE = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    event TEXT NOT NULL,
+    old_path TEXT,
+    commit_id TEXT,
+    pid INTEGER,
+    uid INTEGER,
+    auid INTEGER,
+    exe TEXT,
+    comm TEXT
+);
+CREATE INDEX IF NOT EXISTS events_path_time ON events (path, time);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+"""
+
+COLUMNS = ("time", "root", "path", "event", "old_path", "commit_id", "pid", "uid", "auid", "exe", "comm")
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def connect(db_file:str) -> sqlite3.Connection:
+    """
+    Open the database, creating it if needed.
+    :param db_file: The database file
+    :return: The connection
+    """
+    connection = sqlite3.connect(db_file, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    # a crash can lose the last transactions but never corrupts the database
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class History:
+    """
+    Records changes from any thread, a writer thread inserts them in batches.
+    """
+
+    def __init__(self, db_file:str, batch_size:int=BATCH_SIZE, flush_interval:float=1, max_queue:int=MAX_QUEUE):
+        """
+        :param db_file: The database file
+        :param batch_size: Rows inserted in one transaction at most
+        :param flush_interval: Seconds a row waits at most before it is inserted
+        :param max_queue: Rows waiting before new ones are dropped
+        """
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+
+        self.recorded = 0
+        self.dropped = 0
+        self.batches = 0
+        self.linked = 0
+        self.write_time = 0.0
+
+    def start(self) -> bool:
+        """
+        Open the database and start the writer thread.
+        :return: True if the database is open, False otherwise.
+        """
+        try:
+            connect(self.db_file).close()
+        except sqlite3.Error as e:
+            log("Failed to open history database {}: {}".format(self.db_file, e), "ERROR")
+            return False
+
+        self.thread = threading.Thread(target=self._run, name="history", daemon=True)
+        self.thread.start()
+        return True
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def record(self, root:str, event:str, path:str, old_path:str=None, process:dict=None, when:float=None):
+        """
+        Record a change.
+        :param root: The watched directory
+        :param event: The event, e.g. MODIFIED or CREATE
+        :param path: The changed file
+        :param old_path: Where the file was before, for renames
+        :param process: The process from audit_log.AuditTail.lookup, if known
+        :param when: When the change was seen, defaults to now
+        """
+        process = process or {}
+        self._put(("event", (when or time.time(), root, path, event, old_path, None, _int(process.get("pid")),
+                             _int(process.get("uid")), _int(process.get("auid")), process.get("exe"), process.get("comm"))))
+
+    def link_commit(self, sha:str, files:list, when:float):
+        """
+        Set the commit of the changes of files recorded before it was made that have none yet.
+        :param sha: The commit
+        :param files: The files in the commit
+        :param when: When the commit was made
+        """
+        self._put(("commit", (sha, list(files), when)))
+
+    def _write(self, connection:sqlite3.Connection, items:list):
+        start = time.time()
+        with connection:
+            rows = [row for kind, row in items if kind == "event"]
+            if rows:
+                connection.executemany("INSERT INTO events ({}) VALUES ({})".format(", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), rows)
+                self.recorded += len(rows)
+
+            for kind, (sha, files, when) in (item for item in items if item[0] == "commit"):
+                connection.executemany("UPDATE events SET commit_id = ? WHERE path = ? AND time <= ? AND commit_id IS NULL",
+                                       [(sha, file, when) for file in files])
+                self.linked += len(files)
+
+        self.batches += 1
+        self.write_time += time.time() - start
+
+    def _run(self):
+        connection = connect(self.db_file)
+        stop = False
+        while not stop:
+            items = []
+            deadline = time.time() + self.flush_interval
+            while len(items) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+
+            if items:
+                try:
+                    self._write(connection, items)
+                except sqlite3.Error as e:
+                    log("Failed to write history: {}".format(e), "ERROR")
+        connection.close()
+
+    def stats(self) -> dict:
+        """
+        :return: Rows recorded and dropped, commits linked, batches written and their average time
+        """
+        return {
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize(),
+            "linked": self.linked,
+            "batches": self.batches,
+            "avg_batch_ms": self.write_time / self.batches * 1000 if self.batches else 0.0,
+        }
+
+    def close(self):
+        """
+        Write everything still queued and close the database.
+        """
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+_RELATIVE = re.compile(r"^(\d+(?:\.\d+)?)\s*([smhdw])$")
+_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_time(value:str) -> float:
+    """
+    :param value: Seconds since the epoch, a local time like "2026-10-18 02:00[:00]", or a duration ago like 30m, 2h or 1d
+    :return: Seconds since the epoch
+    """
+    value = value.strip()
+    match = _RELATIVE.match(value)
+    if match:
+        return time.time() - float(match.group(1)) * _UNITS[match.group(2)]
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError("Unknown time: {}".format(value))
+
+
+def _range(since:float=None, until:float=None) -> tuple:
+    clauses, params = [], []
+    if since is not None:
+        clauses.append("time >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("time <= ?")
+        params.append(until)
+    return clauses, params
+
+
+def timeline(connection:sqlite3.Connection, path:str, since:float=None, until:float=None, limit:int=None):
+    """
+    :return: The recorded changes of a path, or of everything under it, oldest first, as dicts
+    """
+    clauses, params = _range(since, until)
+    # a directory covers everything under it, still an index range scan
+    clauses.insert(0, "(path = ? OR (path >= ? AND path < ?))")
+    prefix = path.rstrip("/") + "/"
+    params[:0] = [path, prefix, prefix[:-1] + "0"]
+
+    sql = "SELECT {} FROM events WHERE {} ORDER BY time".format(", ".join(COLUMNS), " AND ".join(clauses))
+    if limit:
+        sql += " LIMIT {}".format(int(limit))
+    for row in connection.execute(sql, params):
+        yield dict(zip(COLUMNS, row))
+
+
+def churn(connection:sqlite3.Connection, top:int=20, since:float=None, until:float=None) -> list:
+    """
+    :return: (path, changes, last change) of the most changed paths
+    """
+    clauses, params = _range(since, until)
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
+    return connection.execute("SELECT path, COUNT(*), MAX(time) FROM events {} GROUP BY path ORDER BY COUNT(*) DESC LIMIT ?".format(where),
+                              params + [top]).fetchall()
+
+
+def export(connection:sqlite3.Connection, since:float=None, until:float=None):
+    """
+    :return: Every recorded change in a time range, oldest first, as dicts
+    """
+    clauses, params = _range(since, until)
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
+    for row in connection.execute("SELECT {} FROM events {} ORDER BY time".format(", ".join(COLUMNS), where), params):
+        yield dict(zip(COLUMNS, row))
+
+
+def _format_time(timestamp:float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def _write_rows(rows, fmt:str):
+    if fmt == "jsonl":
+        for row in rows:
+            sys.stdout.write(json.dumps(row) + "\n")
+    elif fmt == "csv":
+        writer = csv.DictWriter(sys.stdout, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            line = "{} {:<10} {}".format(_format_time(row["time"]), row["event"], row["path"])
+            if row["old_path"]:
+                line += " (from {})".format(row["old_path"])
+            if row["commit_id"]:
+                line += " commit {}".format(row["commit_id"][:10])
+            if row["pid"] is not None:
+                line += " [pid={} uid={} exe={}]".format(row["pid"], row["uid"], row["exe"])
+            sys.stdout.write(line + "\n")
+
+
+def parse_args(argv:list):
+    parser = argparse.ArgumentParser(prog="main.py history", description="Query the history of changes recorded by watchdir.")
+    parser.add_argument("--db", default=None, help="The history database (default: {} in LOG_DIR)".format(config.HISTORY_DB))
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser("timeline", help="Changes of a file, or of everything under a directory")
+    command.add_argument("path")
+    command.add_argument("--limit", type=int, default=None)
+    command.add_argument("--format", choices=["text", "jsonl", "csv"], default="text")
+
+    command = commands.add_parser("churn", help="The most changed paths")
+    command.add_argument("--top", type=int, default=20)
+
+    command = commands.add_parser("export", help="Every change in a time range")
+    command.add_argument("--format", choices=["text", "jsonl", "csv"], default="jsonl")
+
+    for command in commands.choices.values():
+        command.add_argument("--since", default=None, help="Seconds since the epoch, \"2026-10-18 02:00\", or 30m/2h/1d ago")
+        command.add_argument("--until", default=None, help="Same formats as --since")
+    return parser.parse_args(argv)
+
+
+def main(argv:list):
+    args = parse_args(argv)
+    db_file = args.db or os.path.join(config.LOG_DIR, config.HISTORY_DB)
+    if not os.path.isfile(db_file):
+        exit_with_error("History database does not exist: {}".format(db_file))
+
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until) if args.until else None
+    except ValueError as e:
+        exit_with_error(str(e))
+
+    connection = connect(db_file)
+    try:
+        if args.command == "timeline":
+            _write_rows(timeline(connection, os.path.abspath(args.path), since, until, args.limit), args.format)
+        elif args.command == "churn":
+            for path, count, last in churn(connection, args.top, since, until):
+                print("{:>8} {} {}".format(count, _format_time(last), path))
+        else:
+            _write_rows(export(connection, since, until), args.format)
+    finally:
+        connection.close()
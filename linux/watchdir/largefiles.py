@@ -0,0 +1,432 @@
+"""
+Storage policy for large and binary files.
+
+Committing every version of a growing log, a database or a disk image as a full git blob makes the repo and
+its backups grow without limit and every commit of such a file slow. A FilePolicy decides per file how it
+is stored, from gitignore style patterns and its size:
+
+- full: the file is committed as it is, the default for small files
+- meta: only its size and sha256 are committed, changes are seen but the content is not kept
+- chunked: the content is split into chunks at content defined boundaries, the chunks are kept in a
+  deduplicated ChunkStore next to the repo and only the list of chunks is committed. Appending to a file or
+  editing a few bytes of it only stores the chunks around the change.
+
+meta and chunked files are committed as a small text stub in place of their content, see parse_stub.
+
+The history of the repo is never rewritten, so every chunk a commit refers to is kept for as long as the
+repo. Each backup links the chunks into the snapshot store, which then restores without the live store.
+A full repack deletes the chunks no stub refers to, left by commits that failed or were lost.
+
+Chunk boundaries are found without a byte by byte loop in Python: the content is translated to a map of
+"anchor" bytes with bytes.translate, and a chunk ends after the first run of anchors found with bytes.find
+once the chunk is at least MIN_CHUNK long. Since the boundaries only depend on the bytes around them, an
+insertion only changes the chunks next to it.
+"""
+
+from util import log
+import hashlib
+import os
+import pathfilter
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+import zlib
+
+
+FULL = "full"
+META = "meta"
+CHUNKED = "chunked"
+MODES = (FULL, META, CHUNKED)
+
+MIN_CHUNK = 32 * 1024
+MAX_CHUNK = 512 * 1024
+# content read at once when chunking
+READ_SIZE = 8 * 1024 * 1024
+
+# 40 of the 256 byte values are anchors, picked by their hash so text and binary files both have some
+_ANCHOR = bytes(1 if hashlib.sha1(bytes([b])).digest()[0] < 32 else 0 for b in range(256))
+# the longest run found in a chunk ends it, shorter runs are only used when there is no longer one
+_RUNS = (b"\x01" * 5, b"\x01" * 3, b"\x01")
+
+STUB_HEADER = b"watchdir large file v1\n"
+
+
+def _boundary(marks:bytes, start:int, end:int) -> int:
+    """
+    :return: Where the chunk starting at start ends, end if there is no anchor before it
+    """
+    if end - start <= MIN_CHUNK:
+        return end
+
+    for run in _RUNS:
+        index = marks.find(run, start + MIN_CHUNK - len(run), min(end, start + MAX_CHUNK))
+        if index >= 0:
+            return index + len(run)
+    return min(end, start + MAX_CHUNK)
+
+
+def iter_chunks(f):
+    """
+    Split the content of a file into content defined chunks.
+    :param f: The file, opened in binary mode
+    :return: A generator of chunks, bytes between MIN_CHUNK and MAX_CHUNK long except for the last one
+    """
+    data = b""
+    eof = False
+    while not eof:
+        block = f.read(READ_SIZE)
+        eof = not block
+        data += block
+        marks = data.translate(_ANCHOR)
+
+        start = 0
+        # a chunk ending before MAX_CHUNK from the end of the data read so far could still grow
+        while len(data) - start >= MAX_CHUNK or (eof and start < len(data)):
+            end = _boundary(marks, start, len(data))
+            yield data[start:end]
+            start = end
+        data = data[start:]
+
+
+class ChunkStore:
+    """
+    Content addressed store of zlib compressed chunks, each chunk is kept once however many files and
+    versions contain it.
+    """
+
+    def __init__(self, directory:str):
+        """
+        :param directory: Where the chunks are kept, in subdirectories named after the first 2 hex digits of their sha256
+        """
+        self.directory = directory
+        self.written = 0
+        self.written_bytes = 0
+        self.deduplicated = 0
+        self.deduplicated_bytes = 0
+
+    def _path(self, digest:str) -> str:
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def put(self, chunk:bytes) -> str:
+        """
+        Store a chunk, unless it is already stored.
+        :param chunk: The content
+        :return: Its sha256, in hex
+        """
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._path(digest)
+        try:
+            # touched so prune keeps it until the stub that uses it again is committed
+            os.utime(path)
+            self.deduplicated += 1
+            self.deduplicated_bytes += len(chunk)
+            return digest
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first, a chunk is either complete or missing
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(zlib.compress(chunk, 1))
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+        self.written += 1
+        self.written_bytes += len(chunk)
+        return digest
+
+    def get(self, digest:str) -> bytes:
+        """
+        :param digest: The sha256 of a chunk, in hex
+        :return: The content of the chunk
+        """
+        with open(self._path(digest), "rb") as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise ValueError("Chunk {} is corrupt".format(digest))
+        return chunk
+
+    def digests(self) -> set:
+        """
+        :return: The sha256 of every stored chunk, in hex
+        """
+        digests = set()
+        try:
+            prefixes = os.listdir(self.directory)
+        except OSError:
+            return digests
+
+        for prefix in prefixes:
+            try:
+                names = os.listdir(os.path.join(self.directory, prefix))
+            except OSError:
+                continue
+            digests.update(prefix + name for name in names if not name.startswith("."))
+        return digests
+
+    def backup(self, directory:str) -> int:
+        """
+        Copy the chunks another store does not have yet to it. Chunks never change once written, they are hard
+        linked when both stores are on the same filesystem.
+        :param directory: The directory of the other store
+        :return: The number of chunks copied
+        """
+        target = ChunkStore(directory)
+        copied = 0
+        for digest in self.digests() - target.digests():
+            source = self._path(digest)
+            path = target._path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(source, path)
+            except FileExistsError:
+                continue
+            except OSError:
+                # another filesystem, a chunk is either complete or missing
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+                try:
+                    with os.fdopen(fd, "wb") as f, open(source, "rb") as src:
+                        shutil.copyfileobj(src, f)
+                    os.replace(tmp, path)
+                except OSError:
+                    os.unlink(tmp)
+                    raise
+            copied += 1
+        return copied
+
+    def prune(self, referenced:set, expire:float=3600) -> int:
+        """
+        Delete the chunks no stub refers to. A chunk is written before the stub that refers to it is committed,
+        chunks written or reused less than expire seconds ago are kept.
+        :param referenced: The sha256 of every chunk that is still needed, see referenced_chunks
+        :param expire: Seconds an unreferenced chunk is kept
+        :return: The number of deleted chunks
+        """
+        cutoff = time.time() - expire
+        deleted = 0
+        for digest in self.digests() - referenced:
+            path = self._path(digest)
+            try:
+                if os.lstat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    deleted += 1
+            except OSError:
+                continue
+        return deleted
+
+    def stats(self) -> dict:
+        """
+        :return: Chunks and bytes written, and chunks and bytes that were already stored
+        """
+        return {
+            "written": self.written,
+            "written_bytes": self.written_bytes,
+            "deduplicated": self.deduplicated,
+            "deduplicated_bytes": self.deduplicated_bytes,
+        }
+
+
+def make_stub(mode:str, size:int, digest:str, chunks:list=()) -> bytes:
+    """
+    :param mode: META or CHUNKED
+    :param size: The size of the file
+    :param digest: The sha256 of the whole file, in hex
+    :param chunks: (sha256, length) of every chunk, in order
+    :return: The stub committed in place of the file
+    """
+    lines = ["policy {}".format(mode), "size {}".format(size), "sha256 {}".format(digest)]
+    lines.extend("chunk {} {}".format(chunk, length) for chunk, length in chunks)
+    return STUB_HEADER + "\n".join(lines).encode() + b"\n"
+
+
+def parse_stub(content:bytes):
+    """
+    Parse the stub committed in place of a meta or chunked file.
+    :param content: The committed content
+    :return: A dict with policy, size, sha256 and chunks ((sha256, length) list), or None if the content is not a stub
+    """
+    if not content.startswith(STUB_HEADER):
+        return None
+
+    stub = {"chunks": []}
+    for line in content[len(STUB_HEADER):].decode(errors="replace").splitlines():
+        key, _, value = line.partition(" ")
+        if key == "chunk":
+            digest, _, length = value.partition(" ")
+            stub["chunks"].append((digest, int(length)))
+        elif key == "size":
+            stub["size"] = int(value)
+        else:
+            stub[key] = value
+    return stub
+
+
+def referenced_chunks(git_dir:str):
+    """
+    Find the chunks the stubs in a repo refer to. Every blob of the repo is read, it is meant for the occasional
+    full repack.
+    :param git_dir: The git directory
+    :return: The sha256 of every chunk referred to, in hex, or None if git failed
+    """
+    try:
+        process = subprocess.Popen(["git", "--git-dir", git_dir, "cat-file", "--batch-all-objects", "--unordered",
+                                    "--batch=%(objecttype) %(objectsize)"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    except OSError as e:
+        log("Failed to start git cat-file: {}".format(e), "ERROR")
+        return None
+
+    digests = set()
+    with process.stdout as out:
+        for header in iter(out.readline, b""):
+            kind, _, size = header.partition(b" ")
+            remaining = int(size) + 1
+            # only the start of a blob tells if it is a stub, the rest of the others is skipped
+            content = out.read(min(len(STUB_HEADER), remaining))
+            remaining -= len(content)
+            if kind == b"blob" and content == STUB_HEADER:
+                content += out.read(remaining)
+                digests.update(digest for digest, _ in parse_stub(content[:-1])["chunks"])
+                continue
+            while remaining > 0:
+                block = out.read(min(READ_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+
+    if process.wait() != 0:
+        log("Failed to list the objects of {}".format(git_dir), "ERROR")
+        return None
+    return digests
+
+
+def write_content(stub:dict, store:ChunkStore, f) -> bool:
+    """
+    Write the content of a chunked file back from its stub.
+    :param stub: The parsed stub, see parse_stub
+    :param store: The ChunkStore holding its chunks
+    :param f: The file to write to, opened in binary mode
+    :return: True if the content was written and matches its sha256, False if the file was only tracked by its metadata
+    """
+    if stub.get("policy") != CHUNKED:
+        return False
+
+    digest = hashlib.sha256()
+    for chunk_digest, _ in stub["chunks"]:
+        chunk = store.get(chunk_digest)
+        digest.update(chunk)
+        f.write(chunk)
+
+    if digest.hexdigest() != stub.get("sha256"):
+        raise ValueError("Content does not match its sha256 {}".format(stub.get("sha256")))
+    return True
+
+
+class FilePolicy:
+    """
+    Decides how each file of a watched directory is stored, and builds the stubs of meta and chunked files.
+    """
+
+    def __init__(self, watch_dir:str, store_dir:str, rules:dict=None, large_size:int=0, large_mode:str=CHUNKED):
+        """
+        :param watch_dir: The watched directory, patterns are relative to it
+        :param store_dir: The directory of the ChunkStore
+        :param rules: mode -> gitignore style patterns. A file matching patterns of several modes uses the first of
+                      full, meta and chunked
+        :param large_size: Files larger than this many bytes that match no pattern use large_mode, 0 stores them in full
+        :param large_mode: The mode of large files
+        """
+        self.large_size = large_size
+        self.large_mode = large_mode
+        self.store = ChunkStore(store_dir)
+        self.filters = []
+        for mode in MODES:
+            patterns = (rules or {}).get(mode) or []
+            if patterns:
+                # only the patterns, the default excludes of the watcher would match every file below /run or /proc
+                path_filter = pathfilter.PathFilter(watch_dir, rules=[], absolute_excludes=[])
+                for pattern in patterns:
+                    path_filter.add_rule(pattern)
+                path_filter.compile()
+                self.filters.append((mode, path_filter))
+
+        self.files = {mode: 0 for mode in MODES}
+
+    def enabled(self) -> bool:
+        """
+        :return: True if some files may not be stored in full
+        """
+        return bool(self.filters) or (self.large_size > 0 and self.large_mode != FULL)
+
+    def mode(self, path:str, st:os.stat_result) -> str:
+        """
+        :param path: The absolute path of the file
+        :param st: Its lstat result
+        :return: FULL, META or CHUNKED
+        """
+        if not stat.S_ISREG(st.st_mode):
+            return FULL
+
+        for mode, path_filter in self.filters:
+            if path_filter.excluded(path):
+                return mode
+
+        if self.large_size > 0 and st.st_size > self.large_size:
+            return self.large_mode
+        return FULL
+
+    def content(self, path:str, st:os.stat_result):
+        """
+        Build what is committed for a file that is not stored in full.
+        :param path: The absolute path of the file
+        :param st: Its lstat result
+        :return: The stub, or None if the file is stored in full
+        """
+        mode = self.mode(path, st)
+        self.files[mode] += 1
+        if mode == FULL:
+            return None
+
+        digest = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, "rb") as f:
+            if mode == CHUNKED:
+                for chunk in iter_chunks(f):
+                    digest.update(chunk)
+                    chunks.append((self.store.put(chunk), len(chunk)))
+                    size += len(chunk)
+            else:
+                while True:
+                    block = f.read(READ_SIZE)
+                    if not block:
+                        break
+                    digest.update(block)
+                    size += len(block)
+
+        return make_stub(mode, size, digest.hexdigest(), chunks)
+
+    def stats(self) -> dict:
+        """
+        :return: Files seen per mode, and the chunk store counters
+        """
+        stats = dict(self.files)
+        stats.update(self.store.stats())
+        return stats
+
+
+def load_policy(watch_dir:str, store_dir:str, rules:dict, large_size:int, large_mode:str):
+    """
+    :return: A FilePolicy, or None if every file is stored in full
+    """
+    if large_mode not in MODES:
+        log("Unknown large file mode {}, storing large files in full".format(large_mode), "WARNING")
+        large_mode = FULL
+
+    policy = FilePolicy(watch_dir, store_dir, rules, large_size, large_mode)
+    return policy if policy.enabled() else None
@@ -1,106 +1,318 @@
 import time
-import hashlib
-from collections import deque
 import threading
 import datetime
+import argparse
+import gzip
 import os
+import queue
+import re
+import shutil
+import sys
+import metrics
+
+
+# Rotated segments of a log file are named <log file>.<time>[.<n>][.gz], n only when several rotations share a second
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+_SEGMENT = re.compile(r"\.(\d{8}-\d{6})(?:\.(\d+))?(\.gz)?")
+
+
+def segments(log_file):
+    """
+    List the rotated segments of a log file.
+    :param log_file: The log file
+    :return: The paths of its segments, oldest first
+    """
+    directory, name = os.path.split(log_file)
+    try:
+        entries = os.listdir(directory or ".")
+    except OSError:
+        return []
+
+    found = {}
+    for entry in entries:
+        match = _SEGMENT.fullmatch(entry[len(name):]) if entry.startswith(name + ".") else None
+        if match:
+            key = (match.group(1), int(match.group(2) or 0))
+            # while a segment is compressed both files exist, the plain one is complete
+            if key not in found or not match.group(3):
+                found[key] = os.path.join(directory, entry)
+    return [found[key] for key in sorted(found)]
+
+
+def read_lines(log_file):
+    """
+    Stream the lines of a log file across its rotated segments, compressed or not.
+    :param log_file: The log file
+    :return: A generator of lines, oldest first, the lines of the current file last
+    """
+    for segment in segments(log_file) + [log_file]:
+        try:
+            f = gzip.open(segment, "rt", errors="replace") if segment.endswith(".gz") else open(segment, errors="replace")
+        except FileNotFoundError:
+            # compressed since it was listed
+            if segment == log_file or segment.endswith(".gz"):
+                continue
+            try:
+                f = gzip.open(segment + ".gz", "rt", errors="replace")
+            except FileNotFoundError:
+                continue
+
+        with f:
+            for line in f:
+                yield line
+
+
+class _Compressor:
+    """
+    Compresses rotated segments and deletes the ones past the retention count, on one thread shared by every
+    logger, so a rotation never waits for either.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, log_file, compress, backups):
+        """
+        :param log_file: The log file whose segments are compressed and pruned
+        :param compress: Compress its plain segments
+        :param backups: Segments kept, 0 keeps every one
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="logger-compressor", daemon=True)
+                self.thread.start()
+        self.jobs.put((log_file, compress, backups))
+
+    def _run(self):
+        while True:
+            log_file, compress, backups = self.jobs.get()
+            try:
+                found = segments(log_file)
+                if backups > 0:
+                    for segment in found[:-backups]:
+                        os.unlink(segment)
+                    found = found[-backups:]
+
+                if compress:
+                    for segment in found:
+                        if not segment.endswith(".gz"):
+                            self._compress(segment)
+            except Exception as e:
+                print("[ERROR] Logger failed to rotate {}: {}".format(log_file, e))
+            finally:
+                self.jobs.task_done()
+
+    @staticmethod
+    def _compress(segment):
+        # written under a name segments() ignores, a segment is either plain or completely compressed
+        tmp = segment + ".gz.tmp"
+        with open(segment, "rb") as src, gzip.open(tmp, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp, segment + ".gz")
+        os.unlink(segment)
+
+    def wait(self):
+        """
+        Wait until every submitted segment is compressed and pruned.
+        """
+        self.jobs.join()
+
+
+compressor = _Compressor()
+
+
 class Logger:
-    def __init__(self, debounce_time=2, log_to_console=False, log_file=None):
+    def __init__(self, debounce_time=2, log_to_console=False, log_file=None, fsync_interval=5, buffer_size=64 * 1024,
+                 max_bytes=0, max_age=0, backups=0, compress=True):
         """
         Initializes the log debouncer.
 
         :param debounce_time: Time window (in seconds) within which similar logs are merged.
+        :param log_to_console: Print the logs as well as writing them to log_file.
+        :param log_file: The file to append the logs to, kept open for the lifetime of the logger.
+        :param fsync_interval: Seconds between fsyncs of the log file.
+        :param buffer_size: Size of the write buffer of the log file.
+        :param max_bytes: Rotate the log file once it is this large, 0 never rotates it by size.
+        :param max_age: Rotate the log file this many seconds after it was opened, 0 never rotates it by age.
+        :param backups: Rotated segments kept, 0 keeps every one.
+        :param compress: Gzip rotated segments, on a background thread.
         """
         self.debounce_time = debounce_time
+        # (message, level) -> [count, last_seen], in the order the messages were first seen
         self.log_cache = {}
-        self.queue = deque()
         self.log_file = log_file
         self.log_to_console = log_to_console
-        self.flushing = False
+        # label of the lines written, see metrics.LOG_LINES
+        self.name = os.path.basename(log_file) if log_file else "console"
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        # keeps lines from the flusher and a forced flush from interleaving
+        self.write_lock = threading.Lock()
+        self.file = None
+        self.last_fsync = time.time()
+        self._time_cache = (None, None)
+        self._stop = threading.Event()
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.compress = compress
+        # size of the current log file and when it was opened, for the rotation
+        self.size = 0
+        self.opened = time.time()
 
         if log_file:
             if not os.path.exists(os.path.dirname(log_file)):
                 os.makedirs(os.path.dirname(log_file))
+            self._open()
+            # segments left plain by a rotation that was cut short
+            if (max_bytes or max_age) and (compress or backups):
+                compressor.submit(log_file, compress, backups)
+
+        # One flusher per logger, it wakes up a few times per debounce window to write out settled messages
+        self.flusher = threading.Thread(target=self._run, name="logger-flusher", daemon=True)
+        self.flusher.start()
 
-    def _hash_log(self, message, level):
-        return hashlib.md5("{}{}".format(message, level).encode()).hexdigest()
+    def _open(self):
+        self.file = open(self.log_file, 'a', buffering=self.buffer_size)
+        self.size = self.file.tell()
+        self.opened = time.time()
+
+    def _rotate(self):
+        """
+        Rename the log file to a new segment and start a new one, the segment is compressed in the background.
+        """
+        os.fsync(self.file.fileno())
+        self.file.close()
 
-    def _setTimer(self):
+        # a new segment always sorts after the existing ones, even if they were rotated within the same second
+        # (and some of them already deleted) or the clock went back
+        stamp, n = time.strftime(SEGMENT_TIME_FORMAT), 0
+        for newest in segments(self.log_file)[-1:]:
+            match = _SEGMENT.fullmatch(newest[len(self.log_file):])
+            if match.group(1) >= stamp:
+                stamp, n = match.group(1), int(match.group(2) or 0) + 1
+        segment = "{}.{}".format(self.log_file, stamp) + (".{}".format(n) if n else "")
 
-        # If a timer is already running, cancel it (takes more memory)
-        # maybe keeping the old timer is better for performance
         try:
-            self.timer.cancel()
-        except:
-            pass
-        finally:
-            self.timer = threading.Timer(self.debounce_time, self._flush)
-            self.timer.start()
+            os.rename(self.log_file, segment)
+            metrics.LOG_ROTATIONS.inc(self.name)
+        except OSError as e:
+            print("[ERROR] Logger failed to rotate {}: {}".format(self.log_file, e))
+        self._open()
+
+        if self.compress or self.backups:
+            compressor.submit(self.log_file, self.compress, self.backups)
 
     # Log the message
     # If the message is already in the cache, increment the count
     # If the message is not in the cache, add it to the cache
     # Time stamp will be added to the log message
     def log(self, message, level="INFO"):
-        log_hash = self._hash_log(message, level)
+        key = (message, level)
         current_time = time.time()
 
-        if log_hash in self.log_cache:
-            self.log_cache[log_hash]['count'] += 1
-            self.log_cache[log_hash]['last_seen'] = current_time
+        with self.lock:
+            entry = self.log_cache.get(key)
+            if entry is None:
+                self.log_cache[key] = [1, current_time]
+            else:
+                entry[0] += 1
+                entry[1] = current_time
 
-        else:
-            self.log_cache[log_hash] = {
-                'message': message,
-                'level': level,
-                'count': 1,
-                'last_seen': current_time
-            }
-            self.queue.append(log_hash)
+    def _format_time(self, timestamp):
+        # many lines share the same second, only format it once
+        second = int(timestamp)
+        if self._time_cache[0] != second:
+            self._time_cache = (second, datetime.datetime.fromtimestamp(second).strftime('%m-%d %I:%M:%S'))
+        return self._time_cache[1]
 
-        self._setTimer()
-        self._clean_cache()
+    def _format_log(self, time_stamp, message, level, count):
+        if count > 1:
+            return "[{}] [{}] [{}] {}\n".format(time_stamp, count, level, message)
+        return "[{}] [{}] {}\n".format(time_stamp, level, message)
 
-    def _write_log(self,time_stamp, message, level, count):
+    def _write_logs(self, logs):
+        lines = [self._format_log(self._format_time(last_seen), message, level, count) for message, level, count, last_seen in logs]
+        metrics.LOG_LINES.inc(self.name, amount=len(lines))
 
         if self.log_to_console:
-            if count > 1:
-                print("[{}] [{}] [{}] {}".format(time_stamp,count, level, message))
-            else:
-                print("[{}] [{}] {}".format(time_stamp, level, message))
+            print("".join(lines), end="")
+
+        if self.file:
+            self.file.writelines(lines)
+            self.file.flush()
+            # characters, the same as bytes for all but non ascii paths
+            self.size += sum(len(line) for line in lines)
+
+            if (self.max_bytes and self.size >= self.max_bytes) or (self.max_age and time.time() - self.opened >= self.max_age):
+                self._rotate()
+            elif time.time() - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.time()
 
+    def _flush(self, force=False):
+        """
+        Write out every message that has not been repeated within the debounce window.
+        :param force: Write out every cached message, even if it could still be merged with a later one.
+        """
+        cutoff = time.time() - self.debounce_time
 
+        with self.lock:
+            ready = []
+            for key, (count, last_seen) in self.log_cache.items():
+                if force or last_seen <= cutoff:
+                    ready.append((key[0], key[1], count, last_seen))
 
-        if self.log_file:
-            with open(self.log_file, 'a') as f:
-                if count > 1:
-                    f.write("[{}] [{}] [{}] {}\n".format(time_stamp,count, level, message))
-                else:
-                    f.write("[{}] [{}] {}\n".format(time_stamp, level, message))
+            for message, level, _, _ in ready:
+                del self.log_cache[(message, level)]
 
+        if ready:
+            with self.write_lock:
+                self._write_logs(ready)
 
-    def _flush(self, force=False):
-        if force:
-            self._clean_cache()
-            return
-        if self.flushing == True:
-            return
-        self._clean_cache()
+    def _run(self):
+        interval = max(self.debounce_time / 4, 0.05)
+        while not self._stop.wait(interval):
+            try:
+                self._flush()
+            except Exception as e:
+                print("[ERROR] Logger failed to write {}: {}".format(self.log_file, e))
 
+    def queue_size(self):
+        """
+        :return: The number of distinct messages waiting to be written.
+        """
+        return len(self.log_cache)
 
-    def _clean_cache(self):
-        self.flushing = True
-        current_time = time.time()
-        while self.queue:
-            log_hash = self.queue[0]
-            log = self.log_cache[log_hash]
+    def close(self):
+        """
+        Stop the flusher, write out every cached message and close the log file.
+        """
+        self._stop.set()
+        if self.flusher.is_alive() and self.flusher is not threading.current_thread():
+            self.flusher.join()
+
+        self._flush(True)
+
+        with self.write_lock:
+            if self.file:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
 
-            if current_time - log['last_seen'] < self.debounce_time:
-                break
 
-            self.queue.popleft()
-            log_time = datetime.datetime.fromtimestamp(log['last_seen']).strftime('%m-%d %I:%M:%S')
-            self._write_log(log_time,log['message'], log['level'], log['count'])
-            del self.log_cache[log_hash]
+def main(argv):
+    parser = argparse.ArgumentParser(prog="main.py logs", description="Print a log file of watchdir with its rotated segments, oldest first.")
+    parser.add_argument("log_file", help="The log file, e.g. /var/log/watchdir/<name>.access.log")
+    parser.add_argument("--grep", default=None, help="Only print the lines containing this text")
+    args = parser.parse_args(argv)
 
-        self.flushing = False
+    try:
+        for line in read_lines(args.log_file):
+            if args.grep is None or args.grep in line:
+                sys.stdout.write(line)
+    except BrokenPipeError:
+        pass
@@ -1,13 +1,14 @@
 #! /usr/bin/python3
 
 """
-Watch a directory for changes and log them to a git repository.
-This script uses inotifywait to watch for changes in a directory and logs them to a git repository.
+Watch one or more directories for changes and log them to git repositories.
+This script uses inotify (natively, or through inotifywait as a fallback) to watch for changes in a directory and logs them to a git repository.
 It also uses auditd to log access to files in the directory.
 
 
 This script is designed to be run as a daemon and will run in the background.
 It will log all changes to the directory and its subdirectories to a git repository.
+Several directories can be watched by one process, each gets its own git repository and logs.
 
 Meant to be run for a couple of hours, to gather information about changes on a system and revert them without the need to see backups.
 auditd is used to log access to files in the directory, while inotifywait is used to watch for changes in the directory. 
@@ -17,124 +18,258 @@ git is used to see what changes were made to the directory and revert them if ne
 
 import config
 from util import log
-from console import run_command_sudo, check_command, install_pkg
-import git_utils
+from console import check_command, install_pkg
+import console
 import sys
 import auditctl
+import audit_log
+import baseline
+import coalesce
+import event_source
+import git_utils
+import history
 import logger
+import metrics
+import pipeline
+import reconcile
+import restore
+import watchroot
+import capabilities
 import os
 import atexit
-import subprocess
 import threading
+import time
 import argparse
 
 
 
-# create two loggers, one for the watchdir and one for access logs, to order to not mix them up, makes them easier to read
-watchdir_log = None
-watchdir_access_log = None
+# the watched directories, each with its repo, loggers and path filter, see watchroot.WatchRoot
+roots = []
+
+# when the process started, for the time to first watch
+started = time.time()
+
+# reader thread, queue and workers processing the events
+event_pipeline = None
+
+# follows the auditd log to find the process behind each change, see audit_log.AuditTail
+audit_tail = None
+
+# writes the metrics textfile and serves the metrics socket
+metrics_exporter = None
 
+# records every change and the commit it went into, see history.History
+event_history = None
 
 
-def watchable(file:str):
+def watchable(file:str, is_dir:bool=False):
     """
     Check if the file is watchable or not.
     :param file: The file to check
+    :param is_dir: True if the file is a directory
     :return: True if the file is watchable, False otherwise.
     """
 
-
-    # check if .git is in the file path
-    # this is to prevent the script from watching the .git directory
-    if ".git" in file:
+    root = watchroot.find(roots, file)
+    if root is None:
         return False
 
+    # the filter of each root is compiled once at startup from pathfilter.DEFAULT_RULES, the filter files and the options
+    return not root.path_filter.excluded(file, is_dir)
 
-    # check if the following extensions are in the file path, making sure to not watch them
-    # this is to prevent the script from watching temporary files, and creating non-sense commits
-    ext_not_to_watch = [
-        ".swp",
-        ".swx",
-        ".swpx",
-        "~",
-        ".part",
-        ".crdownload",
-        ".tmp",
-        ".temp",
-        ".lock",
-        ".git",
-        ".log"
-    ]
-    # check if the file is in the following paths, making sure to not watch them
-    # this is to prevent the script from watching system files, and creating non-sense commits
-    paths_not_to_watch = [
-        "/proc",
-        "/sys",
-        "/run",
-    ]
-
-    for path in paths_not_to_watch:
-        if file.startswith(path):
-            return False
-
-    for ext in ext_not_to_watch:
-        if ext in file:
-            return False
-
-    # check if the file is a directory
-    if file.startswith("."):
-        return False
 
-    return True
+def route(event):
+    """
+    The watched directory of an event, the pipeline queues the events of each directory separately.
+    :param event: The event_source.Event
+    :return: The watched directory
+    """
+    root = watchroot.find(roots, event.path)
+    return root.watch_dir if root else None
 
 
-def log_change(event, file):
+def filter_change(event):
+    """
+    Filter stage of the pipeline, drops events for files that are not watched.
+    :param event: The event_source.Event
+    :return: True if the file is watched, False otherwise.
+    """
+    if watchable(event.path, "ISDIR" in event.event):
+        return True
+
+    metrics.FILTERED.inc()
+    return False
+
+
+def hold_for_baseline(event):
+    """
+    Stage of the pipeline holding back the events of directories whose initial commit is still imported.
+    :param event: The event_source.Event
+    :return: False if the event was held, True otherwise.
+    """
+    root = watchroot.find(roots, event.path)
+    return not (root and root.hold(event))
+
+
+def import_baseline(root):
+    """
+    Import every file of a new watched directory as its initial commit, then handle the changes seen meanwhile.
+    The directory is watched the whole time, so a change made during the import is never lost.
+    :param root: The WatchRoot
+    """
+    importer = baseline.Baseline(root.repo, lambda path, is_dir: not watchable(path, is_dir), max(1, config.BASELINE_WORKERS))
+    if not importer.run():
+        # keep holding the changes back, committing them now would make them the first commit
+        log("Initial commit of {} failed, restart watchdir to resume it".format(root.watch_dir), "ERROR")
+        return
+
+    events, resyncs = root.release()
+    log("Initial commit of {} imported, handling {} changes seen meanwhile".format(root.watch_dir, len(events)))
+    for event in events:
+        event_pipeline.replay(event, "baseline")
+    for path in resyncs:
+        root.repo.resync(path, lambda file: not watchable(file))
+
+    root.repo.backup_init_repo()
+
+
+def reconcile_root(root):
+    """
+    Commit the changes made to a watched directory while watchdir was not running.
+    The directory is watched already, a change made meanwhile is committed through its event as usual.
+    :param root: The WatchRoot
+    """
+    try:
+        if not reconcile.reconcile(root.repo, lambda path, is_dir: not watchable(path, is_dir), config.RECONCILE_WORKERS):
+            log("Failed to commit the offline changes of {}, they are looked for again on the next start".format(root.watch_dir), "ERROR")
+    except Exception as e:
+        log("Failed to reconcile {}: {}".format(root.watch_dir, e), "ERROR")
+
+
+def log_change(event, file, old_path=None):
     """
     Log the change to the git repository and auditd.
+    Events reach it through the pipeline, after filter_change dropped the ones for files that are not watched.
+    With coalescing enabled event is one of the logical changes from coalesce.py, otherwise a raw inotify event.
     :param event: The event that occurred (modify, create, delete, etc.)
     :param file: The file that was changed
+    :param old_path: Where the file was before, for renamed files
     :return: True if the change was logged, False otherwise.
     """
 
+    root = watchroot.find(roots, file)
+    if root is None:
+        log("File {} is outside of the watched directories".format(file), "ERROR")
+        return False
+
+    metrics.CHANGES.inc(root.watch_dir)
+    repo = root.repo
+
     # Check if the git repo is initialized and active
-    if not git_utils.check_repo():
+    if not repo.check_repo():
         log("Git repo does not exist", "ERROR")
         return False
 
-    # Check if the file is watchable
-    if not watchable(file):
-        return False
+    upper = str.upper(event)
 
     # Check if the Event is a file change event, One where the file content is changed
 
     # if its not just log that the file was accessed, and return
-    if "ACCESS" in str.upper(event) or  "CLOSE" in str.upper(event) :
-        watchdir_access_log.log("File {} was accessed".format(file))
+    if "ACCESS" in upper or  "CLOSE" in upper :
+        root.access_log.log("File {} was accessed".format(file))
+        if event_history:
+            event_history.record(root.watch_dir, event, file)
+        return True
+
+    # Moving or removing a directory only produces an event for the directory itself, rescan what was in it
+    if "ISDIR" in upper:
+        if "MOVED" in upper or "DELETE" in upper or coalesce.RENAMED in upper:
+            root.log.log("{} - {}".format(event, file if not old_path else "{} -> {}".format(old_path, file)), "INFO")
+            if event_history:
+                event_history.record(root.watch_dir, event, file, old_path)
+            for path in (old_path, file):
+                path_root = watchroot.find(roots, path) if path else None
+                if path_root:
+                    path_root.repo.resync(path, lambda changed: not watchable(changed), "directory {}".format(event))
         return True
 
     # else check if the file still exists, if it was deleted, and log the event
-    if not os.path.exists(file) and not "DELETE" in str.upper(event):
-        watchdir_log.log("File {} was deleted - might be a dropped executable".format(file), "WARNING")
+    if not os.path.exists(file) and not "DELETE" in upper:
+        root.log.log("File {} was deleted - might be a dropped executable".format(file), "WARNING")
+        if event_history:
+            event_history.record(root.watch_dir, event, file, old_path)
         return True
 
-    watchdir_log.log("{} - {}".format(event, file), "INFO")
+    # who made the change, from the audit records of the same path
+    process = None
+    if audit_tail:
+        process = audit_tail.lookup(file) or (audit_tail.lookup(old_path) if old_path else None)
+    details = audit_log.format_process(process) if process else None
+    suffix = " [{}]".format(details) if details else ""
+    if event_history:
+        event_history.record(root.watch_dir, event, file, old_path, process)
+
+    if old_path:
+        root.log.log("{} - {} -> {}{}".format(event, old_path, file, suffix), "INFO")
+        # the old path is committed as a deletion, in the repo of whichever directory it was moved out of
+        old_root = watchroot.find(roots, old_path)
+        if old_root:
+            old_root.repo.commit(event, old_path, details)
+    else:
+        root.log.log("{} - {}{}".format(event, file, suffix), "INFO")
 
 
     # Add the file to the git repo
-    git_utils.commit(event, file)
+    return repo.commit(event, file, details)
+
 
 
+def write_pid_files():
+    """
+    Record that the directories are watched by this process, a restore leaves its commit to it, see restore.py.
+    """
+    for root in roots:
+        with open(os.path.join(os.path.dirname(root.repo.repo_dir), git_utils.PID_FILE), "w") as f:
+            f.write(str(os.getpid()))
+
+
+def remove_pid_files():
+    for root in roots:
+        pid_file = os.path.join(os.path.dirname(root.repo.repo_dir), git_utils.PID_FILE)
+        try:
+            with open(pid_file) as f:
+                if f.read().strip() == str(os.getpid()):
+                    os.unlink(pid_file)
+        except OSError:
+            pass
+
+
+def commit_restores():
+    """
+    Commit the files written by a restore of a watched directory once it is done, and checkpoint for the
+    restores that ask for it.
+    """
+    for root in roots:
+        root.repo.answer_checkpoint()
+        root.repo.commit_restore()
+
 
 def on_exit():
     """
     Flush the logs and close the git repo.
     """
-    if watchdir_log:
-        watchdir_log._flush(True)
-    if watchdir_access_log:
-        watchdir_access_log._flush(True)
-    if git_utils.git_log:
-        git_utils.git_log._flush(True)
+    # Commit anything still waiting in the batch and stop the git writer before the logs are flushed
+    if audit_tail:
+        audit_tail.close()
+    for root in roots:
+        root.close()
+    remove_pid_files()
+    # after the repos, the commit ids of their last commits are queued
+    if event_history:
+        event_history.close()
+    # the last textfile includes the final commits
+    if metrics_exporter:
+        metrics_exporter.close()
 
 # Close the git repo on exit
 atexit.register(on_exit)
@@ -151,63 +286,116 @@ def set_interval(func, sec):
         set_interval(func, sec)
         func()
     t = threading.Timer(sec, func_wrapper)
+    t.daemon = True
     t.start()
     return t
 
 
-def inotify_generator(path:str):
+def resync(path):
     """
-    Generator that yields events from inotifywait.
-    :param path: The path to watch
-    :return: A generator that yields events from inotifywait.
+    Commit the changes under a directory whose events were lost.
+    :param path: The directory to rescan
     """
+    root = watchroot.find(roots, path)
+    if root is None or root.hold_resync(path):
+        return
 
-    # Check if inotifywait is installed
-    if not check_command("inotifywait"):
-        log("inotify-tools package is not installed", "ERROR")
+    root.log.log("Events under {} were lost, rescanning".format(path), "WARNING")
+    root.repo.resync(path, lambda file: not watchable(file))
+
+
+def backup_git_directories():
+    """
+    Take a backup snapshot of the repo of every watched directory.
+    """
+    for root in roots:
+        root.repo.backup_git_directory()
+
+
+def maintain_repos():
+    """
+    Repack the repos that piled up loose objects or packs, or that are idle, see maintenance.py.
+    """
+    for root in roots:
+        # the baseline streams into its own fast-import, its packs are combined once it is done
+        if not root.importing:
+            root.repo.maintain()
+
+
+def log_pipeline_stats():
+    """
+    Log queue depth, drops and per stage latencies of the event pipeline.
+    """
+    if not event_pipeline:
         return
 
-    # Open a subprocess to run inotifywait
-    # and yield the events as they come in
-    # The -m flag is used to monitor the directory recursively, and -e with the events to watch for
-    process = subprocess.Popen(['inotifywait', '-m', '-r', '-e', 'modify,attrib,close_write,move,create,delete', path, '--format', "'%e, %w%f'"],
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    try:
-        if not process:
-            log("Failed to start inotifywait process", "ERROR")
-            return
+    stats = event_pipeline.stats()
+    stages = ", ".join("{} {:.2f}/{:.2f}ms".format(name, stage["avg_ms"], stage["max_ms"]) for name, stage in stats["stages"].items())
+    roots[0].log.log("Pipeline: queue {}/{}, received {}, dropped {}, overflows {}, resyncs {}, latency avg/max: {}".format(
+        stats["queue_depth"], stats["queue_max"], stats["received"], stats["dropped"], stats["overflows"], stats["resyncs"], stages))
 
-        if not process.stdout:
-            log("Failed to start inotifywait process", "ERROR")
-            return
+    if audit_tail:
+        audit = audit_tail.stats()
+        roots[0].log.log("Audit log: {} lines, {} records with key {}, {} paths indexed, {}/{} changes attributed, {} rotations".format(
+            audit["lines"], audit["matched"], config.AUDITDKEY, audit["paths"], audit["hits"], audit["lookups"], audit["rotations"]))
 
-        for stdout_line in iter(process.stdout.readline, ""):
-            yield stdout_line.strip()
+    roots[0].log.log("Commands:\n{}".format(console.format_command_stats()))
 
-    except Exception as e:
-        log("Error in inotify_generator: {}".format(e), "ERROR")
-    finally:
+    if event_history:
+        recorded = event_history.stats()
+        roots[0].log.log("History: {} changes recorded, {} dropped, {} queued, {} files linked to commits, {} batches avg {:.2f}ms".format(
+            recorded["recorded"], recorded["dropped"], recorded["queued"], recorded["linked"], recorded["batches"], recorded["avg_batch_ms"]))
+
+    for root in roots:
+        if len(roots) > 1:
+            root.log.log("Queue of {}: {}/{}".format(root.watch_dir, stats["queues"].get(root.watch_dir, 0), stats["queue_max"]))
 
-        if not process:
-            return
+        if root.repo.policy:
+            policy = root.repo.policy.stats()
+            root.log.log("Large files: {} full, {} meta, {} chunked, {} chunks stored ({:.1f} MiB), {} deduplicated ({:.1f} MiB)".format(
+                policy["full"], policy["meta"], policy["chunked"], policy["written"], policy["written_bytes"] / 1024 ** 2,
+                policy["deduplicated"], policy["deduplicated_bytes"] / 1024 ** 2))
 
-        if not process.stdout:
-            return
+        if root.repo.fingerprints:
+            fingerprints = root.repo.fingerprints.stats()
+            root.log.log("Fingerprint index: {} files, {} unchanged, {} changed, {} hashed, hit rate {:.1%}".format(
+                fingerprints["entries"], fingerprints["hits"], fingerprints["misses"], fingerprints["hashed"], fingerprints["hit_rate"]))
 
-        if not process.stderr:
-            return
 
-        process.stdout.close()
-        process.stderr.close()
-        process.terminate()
+def _pipeline_metric(name:str):
+    return lambda: {(): event_pipeline.stats()[name]} if event_pipeline else {}
+
+
+def register_metrics():
+    """
+    Metrics read from the pipeline, the loggers and the repos when they are rendered.
+    """
+    metrics.Counter("watchdir_events_received_total", "Events read from the event source", collect=_pipeline_metric("received"))
+    metrics.Counter("watchdir_events_dropped_total", "Events dropped because the queue was full", collect=_pipeline_metric("dropped"))
+    metrics.Counter("watchdir_events_overflowed_total", "Kernel event queue overflows", collect=_pipeline_metric("overflows"))
+    metrics.Counter("watchdir_resyncs_total", "Rescans after lost events", collect=_pipeline_metric("resyncs"))
+    metrics.Gauge("watchdir_queue_depth", "Events waiting in the queue of each watched directory", ("root",),
+                  collect=lambda: {(root,): depth for root, depth in event_pipeline.queue.depths().items()} if event_pipeline else {})
+    metrics.Gauge("watchdir_logger_queue_size", "Messages waiting to be written by each logger", ("log",),
+                  collect=lambda: {(logger.name,): logger.queue_size() for root in roots for logger in (root.log, root.access_log, root.repo.git_log)})
+    metrics.Gauge("watchdir_git_objects", "Objects in the git repo of each watched directory", ("root",), collect=_git_objects)
+
+
+def _git_objects() -> dict:
+    counts = {}
+    for root in roots:
+        count = root.repo.object_count()
+        if count is not None:
+            counts[(root.watch_dir,)] = count
+    return counts
 
 
 def start():
     """
-    Start the script and watch the directory for changes.
+    Start the script and watch the directories for changes.
     :return: None
     """
-    log("Starting script on directory: {}".format(config.WATCH_DIR))
+    log("Starting script on directories: {}".format(", ".join(root.watch_dir for root in roots)))
 
     if config.DEBUG:
         log("Debug mode is enabled will not install packages")
@@ -216,8 +404,14 @@ def start():
 
     # Check if inotifywait is installed
     log("Checking dependencies")
-    if not check_command("inotifywait"):
-        
+    # one pass over PATH, or the cache from the last start, instead of forking `which` for every tool
+    capabilities.probe()
+    log("Found tools in {:.1f}ms".format(capabilities.probe_time * 1000))
+    backend = event_source.resolve_backend(config.EVENT_BACKEND)
+    if backend == event_source.InotifyBackend.name:
+        log("Using native inotify, inotify-tools package is not needed")
+    elif not check_command("inotifywait"):
+
         log("Installing inotify-tools package")
         if not install_pkg("inotify-tools"):
             log("Failed to install inotify-tools package", "ERROR")
@@ -245,16 +439,32 @@ def start():
         log("auditd package is already installed")
 
 
-    # Check if git repo exists, initialize it if it doesn't
-    if not run_command_sudo("git -C {} status".format(config.WATCH_DIR)):
-        # init git repo and auditd
-        log("Initializing git repo")
-        if not git_utils.init_repo():
-            log("Failed to initialize git repo", "ERROR")
-            sys.exit(1)
-
-        # init git repo and auditd
-        auditctl.init_auditd()
+    # Check if the git repos exist, initialize the ones that don't. A `git status` would stat and maybe rehash
+    # every file of the tree, the changes made while watchdir was not running are found by reconcile.py instead
+    importing = []
+    # the existing repos, compared with their tree for the changes made while watchdir was not running
+    reconciling = []
+    for root in roots:
+        if not root.repo.check_repo():
+            # init git repo and auditd
+            log("Initializing git repo in {}".format(root.watch_dir))
+            # the files are imported once the directory is watched, unless the baseline import is disabled
+            if not root.repo.init_repo(import_files=config.BASELINE_WORKERS <= 0):
+                log("Failed to initialize git repo", "ERROR")
+                sys.exit(1)
+            if config.BASELINE_WORKERS > 0:
+                importing.append(root)
+
+            # init git repo and auditd
+            auditctl.init_auditd(root.watch_dir)
+        elif baseline.Baseline.incomplete(root.repo):
+            log("Initial commit of {} was interrupted, resuming it".format(root.watch_dir), "WARNING")
+            importing.append(root)
+        elif root.repo.stat_index:
+            reconciling.append(root)
+
+    for root in importing:
+        root.importing = True
 
     # General info and useful commands
     # This is just a simple info message to help the user
@@ -264,7 +474,9 @@ def start():
         |              Useful Commands                  |
         |_______________________________________________|
         |                                               |
-        |    - git reset --hard <Sha256 commit hash>    |
+        |    - main.py restore <dir> --at <time>        |
+        |    - main.py history timeline <path>          |
+        |    - main.py logs <log file>                  |
         |    - git log                                  |
         |    - git status                               |
         |_______________________________________________|
@@ -282,20 +494,73 @@ def start():
     config.print_config()
 
     try:
-        # Start inotifywait
-        log("Starting inotifywait")
-        for line in inotify_generator(config.WATCH_DIR):
-            if not line:
-                continue
-
-            event, file = line.replace("'", "").split(" ")
-
-            log_change(event, file)
-
-        # Set the interval to backup the git directory
-        set_interval(git_utils.backup_git_directory, config.BACKUP_INTERVAL)
+        # Set the interval to backup the git directory, the watch loop below only returns on exit
+        set_interval(backup_git_directories, config.BACKUP_INTERVAL)
+        if config.MAINTENANCE_INTERVAL > 0:
+            set_interval(maintain_repos, config.MAINTENANCE_INTERVAL)
+        write_pid_files()
+        set_interval(commit_restores, 1)
+
+        # Follow the audit log from here on, so changes can be attributed to the process that made them
+        global audit_tail
+        if config.AUDIT_LOG:
+            audit_tail = audit_log.AuditTail(config.AUDITDKEY, config.AUDIT_LOG, config.AUDIT_WINDOW)
+            if audit_tail.start():
+                log("Following audit log {}".format(config.AUDIT_LOG))
+            else:
+                audit_tail = None
+
+        # Record every change, the repos fill in the commit each one went into
+        global event_history
+        if config.HISTORY_DB:
+            event_history = history.History(os.path.join(config.LOG_DIR, config.HISTORY_DB))
+            if event_history.start():
+                log("Recording history in {}".format(event_history.db_file))
+                for root in roots:
+                    root.repo.on_commit = event_history.link_commit
+            else:
+                event_history = None
+
+        # Start watching, a reader thread drains the event source into a bounded queue per directory
+        # and worker threads filter, log and commit the events
+        global event_pipeline
+        log("Starting watcher")
+        source = event_source.get_event_source([root.watch_dir for root in roots], backend, lambda path: not watchable(path, True))
+        log("Using {} event source".format(source.name))
+        stages = [("filter", filter_change)]
+        if importing:
+            stages.append(("baseline", hold_for_baseline))
+        if config.COALESCE_QUIET > 0:
+            # collapse the burst of events of a single save into one change
+            stages.append(("coalesce", coalesce.Coalescer(config.COALESCE_QUIET, config.COALESCE_MAX_PENDING)))
+        stages.append(("change", lambda event: log_change(event.event, event.path, event.old_path)))
+
+        event_pipeline = pipeline.Pipeline(source, stages, resync,
+                                           max_queue=config.PIPELINE_QUEUE_SIZE, workers=config.PIPELINE_WORKERS, route=route)
+        event_pipeline.start()
+
+        global metrics_exporter
+        textfile = os.path.join(config.LOG_DIR, config.METRICS_TEXTFILE) if config.METRICS_TEXTFILE else None
+        if textfile or config.METRICS_SOCKET:
+            register_metrics()
+            metrics_exporter = metrics.Exporter(textfile, config.METRICS_SOCKET or None, config.METRICS_INTERVAL)
+            metrics_exporter.start()
+        event_pipeline.watching.wait()
+        if not event_pipeline.stopped.is_set():
+            log("Watching {} directories, time to first watch: {:.2f}s".format(len(roots), time.time() - started))
+        # every directory is watched now, import the new ones in the background
+        for root in importing:
+            threading.Thread(target=import_baseline, args=(root,), name="baseline-{}".format(root.repo.base_name), daemon=True).start()
+        # and commit what changed in the existing ones while nothing watched them
+        for root in reconciling:
+            threading.Thread(target=reconcile_root, args=(root,), name="reconcile-{}".format(root.repo.base_name), daemon=True).start()
+        set_interval(log_pipeline_stats, config.STATS_INTERVAL)
+
+        event_pipeline.join()
     except KeyboardInterrupt:
         log("Exiting script")
+        if event_pipeline:
+            event_pipeline.stop()
         sys.exit(0)
     except Exception as e:
         log("Error in main: {}".format(e), "ERROR")
@@ -303,19 +568,115 @@ def start():
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="Watch a directory for changes and log them to a git repository.")
-    parser.add_argument("directory", help="The directory to watch")
+    parser = argparse.ArgumentParser(description="Watch directories for changes and log them to git repositories.")
+    parser.add_argument("directory", nargs="*", help="The directories to watch")
+    parser.add_argument("--config", default=None,
+                        help="INI file with the options in a [watchdir] section and a section per directory to watch, see config.load_config_file")
+    parser.add_argument("--backend", choices=["auto", "native", "inotifywait"], default=None,
+                        help="The event source to use, native inotify or the inotifywait fallback (default: auto)")
+    parser.add_argument("--git-writer", choices=["fast-import", "cli"], default=None,
+                        help="Stream commits into one long lived git fast-import process, or run git add/commit for each commit (default: {})".format(config.GIT_WRITER))
+    parser.add_argument("--filter-file", default=None,
+                        help="gitignore style file with extra exclude rules, `!pattern` re-includes a path")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="gitignore style pattern of paths not to watch, can be given multiple times")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="gitignore style pattern of paths to watch even if an exclude rule matches, can be given multiple times")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Events queued between the reader and the workers before events are dropped and rescanned (default: {})".format(config.PIPELINE_QUEUE_SIZE))
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker threads filtering, logging and committing events (default: {})".format(config.PIPELINE_WORKERS))
+    parser.add_argument("--quiet-period", type=float, default=None,
+                        help="Seconds a file has to be quiet before its events are collapsed into one change, 0 handles every event on its own (default: {})".format(config.COALESCE_QUIET))
+    parser.add_argument("--max-pending", type=int, default=None,
+                        help="Files kept waiting for their quiet period, the oldest one is handled early when there are more (default: {})".format(config.COALESCE_MAX_PENDING))
+    parser.add_argument("--batch-window", type=float, default=None,
+                        help="Commit changes seen within this many seconds together, 0 commits each change on its own (default: {})".format(config.COMMIT_BATCH_WINDOW))
+    parser.add_argument("--audit-log", default=None,
+                        help="The auditd log followed to attribute changes to processes, an empty string disables it (default: {})".format(config.AUDIT_LOG))
+    parser.add_argument("--metrics-textfile", default=None,
+                        help="Prometheus textfile written to LOG_DIR, an empty string disables it (default: {})".format(config.METRICS_TEXTFILE))
+    parser.add_argument("--metrics-socket", default=None,
+                        help="Unix socket serving the metrics, plain or over HTTP (default: none)")
+    parser.add_argument("--history-db", default=None,
+                        help="SQLite database in LOG_DIR recording every change, empty disables it (default: {})".format(config.HISTORY_DB))
+    parser.add_argument("--maintenance-interval", type=float, default=None,
+                        help="Seconds between checks whether the repos need repacking, 0 disables it (default: {})".format(config.MAINTENANCE_INTERVAL))
+    parser.add_argument("--baseline-workers", type=int, default=None,
+                        help="Threads walking and hashing a new directory for its initial commit, 0 runs `git add .` before watching (default: {})".format(config.BASELINE_WORKERS))
+    parser.add_argument("--reconcile-workers", type=int, default=None,
+                        help="Threads scanning a directory at start for the changes made while watchdir was not running, 0 disables it (default: {})".format(config.RECONCILE_WORKERS))
+    parser.add_argument("--large-file-size", type=int, default=None,
+                        help="Files larger than this many bytes are stored as --large-file-mode, 0 stores every file in full (default: {})".format(config.LARGE_FILE_SIZE))
+    parser.add_argument("--large-file-mode", choices=["full", "meta", "chunked"], default=None,
+                        help="How large files are stored: in full, only their size and hash, or as deduplicated chunks (default: {})".format(config.LARGE_FILE_MODE))
+    for mode, help in (("full", "stored in full"), ("meta", "tracked by their size and hash only"), ("chunked", "stored as deduplicated chunks")):
+        parser.add_argument("--{}".format(mode), action="append", default=[], metavar="PATTERN", dest="{}_files".format(mode),
+                            help="gitignore style pattern of files {} whatever their size, can be given multiple times".format(help))
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="Commit a batch early once it holds this many files (default: {})".format(config.COMMIT_BATCH_SIZE))
     return parser.parse_args()
 
 
 def main():
-    args = parse_args()
-    config.init(args.directory)
-    git_utils.init()
+    # restore, history and logs are subcommands with their own options, everything else watches directories
+    if len(sys.argv) > 1 and sys.argv[1] == "restore":
+        restore.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "history":
+        history.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "logs":
+        logger.main(sys.argv[2:])
+        return
 
-    global watchdir_log, watchdir_access_log
-    watchdir_log = logger.Logger(2, log_to_console=True, log_file=config.WATCH_DIR_LOG_FILE)
-    watchdir_access_log = logger.Logger(2, log_file=config.WATCH_ACCESS_LOG_FILE)
+    args = parse_args()
+    # the command line options override the config file
+    config.init(args.directory, config.load_config_file(args.config) if args.config else None)
+    if args.backend:
+        config.EVENT_BACKEND = args.backend
+    if args.filter_file:
+        config.FILTER_FILE = args.filter_file
+    config.FILTER_EXCLUDES += args.exclude
+    config.FILTER_INCLUDES += args.include
+    if args.git_writer:
+        config.GIT_WRITER = args.git_writer
+    if args.queue_size is not None:
+        config.PIPELINE_QUEUE_SIZE = max(1, args.queue_size)
+    if args.workers is not None:
+        config.PIPELINE_WORKERS = max(1, args.workers)
+    if args.quiet_period is not None:
+        config.COALESCE_QUIET = args.quiet_period
+    if args.max_pending is not None:
+        config.COALESCE_MAX_PENDING = max(1, args.max_pending)
+    if args.batch_window is not None:
+        config.COMMIT_BATCH_WINDOW = args.batch_window
+    if args.audit_log is not None:
+        config.AUDIT_LOG = args.audit_log
+    if args.metrics_textfile is not None:
+        config.METRICS_TEXTFILE = args.metrics_textfile
+    if args.metrics_socket is not None:
+        config.METRICS_SOCKET = args.metrics_socket
+    if args.history_db is not None:
+        config.HISTORY_DB = args.history_db
+    if args.maintenance_interval is not None:
+        config.MAINTENANCE_INTERVAL = args.maintenance_interval
+    if args.baseline_workers is not None:
+        config.BASELINE_WORKERS = args.baseline_workers
+    if args.reconcile_workers is not None:
+        config.RECONCILE_WORKERS = args.reconcile_workers
+    if args.large_file_size is not None:
+        config.LARGE_FILE_SIZE = args.large_file_size
+    if args.large_file_mode:
+        config.LARGE_FILE_MODE = args.large_file_mode
+    config.FULL_FILES += args.full_files
+    config.META_FILES += args.meta_files
+    config.CHUNKED_FILES += args.chunked_files
+    if args.batch_size is not None:
+        config.COMMIT_BATCH_SIZE = max(1, args.batch_size)
+
+    global roots
+    roots = watchroot.init()
 
     start()
 
@@ -0,0 +1,103 @@
+"""
+Packing of the watchdir repo.
+
+The cli git writer leaves loose objects behind every commit, and fast-import writes a new pack at every
+checkpoint (or loose objects, when it holds less than fastimport.unpackLimit of them). Nothing ever combines
+them: after a day of changes the repo holds hundreds of thousands of loose files or thousands of small packs,
+and every git command, backup fetch and restore that has to look objects up in them slows down.
+
+Repo.maintain checks the object counts of the repo and repacks it:
+
+- incremental: the loose objects are packed into one new pack, the existing packs are left alone. Cheap,
+  runs once MAINTENANCE_LOOSE_OBJECTS loose objects piled up.
+- full: every object is repacked into a single pack and unreachable loose objects older than PRUNE_EXPIRE
+  are deleted. Runs once there are more than MAINTENANCE_PACKS packs.
+
+Once the repo saw no commit for MAINTENANCE_IDLE seconds it is packed as soon as there is anything to pack,
+so the work is mostly done when nothing else happens. The snapshot store packs itself after each backup,
+see backups.snapshot.
+"""
+
+import console
+
+
+INCREMENTAL = "incremental"
+FULL = "full"
+
+# unreachable loose objects younger than this are kept, a git command outside of watchdir may still use them
+PRUNE_EXPIRE = "1.hour.ago"
+
+
+def count_objects(git_dir:str):
+    """
+    :param git_dir: The git directory
+    :return: A dict with loose (objects), loose_bytes, packed (objects), packs, pack_bytes and garbage_bytes,
+             or None if git failed
+    """
+    res = console.run(["git", "--git-dir", git_dir, "count-objects", "-v"])
+    if res.returncode != 0:
+        return None
+
+    fields = dict(line.split(": ", 1) for line in res.stdout.splitlines() if ": " in line)
+    value = lambda name: int(fields.get(name, 0))
+    # sizes are in KiB
+    return {
+        "loose": value("count"),
+        "loose_bytes": value("size") * 1024,
+        "packed": value("in-pack"),
+        "packs": value("packs"),
+        "pack_bytes": value("size-pack") * 1024,
+        "garbage_bytes": value("size-garbage") * 1024,
+    }
+
+
+def disk_usage(counts:dict) -> int:
+    """
+    :param counts: The result of count_objects
+    :return: Bytes taken by the objects of the repo
+    """
+    return counts["loose_bytes"] + counts["pack_bytes"] + counts["garbage_bytes"]
+
+
+def plan(counts:dict, new_loose:int, idle:bool, loose_limit:int, pack_limit:int):
+    """
+    Decide what the repo needs.
+    :param counts: The result of count_objects
+    :param new_loose: Loose objects added since the last repack, the unreachable ones it left are not counted
+    :param idle: True if the repo was changed since the last repack and saw no commit for a while
+    :param loose_limit: Loose objects that trigger an incremental repack, 0 never triggers one
+    :param pack_limit: Packs that trigger a full repack, 0 never triggers one
+    :return: FULL, INCREMENTAL or None
+    """
+    if pack_limit > 0 and counts["packs"] > pack_limit:
+        return FULL
+    if loose_limit > 0 and new_loose >= loose_limit:
+        return INCREMENTAL
+
+    if idle:
+        if counts["packs"] > 1:
+            return FULL
+        if new_loose > 0:
+            return INCREMENTAL
+    return None
+
+
+def repack(git_dir:str, kind:str) -> bool:
+    """
+    Repack a repo. Commits must not be written meanwhile, the caller holds the lock of the repo.
+    :param git_dir: The git directory
+    :param kind: INCREMENTAL or FULL
+    :return: True if the repo was repacked, False otherwise.
+    """
+    git = ["git", "--git-dir", git_dir]
+    # -d deletes the loose objects that were packed, a large repo can take a while
+    args = ["repack", "-q", "-d"]
+    if kind == FULL:
+        args.insert(2, "-a")
+
+    if console.run(git + args, timeout=0).returncode != 0:
+        return False
+
+    if kind == FULL:
+        console.run(git + ["prune", "--expire", PRUNE_EXPIRE], timeout=0)
+    return True
@@ -0,0 +1,264 @@
+"""
+Metrics for watchdir, in the Prometheus text format.
+
+Counters, gauges and histograms are plain objects updated in place by the code they measure, an update is
+a dict lookup and an addition under an uncontended lock. Values that are already counted elsewhere
+(pipeline counters, logger queues, git object counts) are read through a collect function when the
+metrics are rendered, so they cost nothing in between.
+
+The metrics are exposed as a textfile for the node_exporter textfile collector, rewritten every few seconds,
+and/or on a unix socket answering every connection (plain or HTTP GET) with the current metrics:
+
+    curl --unix-socket /run/watchdir.sock http://localhost/metrics
+"""
+
+from util import log
+import bisect
+import os
+import socket
+import socketserver
+import threading
+
+
+# Every metric, in the order they were created
+REGISTRY = []
+
+# Commit and backup latencies, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names:tuple, values:tuple, extra:str="") -> str:
+    parts = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A value that only goes up, one per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name:str, help:str, labels:tuple=(), collect=None):
+        """
+        :param name: The metric name
+        :param help: The HELP text
+        :param labels: The label names
+        :param collect: Called when rendering instead of keeping values, returns label values tuple -> value
+        """
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.collect = collect
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount:float=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+    def _items(self) -> list:
+        if self.collect:
+            try:
+                return list(self.collect().items())
+            except Exception as e:
+                log("Failed to collect metric {}: {}".format(self.name, e), "WARNING")
+                return []
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        for labels, value in self._items():
+            lines.append("{}{} {}".format(self.name, _format_labels(self.label_names, labels), _format_value(value)))
+        return lines
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down.
+    """
+
+    kind = "gauge"
+
+    def set(self, value:float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Counter):
+    """
+    Counts of observations in buckets, with their sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str, labels:tuple=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # one count per bucket (not cumulative) plus +Inf, the sum and the count
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            items = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.values.items()]
+
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.label_names, labels, 'le="{}"'.format(_format_value(float(bound)))), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.label_names, labels), _format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.label_names, labels), count))
+        return lines
+
+
+def render() -> str:
+    """
+    :return: Every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Updated where the work happens
+CHANGES = Counter("watchdir_changes_total", "Changes that reached log_change", ("root",))
+FILTERED = Counter("watchdir_events_filtered_total", "Events dropped by the path filter")
+COMMITS = Counter("watchdir_commits_total", "Commits written", ("root",))
+COMMITTED_FILES = Counter("watchdir_committed_files_total", "Files included in commits", ("root",))
+COMMIT_FAILURES = Counter("watchdir_commit_failures_total", "Commits that failed", ("root",))
+UNCHANGED = Counter("watchdir_unchanged_skipped_total", "Changes skipped because the content did not change", ("root",))
+COMMIT_SECONDS = Histogram("watchdir_commit_duration_seconds", "Time to write a commit", ("root",))
+BACKUPS = Counter("watchdir_backups_total", "Backup snapshots taken", ("root", "result"))
+BACKUP_SECONDS = Gauge("watchdir_backup_duration_seconds", "Duration of the last backup snapshot", ("root",))
+REPACKS = Counter("watchdir_repacks_total", "Repacks of the repo", ("root", "kind", "result"))
+REPACK_SECONDS = Counter("watchdir_repack_seconds_total", "Time spent repacking the repo, commits wait meanwhile", ("root",))
+REPACK_RECLAIMED = Counter("watchdir_repack_reclaimed_bytes_total", "Disk space freed by repacks", ("root",))
+LOG_LINES = Counter("watchdir_log_lines_total", "Lines written by each logger", ("log",))
+LOG_ROTATIONS = Counter("watchdir_log_rotations_total", "Rotations of each log file", ("log",))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.connection.settimeout(1)
+        try:
+            request = self.connection.recv(4096)
+        except (socket.timeout, OSError):
+            request = b""
+
+        body = render().encode()
+        if request.startswith(b"GET"):
+            body = b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + \
+                   str(len(body)).encode() + b"\r\n\r\n" + body
+        try:
+            self.wfile.write(body)
+        except OSError:
+            # the client went away
+            pass
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Exporter:
+    """
+    Writes the metrics to a textfile every interval seconds and/or serves them on a unix socket.
+    """
+
+    def __init__(self, textfile:str=None, socket_path:str=None, interval:float=15):
+        """
+        :param textfile: The .prom file to write, None to not write one
+        :param socket_path: The unix socket to listen on, None to not listen
+        :param interval: Seconds between writes of the textfile
+        """
+        self.textfile = textfile
+        self.socket_path = socket_path
+        self.interval = interval
+        self.server = None
+        self._stop = threading.Event()
+        self.threads = []
+
+    def start(self):
+        if self.textfile:
+            thread = threading.Thread(target=self._run, name="metrics-textfile", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        if self.socket_path:
+            try:
+                if os.path.exists(self.socket_path):
+                    os.unlink(self.socket_path)
+                self.server = _UnixServer(self.socket_path, _Handler)
+                os.chmod(self.socket_path, 0o600)
+            except OSError as e:
+                log("Failed to listen on metrics socket {}: {}".format(self.socket_path, e), "ERROR")
+                self.server = None
+            else:
+                thread = threading.Thread(target=self.server.serve_forever, args=(1,), name="metrics-socket", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def write(self) -> bool:
+        """
+        Write the textfile, atomically so the collector never reads half of it.
+        :return: True if the file was written, False otherwise.
+        """
+        tmp = self.textfile + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(render())
+            os.replace(tmp, self.textfile)
+        except OSError as e:
+            log("Failed to write metrics to {}: {}".format(self.textfile, e), "ERROR")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            self.write()
+            if self._stop.wait(self.interval):
+                break
+
+    def close(self):
+        self._stop.set()
+        if self.textfile:
+            self.write()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
@@ -0,0 +1,243 @@
+"""
+Path filter for watchdir.
+
+Rules use gitignore syntax and are compiled once into a single matcher:
+
+- `*.ext` style patterns go into a suffix tuple checked with str.endswith
+- plain names (`node_modules`, `.git`) go into a set checked against every path component
+- anchored literal paths (`/var/cache`) go into a trie of path components
+- everything else is translated to a regex, all of them joined into one compiled pattern
+
+A `!pattern` line (or --include) re-includes paths an exclude rule matched. Unlike git, the order of the
+rules does not matter: a path is excluded when any exclude rule matches and no include rule does.
+"""
+
+import os
+import re
+
+
+# The files watchable() used to skip: editor swap files, partial downloads, locks, logs and git's own files
+DEFAULT_RULES = [
+    ".git",
+    "*.swp",
+    "*.swx",
+    "*.swpx",
+    "*~",
+    "*.part",
+    "*.crdownload",
+    "*.tmp",
+    "*.temp",
+    "*.lock",
+    "*.log",
+]
+
+# Pseudo filesystems, never watched no matter where the watched directory is
+ABSOLUTE_EXCLUDES = [
+    "/proc",
+    "/sys",
+    "/run",
+]
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def _glob_to_regex(pattern:str) -> str:
+    """
+    Translate a gitignore glob to a regex fragment, `*` and `?` never match a slash and `**` matches across directories.
+    """
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern.startswith("**/", i):
+                out.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern.startswith("**", i):
+                out.append(".*")
+                i += 2
+                continue
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class _RuleSet:
+    """
+    One side of the filter, either the exclude or the include rules, compiled into fast lookups.
+    """
+
+    def __init__(self):
+        # tuples, so str.endswith can check all of them at once
+        self.suffixes = ()
+        self.dir_suffixes = ()
+        self.names = set()
+        self.dir_names = set()
+        self.trie = {}
+        self.regexes = []
+        self.regex = None
+
+    def add(self, pattern:str):
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            return
+
+        anchored = pattern.startswith("/") or "/" in pattern.lstrip("/")
+        pattern = pattern.lstrip("/")
+        has_glob = _GLOB_CHARS.search(pattern) is not None
+
+        # *.ext, *~
+        if not anchored and pattern.startswith("*") and not _GLOB_CHARS.search(pattern[1:]):
+            if dir_only:
+                self.dir_suffixes += (pattern[1:],)
+            else:
+                self.suffixes += (pattern[1:],)
+        # plain name, matches at any depth
+        elif not anchored and not has_glob:
+            (self.dir_names if dir_only else self.names).add(pattern)
+        # literal path from the root
+        elif anchored and not has_glob and not dir_only:
+            node = self.trie
+            for part in pattern.split("/"):
+                node = node.setdefault(part, {})
+            node[None] = True
+        else:
+            regex = _glob_to_regex(pattern)
+            prefix = "^" if anchored else "(?:^|.*/)"
+            # matches the path itself or anything below it, dir only rules need something below (or a trailing slash)
+            suffix = "/.*$" if dir_only else "(?:/.*)?$"
+            self.regexes.append(prefix + regex + suffix)
+
+    def compile(self):
+        self.regex = re.compile("|".join(self.regexes)) if self.regexes else None
+
+    def matches(self, relative:str, parts:list, is_dir:bool) -> bool:
+        last = len(parts) - 1
+        for i, part in enumerate(parts):
+            if part in self.names or (self.suffixes and part.endswith(self.suffixes)):
+                return True
+            # dir only rules match every component but the last one, unless the path itself is a directory
+            if i < last or is_dir:
+                if part in self.dir_names or (self.dir_suffixes and part.endswith(self.dir_suffixes)):
+                    return True
+
+        if self.trie:
+            node = self.trie
+            for part in parts:
+                node = node.get(part)
+                if node is None:
+                    break
+                if None in node:
+                    return True
+
+        if self.regex is not None:
+            if self.regex.match(relative + "/" if is_dir else relative):
+                return True
+
+        return False
+
+
+class PathFilter:
+    """
+    Decides which paths under a watched directory are watched.
+    """
+
+    def __init__(self, root:str, rules:list=None, includes:list=None, absolute_excludes:list=None):
+        """
+        :param root: The watched directory, rules are matched against paths relative to it
+        :param rules: gitignore style rules, `!pattern` re-includes a path
+        :param includes: Extra patterns that re-include paths
+        :param absolute_excludes: Absolute path prefixes that are never watched
+        """
+        self.root = os.path.abspath(root)
+        self.excludes = _RuleSet()
+        self.includes = _RuleSet()
+        self.absolute_excludes = tuple(absolute_excludes if absolute_excludes is not None else ABSOLUTE_EXCLUDES)
+
+        for rule in DEFAULT_RULES if rules is None else rules:
+            self.add_rule(rule)
+        for pattern in includes or []:
+            self.includes.add(pattern)
+
+        self.compile()
+
+    def add_rule(self, rule:str):
+        """
+        Add a gitignore style rule, call compile() once every rule was added.
+        :param rule: The rule, `!pattern` re-includes a path
+        """
+        rule = rule.strip()
+        if not rule or rule.startswith("#"):
+            return
+
+        if rule.startswith("!"):
+            self.includes.add(rule[1:])
+        else:
+            self.excludes.add(rule)
+
+    def add_file(self, path:str):
+        """
+        Add the rules of a gitignore style file, call compile() once every rule was added.
+        :param path: The file to read
+        """
+        with open(path) as f:
+            for line in f:
+                self.add_rule(line)
+
+    def compile(self):
+        self.excludes.compile()
+        self.includes.compile()
+
+    def excluded(self, path:str, is_dir:bool=False) -> bool:
+        """
+        Check if a path is excluded.
+        :param path: The absolute path
+        :param is_dir: True if the path is a directory, dir only rules (ending with /) then match it as well
+        :return: True if the path should not be watched, False otherwise.
+        """
+        for prefix in self.absolute_excludes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return True
+
+        if path == self.root:
+            return False
+
+        if path.startswith(self.root + "/"):
+            relative = path[len(self.root) + 1:]
+        elif self.root == "/":
+            relative = path[1:]
+        else:
+            relative = path.lstrip("/")
+
+        parts = relative.split("/")
+        if not self.excludes.matches(relative, parts, is_dir):
+            return False
+
+        return not self.includes.matches(relative, parts, is_dir)
+
+    def excluded_dir(self, path:str) -> bool:
+        """
+        Check if a directory is excluded, used to skip it when registering watches.
+        :param path: The absolute path of the directory
+        """
+        return self.excluded(path, True)
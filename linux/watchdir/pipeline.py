@@ -0,0 +1,332 @@
+"""
+Event pipeline for watchdir.
+
+A reader thread drains the event source as fast as it can into a bounded queue, worker threads take
+events off the queue and run them through the processing stages (filtering, logging, committing).
+A slow commit therefore never stops events from being read, so the kernel queue does not overflow.
+
+When the queue is full the event is dropped and its directory is marked for a resync. Kernel queue
+overflows mark the whole watched directory. Marked subtrees are rescanned once the workers are idle.
+
+With several watched directories every directory gets its own bounded queue and the workers take events
+from them in turn, so a burst in one directory neither delays nor drops the events of the others.
+"""
+
+from collections import deque
+from util import log
+import event_source
+import os
+import queue
+import threading
+import time
+
+
+class StageStats:
+    """
+    Latency of a pipeline stage.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed:float):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+class FairQueue:
+    """
+    One bounded FIFO per key, get() takes from the keys in turn.
+    Same interface as the parts of queue.Queue the pipeline uses.
+    """
+
+    def __init__(self, maxsize:int, route=None):
+        """
+        :param maxsize: The number of items each key holds before put_nowait raises queue.Full
+        :param route: Called with every item, returns its key. Everything shares one queue when it is None
+        """
+        self.maxsize = maxsize
+        self.route = route
+        self.queues = {}
+        # keys with queued items, in the order they are served
+        self.ready = deque()
+        self.size = 0
+        self.not_empty = threading.Condition()
+
+    def put_nowait(self, item):
+        key = self.route(item) if self.route else None
+        with self.not_empty:
+            items = self.queues.get(key)
+            if items is None:
+                items = self.queues[key] = deque()
+            if len(items) >= self.maxsize:
+                raise queue.Full
+            if not items:
+                self.ready.append(key)
+            items.append(item)
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self, timeout:float=None):
+        with self.not_empty:
+            if not self.size and not self.not_empty.wait_for(lambda: self.size, timeout):
+                raise queue.Empty
+
+            key = self.ready.popleft()
+            items = self.queues[key]
+            item = items.popleft()
+            if items:
+                # back of the line, the other keys go first
+                self.ready.append(key)
+            self.size -= 1
+            return item
+
+    def qsize(self) -> int:
+        return self.size
+
+    def empty(self) -> bool:
+        return not self.size
+
+    def depths(self) -> dict:
+        """
+        :return: key -> number of queued items
+        """
+        with self.not_empty:
+            return {key: len(items) for key, items in self.queues.items()}
+
+
+class Pipeline:
+    """
+    Reader thread -> bounded queue -> worker threads running the stages.
+    """
+
+    def __init__(self, source, stages:list, resync, max_queue:int=10000, workers:int=1, resync_delay:float=1, route=None):
+        """
+        :param source: The event source, see event_source.get_event_source
+        :param stages: A list of (name, stage) pairs. A stage is either a function called with the event_source.Event
+                       that returns False to stop processing the event, or a coalesce.Coalescer: events are fed to it
+                       and the changes it emits continue with the stages after it
+        :param resync: Called with a directory whose events were lost, it should rescan it
+        :param max_queue: The number of events the queue of each watched directory holds before events are dropped
+        :param workers: The number of worker threads
+        :param resync_delay: Seconds the workers have to be idle before marked subtrees are rescanned
+        :param route: Called with every event, returns the watched directory it belongs to. Events of different
+                      directories are queued separately and handled in turn
+        """
+        self.source = source
+        self.stages = stages
+        self.resync = resync
+        self.queue = FairQueue(max_queue, (lambda item: route(item[0])) if route else None)
+        self.workers = workers
+        self.resync_delay = resync_delay
+        self.threads = []
+        self.stopped = threading.Event()
+        # set once the event source watches every directory
+        self.watching = threading.Event()
+
+        self.lock = threading.Lock()
+        self.resync_paths = set()
+        self.received = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.resyncs = 0
+        self.last_resync = time.time()
+        self.stage_stats = {"queue": StageStats()}
+        for name, _ in stages:
+            self.stage_stats[name] = StageStats()
+        self.stage_stats["resync"] = StageStats()
+
+        # workers wake up often enough to pass on what the coalescers emit, and drain them at most once per tick
+        self.tick = resync_delay
+        self.last_drain = time.time()
+        for _, stage in stages:
+            if hasattr(stage, "feed"):
+                self.tick = min(self.tick, max(stage.quiet_period / 4, 0.01))
+
+    def start(self):
+        reader = threading.Thread(target=self._read, name="pipeline-reader", daemon=True)
+        reader.start()
+        self.threads.append(reader)
+
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name="pipeline-worker-{}".format(i), daemon=True)
+            worker.start()
+            self.threads.append(worker)
+
+    def mark_resync(self, path:str):
+        """
+        Mark a directory to be rescanned because some of its events were lost.
+        :param path: The directory
+        """
+        with self.lock:
+            self.resync_paths.add(path)
+
+    def _read(self):
+        try:
+            self.source.open()
+        except OSError as e:
+            log("Failed to start event source: {}".format(e), "ERROR")
+            self.stopped.set()
+            self.watching.set()
+            return
+
+        self.watching.set()
+
+        put = self.queue.put_nowait
+        while not self.stopped.is_set():
+            try:
+                events = self.source.read_events(1)
+            except Exception as e:
+                if not self.stopped.is_set():
+                    log("Error reading events: {}".format(e), "ERROR")
+                break
+
+            now = time.time()
+            for event in events:
+                self.received += 1
+
+                if event.event == event_source.OVERFLOW:
+                    self.overflows += 1
+                    self.mark_resync(event.path)
+                    continue
+
+                try:
+                    put((event, now))
+                except queue.Full:
+                    # drop the event, the resync scan will pick the change up later
+                    self.dropped += 1
+                    self.mark_resync(os.path.dirname(event.path))
+
+        self.stopped.set()
+
+    def replay(self, event, after:str):
+        """
+        Run an event that was held back by a stage through the stages after it.
+        :param event: The event_source.Event
+        :param after: The name of the stage that held it
+        """
+        names = [name for name, _ in self.stages]
+        self._run_stages(event, names.index(after) + 1)
+
+    def _run_stages(self, event, first:int=0):
+        stats = self.stage_stats
+        start = time.time()
+
+        for index in range(first, len(self.stages)):
+            name, stage = self.stages[index]
+
+            if hasattr(stage, "feed"):
+                stage.feed(event)
+                stats[name].add(time.time() - start)
+                return
+
+            try:
+                keep = stage(event)
+            except Exception as e:
+                log("Error in {} stage for {}: {}".format(name, event.path, e), "ERROR")
+                keep = False
+
+            end = time.time()
+            stats[name].add(end - start)
+            start = end
+
+            if keep is False:
+                return
+
+    def _drain_coalescers(self):
+        self.last_drain = time.time()
+        for index, (_, stage) in enumerate(self.stages):
+            if hasattr(stage, "ready"):
+                for change in stage.ready():
+                    self._run_stages(change, index + 1)
+
+    def _work(self):
+        while not self.stopped.is_set() or not self.queue.empty():
+            try:
+                event, queued = self.queue.get(timeout=self.tick)
+            except queue.Empty:
+                self._drain_coalescers()
+                if time.time() - self.last_resync >= self.resync_delay:
+                    self._resync()
+                continue
+
+            self.stage_stats["queue"].add(time.time() - queued)
+            self._run_stages(event)
+            # a steady stream of events never lets the get above time out
+            if time.time() - self.last_drain >= self.tick:
+                self._drain_coalescers()
+
+            # don't let a steady stream of events hold back resyncs forever, run them once the queue is half empty
+            if self.resync_paths and self.queue.qsize() < self.queue.maxsize // 2 and time.time() - self.last_resync > self.resync_delay * 10:
+                self._resync()
+
+        # pass on whatever is still pending
+        for index, (_, stage) in enumerate(self.stages):
+            if hasattr(stage, "ready"):
+                for change in stage.ready(float("inf")):
+                    self._run_stages(change, index + 1)
+
+    def _resync(self):
+        self.last_resync = time.time()
+        with self.lock:
+            if not self.resync_paths:
+                return
+            paths = sorted(self.resync_paths)
+            self.resync_paths = set()
+
+        # a marked directory covers everything below it
+        roots = []
+        for path in paths:
+            if roots and (path == roots[-1] or path.startswith(roots[-1].rstrip("/") + "/")):
+                continue
+            roots.append(path)
+
+        for path in roots:
+            log("Resyncing {} after lost events".format(path), "WARNING")
+            start = time.time()
+            try:
+                self.resync(path)
+            except Exception as e:
+                log("Failed to resync {}: {}".format(path, e), "ERROR")
+            self.stage_stats["resync"].add(time.time() - start)
+            self.resyncs += 1
+
+    def stats(self) -> dict:
+        """
+        :return: Queue depth, event counters and per stage latencies
+        """
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_max": self.queue.maxsize,
+            "queues": self.queue.depths(),
+            "received": self.received,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+            "resyncs": self.resyncs,
+            "pending_resyncs": len(self.resync_paths),
+            "stages": {name: stage.as_dict() for name, stage in self.stage_stats.items()},
+            "coalesce": {name: stage.stats() for name, stage in self.stages if hasattr(stage, "stats")},
+        }
+
+    def join(self):
+        """
+        Wait until the reader stops and the workers finished the queued events.
+        """
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def stop(self):
+        self.stopped.set()
+        self.source.close()
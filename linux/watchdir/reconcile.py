@@ -0,0 +1,341 @@
+"""
+Reconciliation of the changes made while watchdir was not running.
+
+While watchdir runs every change reaches the repo through an event, but a file changed while it was stopped
+is only committed once it is changed again. `git status` finds those changes, but on a tree with millions of
+files it reads the whole index, stats every file and rehashes the ones whose index entry is stale, which
+takes minutes.
+
+Instead every repo keeps a stat index: path -> (inode, size, mtime_ns, mode) of each file as it was last
+committed or scanned, saved next to the repo like the fingerprint index. At start the tree is walked with
+several os.scandir workers and compared with it. Only the new, deleted and changed files are hashed (through
+the fingerprint index, so a touch is not a change) and committed, in one "offline changes" commit. The scan
+then becomes the new index.
+
+A repo without a stat index yet, e.g. one created by an older watchdir, is compared with `git status` once.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from util import log
+import os
+import queue
+import stat
+import struct
+import threading
+import time
+
+
+MAGIC = b"WDST1\n"
+# the number of entries, then every (inode, size, mtime_ns, mode) and then the paths separated by NUL, so a
+# million entries are read with one unpack and one decode instead of one per entry
+_COUNT = struct.Struct("<Q")
+_ENTRY = struct.Struct("<QQqI")
+
+INDEX_FILE = "stat.idx"
+# the entry of a file whose commit was lost, it matches no real stat
+INVALID = (0, 0, -1, 0)
+
+
+def _entry(st:os.stat_result) -> tuple:
+    return st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode
+
+
+def _git_mode(mode:int) -> tuple:
+    # the part of the mode git stores: the file type and the executable bit
+    return stat.S_IFMT(mode), bool(mode & stat.S_IXUSR)
+
+
+class StatIndex:
+    """
+    path -> (inode, size, mtime_ns, mode) of every file of a watched directory as it was last committed or scanned.
+    """
+
+    def __init__(self, index_file:str=None):
+        """
+        :param index_file: Where the index is saved, it is loaded right away if it exists
+        """
+        self.index_file = index_file
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        # False until the index was loaded or filled by a scan, a repo without one is compared with git status
+        self.loaded = False
+
+        if index_file and os.path.isfile(index_file):
+            self.load()
+
+    def snapshot(self, files:list) -> dict:
+        """
+        Stat files before they are committed, the content committed is then at least as new as the stat.
+        :param files: Absolute paths
+        :return: path -> entry, or None for the files that don't exist
+        """
+        entries = {}
+        for file in files:
+            try:
+                entries[file] = _entry(os.lstat(file))
+            except OSError:
+                entries[file] = None
+        return entries
+
+    def update(self, entries:dict):
+        """
+        Record the entries of a snapshot once its files were committed.
+        :param entries: The result of snapshot
+        """
+        with self.lock:
+            for file, entry in entries.items():
+                if entry is None:
+                    self.entries.pop(file, None)
+                else:
+                    self.entries[file] = entry
+            self.dirty = True
+
+    def invalidate(self, files:list):
+        """
+        Mark files as not committed, for example because their commit was lost. Their entries match no stat,
+        so the next start commits them again, or their deletion if they are gone by then.
+        :param files: Absolute paths
+        """
+        with self.lock:
+            for file in files:
+                self.entries[file] = INVALID
+            self.dirty = True
+
+    def replace(self, entries:dict):
+        """
+        Replace the whole index, with the result of a scan.
+        :param entries: path -> entry
+        """
+        with self.lock:
+            self.entries = entries
+            self.dirty = True
+            self.loaded = True
+
+    def load(self):
+        """
+        Load the index from index_file, a missing or damaged file leaves the index empty.
+        """
+        try:
+            with open(self.index_file, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            log("Failed to read stat index {}: {}".format(self.index_file, e), "ERROR")
+            return
+
+        if not data.startswith(MAGIC):
+            log("Ignoring stat index {} with unknown format".format(self.index_file), "WARNING")
+            return
+
+        try:
+            count, = _COUNT.unpack_from(data, len(MAGIC))
+            start = len(MAGIC) + _COUNT.size
+            end = start + count * _ENTRY.size
+            paths = os.fsdecode(data[end:]).split("\0") if count else []
+            if len(data) < end or len(paths) != count:
+                raise ValueError
+        except (struct.error, ValueError):
+            # a truncated index can't be trusted, the files it lost would never be compared
+            log("Stat index {} is truncated, ignoring it".format(self.index_file), "WARNING")
+            return
+        entries = dict(zip(paths, _ENTRY.iter_unpack(data[start:end])))
+
+        with self.lock:
+            self.entries = entries
+            self.dirty = False
+            self.loaded = True
+
+    def save(self) -> bool:
+        """
+        Write the index to index_file if it changed, the file is replaced atomically.
+        :return: True if the index is saved, False otherwise.
+        """
+        if not self.index_file or not self.dirty or not self.loaded:
+            return True
+
+        with self.lock:
+            items = list(self.entries.items())
+            self.dirty = False
+
+        pack = _ENTRY.pack
+        parts = [MAGIC, _COUNT.pack(len(items))]
+        parts += [pack(*entry) for _, entry in items]
+        parts.append(os.fsencode("\0".join(path for path, _ in items)))
+
+        tmp = self.index_file + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(b"".join(parts))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.index_file)
+        except OSError as e:
+            log("Failed to save stat index {}: {}".format(self.index_file, e), "ERROR")
+            self.dirty = True
+            return False
+
+        return True
+
+
+class Scanner:
+    """
+    Stats every file of a watched directory with several os.scandir workers.
+    """
+
+    def __init__(self, watch_dir:str, exclude=None, workers:int=8):
+        """
+        :param watch_dir: The watched directory
+        :param exclude: Called with (path, is_dir), the path is skipped when it returns True
+        :param workers: Threads listing directories
+        """
+        self.watch_dir = watch_dir
+        self.exclude = exclude
+        self.workers = max(1, workers)
+        self.directories = queue.Queue()
+        self.lock = threading.Lock()
+        # directories queued or being listed, the scan is done when it drops to 0
+        self.outstanding = 0
+        self.entries = {}
+        # directories that could not be listed, their files are not missing
+        self.failed = []
+
+    def _walk(self):
+        git_file = os.path.join(self.watch_dir, ".git")
+        while True:
+            directory = self.directories.get()
+            if directory is None:
+                return
+
+            # collected per directory, the shared dict is only locked once for all of them
+            found = {}
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+
+                        is_dir = stat.S_ISDIR(st.st_mode)
+                        if entry.path == git_file or (self.exclude and self.exclude(entry.path, is_dir)):
+                            continue
+
+                        if is_dir:
+                            with self.lock:
+                                self.outstanding += 1
+                            self.directories.put(entry.path)
+                        elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                            found[entry.path] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+            except OSError as e:
+                log("Failed to list {}: {}".format(directory, e), "WARNING")
+                with self.lock:
+                    self.failed.append(directory.rstrip("/") + "/")
+
+            with self.lock:
+                self.entries.update(found)
+                self.outstanding -= 1
+                done = self.outstanding == 0
+
+            if done:
+                for _ in range(self.workers):
+                    self.directories.put(None)
+
+    def run(self) -> dict:
+        """
+        :return: path -> (inode, size, mtime_ns, mode) of every regular file and symlink
+        """
+        self.outstanding = 1
+        self.directories.put(self.watch_dir)
+        threads = [threading.Thread(target=self._walk, name="reconcile-scan-{}".format(i), daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.entries
+
+
+def changed_files(previous:dict, current:dict, fingerprints=None, workers:int=8) -> tuple:
+    """
+    Compare two scans of a tree.
+    :param previous: path -> entry, the stat index
+    :param current: path -> entry, the scan
+    :param fingerprints: The FingerprintIndex of the repo, files whose stat changed are only changes if their
+                         content differs from it. Without one every file whose stat changed is a change.
+    :param workers: Threads hashing files
+    :return: (changed or new files, deleted files, files hashed)
+    """
+    changed = []
+    candidates = []
+    for path, entry in current.items():
+        old = previous.get(path)
+        if old == entry:
+            continue
+        if old is not None and old[:3] == entry[:3]:
+            # chmod, only a change for git if the type or the executable bit changed
+            if _git_mode(old[3]) != _git_mode(entry[3]):
+                changed.append(path)
+        elif fingerprints is None:
+            changed.append(path)
+        else:
+            candidates.append(path)
+
+    if candidates:
+        # hashlib releases the GIL on large buffers, the files are hashed in parallel
+        with ThreadPoolExecutor(max(1, workers)) as pool:
+            changed += [path for path, differs in zip(candidates, pool.map(fingerprints.changed, candidates)) if differs]
+
+    deleted = [path for path in previous if path not in current]
+    return changed, deleted, len(candidates)
+
+
+def reconcile(repo, exclude=None, workers:int=8) -> bool:
+    """
+    Commit the changes made to a watched directory while watchdir was not running.
+    The directory may already be watched, the changes seen meanwhile are committed on their own as usual.
+    :param repo: The git_utils.Repo, with a stat index
+    :param exclude: Called with (path, is_dir), the path is skipped when it returns True
+    :param workers: Threads listing directories and hashing files
+    :return: True if the changes were committed or there were none, False otherwise.
+    """
+    index = repo.stat_index
+    start = time.time()
+    scanner = Scanner(repo.watch_dir, exclude, workers)
+    current = scanner.run()
+    scanned = time.time() - start
+
+    if scanner.failed:
+        # what was under them is kept as it is known
+        failed = tuple(scanner.failed)
+        for path, entry in index.entries.items():
+            if path.startswith(failed) and path not in current:
+                current[path] = entry
+
+    if not index.loaded:
+        log("No stat index for {}, comparing it with git status once".format(repo.watch_dir), "WARNING")
+        committed = repo.resync(repo.watch_dir, lambda file: exclude and exclude(file, False), "a start without a stat index")
+        if committed:
+            index.replace(current)
+            index.save()
+        return committed
+
+    changed, deleted, hashed = changed_files(index.entries, current, repo.fingerprints, workers)
+    files = sorted(changed + deleted)
+    committed = repo.commit_offline(files) if files else True
+
+    if committed:
+        if repo.fingerprints:
+            for file in deleted:
+                repo.fingerprints.forget(file)
+    else:
+        # keep what the index knew about them, they are compared again on the next start
+        for file in files:
+            if file in index.entries:
+                current[file] = index.entries[file]
+            else:
+                current.pop(file, None)
+    index.replace(current)
+    index.save()
+
+    log("Reconciled {} in {:.2f}s: {} files scanned in {:.2f}s, {} hashed, {} changed, {} deleted".format(
+        repo.watch_dir, time.time() - start, len(current), scanned, hashed, len(changed), len(deleted)))
+    return committed
@@ -0,0 +1,442 @@
+"""
+Point in time restore of a watched directory.
+
+    python3 main.py restore /etc --at "2026-10-18 02:00"
+    python3 main.py restore /etc --commit 1a2b3c4 passwd ssh/
+
+The files as they were at a commit, or at the last commit before a time, are compared with the watched
+directory and only the ones that differ are written back, on several threads, with their mode. Files that
+were committed after that point are deleted, unless --keep-new is given.
+
+Nothing in the working tree is compared by reading it if its fingerprint (see fingerprint.py) says it did
+not change since it was committed, so a restore of a few files in a large tree is fast.
+
+While a restore runs a marker next to the repo lists the files it writes. A running watchdir does not commit
+them one by one, it commits them together once the restore is done (see git_utils.Repo.commit_restore).
+Without a running watchdir the restore commits them itself.
+
+The fast-import writer of a running watchdir only moves the branch at its checkpoints, up to
+GIT_CHECKPOINT_INTERVAL seconds apart, so the branch may lack the newest commits. Before it reads the branch
+the restore asks the watcher to checkpoint and waits for its answer (see request_checkpoint). If no answer
+comes the restore goes on with a warning: --at may then pick an older commit than the newest one before the
+time, and files committed since the last checkpoint are not deleted.
+
+If the repo can't be read, the restore falls back to the backup snapshots (see backups.py).
+"""
+
+from util import log, exit_with_error
+from concurrent.futures import ThreadPoolExecutor
+from fingerprint import FingerprintIndex
+from git_writer import blob_sha
+import argparse
+import backups
+import config
+import console
+import git_utils
+import hashlib
+import json
+import largefiles
+import os
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class _CatFile:
+    """
+    One `git cat-file --batch` per thread, reading every blob of the restore through a pipe.
+    """
+
+    def __init__(self, git_dir:str):
+        self.git_dir = git_dir
+        self.local = threading.local()
+        self.processes = []
+        self.lock = threading.Lock()
+
+    def read(self, sha:str) -> bytes:
+        process = getattr(self.local, "process", None)
+        if process is None:
+            process = subprocess.Popen(["git", "--git-dir", self.git_dir, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.local.process = process
+            with self.lock:
+                self.processes.append(process)
+
+        process.stdin.write(sha.encode() + b"\n")
+        process.stdin.flush()
+        header = process.stdout.readline().split()
+        if len(header) != 3:
+            raise OSError("Object {} is missing".format(sha))
+        content = process.stdout.read(int(header[2]))
+        process.stdout.read(1)
+        return content
+
+    def close(self):
+        for process in self.processes:
+            process.stdin.close()
+            process.wait()
+
+
+def _ls_tree(git_dir:str, rev:str, paths:list) -> dict:
+    """
+    :return: relative path -> (mode, sha, size) of every file under paths in a commit
+    """
+    res = console.run(["git", "--git-dir", git_dir, "ls-tree", "-r", "-z", "-l", "--full-tree", rev, "--"] + paths, text=False)
+    if res.returncode != 0:
+        raise OSError(res.stderr.decode(errors="replace").strip())
+
+    entries = {}
+    for entry in res.stdout.split(b"\0"):
+        if not entry:
+            continue
+        info, _, path = entry.partition(b"\t")
+        mode, _, sha, size = info.split()
+        entries[os.fsdecode(path)] = (mode.decode(), sha.decode(), int(size) if size != b"-" else 0)
+    return entries
+
+
+def resolve(git_dir:str, commit:str=None, at:str=None, refs:list=None):
+    """
+    :param git_dir: The repo or the snapshot store
+    :param commit: A commit, anything git rev-parse understands
+    :param at: A time, anything git understands for --before, the last commit before it is used
+    :param refs: Where to look for commits before the time, defaults to the main branch
+    :return: The full sha of the commit, or None if there is none
+    """
+    if commit:
+        res = console.run(["git", "--git-dir", git_dir, "rev-parse", "--verify", "-q", commit + "^{commit}"])
+    else:
+        res = console.run(["git", "--git-dir", git_dir, "rev-list", "-1", "--before={}".format(at)] + (refs or ["refs/heads/main"]))
+    sha = res.stdout.strip()
+    return sha if res.returncode == 0 and sha else None
+
+
+class Restore:
+    """
+    Restores files of a watched directory to how they were at a commit.
+    """
+
+    def __init__(self, repo:git_utils.Repo, workers:int=8, keep_new:bool=False, from_backup:bool=False):
+        """
+        :param repo: The git_utils.Repo of the watched directory
+        :param workers: Threads comparing and writing files
+        :param keep_new: Don't delete files that were committed after the restored commit
+        :param from_backup: Read the commits from the backup snapshots even if the repo is fine
+        """
+        self.repo = repo
+        self.watch_dir = repo.watch_dir
+        self.workers = max(1, workers)
+        self.keep_new = keep_new
+        self.git_dir = repo.repo_dir
+        self.from_backup = from_backup or not self._repo_ok()
+        if self.from_backup:
+            self.git_dir = repo.backup_dir()
+
+        base = os.path.dirname(repo.repo_dir)
+        self.fingerprints = FingerprintIndex(os.path.join(base, "fingerprints.idx"))
+        # backups taken before the snapshot store kept chunks use the live store
+        chunks = repo.backup_chunks_dir()
+        self.store = largefiles.ChunkStore(chunks if self.from_backup and os.path.isdir(chunks) else os.path.join(base, "chunks"))
+
+        self.lock = threading.Lock()
+        self.written = 0
+        self.chmoded = 0
+        self.deleted = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def _repo_ok(self) -> bool:
+        res = console.run(["git", "--git-dir", self.repo.repo_dir, "rev-parse", "--verify", "-q", "refs/heads/main^{commit}"])
+        if res.returncode != 0:
+            log("The repo of {} can't be read, restoring from the backups".format(self.watch_dir), "WARNING")
+            return False
+        return True
+
+    def head(self):
+        """
+        :return: The newest commit, the branch of the repo or the newest backup snapshot. With a running watchdir
+                 the branch is only current after request_checkpoint
+        """
+        if not self.from_backup:
+            return resolve(self.git_dir, "refs/heads/main")
+        snapshots = backups.list_snapshots(self.git_dir)
+        if snapshots:
+            return snapshots[-1][2]
+        return resolve(self.git_dir, "refs/backups/initial")
+
+    def resolve(self, commit:str=None, at:str=None):
+        refs = None
+        if self.from_backup:
+            refs = ["--glob=" + backups.SNAPSHOT_PREFIX + "*", "--glob=" + backups.PROTECTED_PREFIX + "*"]
+        return resolve(self.git_dir, commit, at, refs)
+
+    def _current_sha(self, path:str, st:os.stat_result) -> str:
+        # the fingerprint of the last committed content, if the file was not touched since
+        entry = self.fingerprints.entries.get(path)
+        if entry is not None and entry[0] == st.st_ino and entry[1] == st.st_size and entry[2] == st.st_mtime_ns:
+            return entry[3].hex()
+
+        if stat.S_ISLNK(st.st_mode):
+            return blob_sha(os.fsencode(os.readlink(path)))
+        with open(path, "rb") as f:
+            return blob_sha(f.read())
+
+    def _compare(self, relative:str, target:tuple):
+        """
+        :return: The change needed to restore a file: None, "chmod" or "write"
+        """
+        mode, sha, size = target
+        path = os.path.join(self.watch_dir, relative)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return "write"
+
+        if mode == "120000":
+            if not stat.S_ISLNK(st.st_mode):
+                return "write"
+        elif not stat.S_ISREG(st.st_mode):
+            return "write"
+        elif st.st_size != size:
+            # different size, different content, no need to read it
+            return "write"
+
+        if self._current_sha(path, st) != sha:
+            return "write"
+
+        if mode != "120000" and (mode == "100755") != bool(st.st_mode & stat.S_IXUSR):
+            return "chmod"
+        return None
+
+    def plan(self, commit:str, paths:list) -> list:
+        """
+        Compare the watched directory with a commit.
+        :param commit: The commit to restore
+        :param paths: Paths relative to the watched directory to restore, all of it if empty
+        :return: A list of (change, relative path, (mode, sha, size)), change is write, chmod or delete
+        """
+        target = _ls_tree(self.git_dir, commit, paths)
+
+        items = sorted(target.items())
+        with ThreadPoolExecutor(self.workers) as pool:
+            changes = [(change, relative, entry) for change, (relative, entry) in
+                       zip(pool.map(lambda item: self._compare(*item), items), items) if change]
+        self.unchanged = len(items) - len(changes)
+
+        if not self.keep_new:
+            head = self.head()
+            if head and head != commit:
+                for relative, entry in sorted(_ls_tree(self.git_dir, head, paths).items()):
+                    if relative not in target and os.path.lexists(os.path.join(self.watch_dir, relative)):
+                        changes.append(("delete", relative, entry))
+
+        return changes
+
+    def _write(self, path:str, content:bytes, mode:str, stub:dict=None):
+        try:
+            old = os.lstat(path)
+        except OSError:
+            old = None
+
+        if old is not None and stat.S_ISDIR(old.st_mode):
+            raise OSError("{} is a directory now".format(path))
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        if mode == "120000":
+            if old is not None:
+                os.unlink(path)
+            os.symlink(os.fsdecode(content), path)
+            return
+
+        # written next to the file and renamed over it, the file is never half restored
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".watchdir_restore_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if stub:
+                    largefiles.write_content(stub, self.store, f)
+                else:
+                    f.write(content)
+
+                # git only keeps the executable bit, the other permissions and the owner are kept from the file
+                perms = old.st_mode & 0o7777 if old is not None and stat.S_ISREG(old.st_mode) else 0o644
+                perms = perms | 0o111 if mode == "100755" else perms & ~0o111
+                os.fchmod(f.fileno(), perms)
+                if old is not None and os.geteuid() == 0:
+                    os.fchown(f.fileno(), old.st_uid, old.st_gid)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _count(self, name:str):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _apply(self, cat_file:_CatFile, change:str, relative:str, entry:tuple):
+        mode, sha, _ = entry
+        path = os.path.join(self.watch_dir, relative)
+        try:
+            if change == "delete":
+                os.unlink(path)
+                self._count("deleted")
+            elif change == "chmod":
+                perms = os.lstat(path).st_mode & 0o7777
+                os.chmod(path, perms | 0o111 if mode == "100755" else perms & ~0o111)
+                self._count("chmoded")
+            else:
+                content = cat_file.read(sha)
+                stub = largefiles.parse_stub(content) if mode != "120000" else None
+                if stub and stub.get("policy") != largefiles.CHUNKED:
+                    log("Only the size and hash of {} were kept, it can't be restored".format(path), "WARNING")
+                    self._count("skipped")
+                    return
+                if stub and os.path.isfile(path) and _sha256(path) == stub.get("sha256"):
+                    self._count("unchanged")
+                    return
+                self._write(path, content, mode, stub)
+                self._count("written")
+        except (OSError, ValueError) as e:
+            log("Failed to restore {}: {}".format(path, e), "ERROR")
+            self._count("failed")
+
+    def apply(self, changes:list):
+        """
+        Write, chmod and delete files, on several threads.
+        :param changes: From plan
+        """
+        cat_file = _CatFile(self.git_dir)
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                list(pool.map(lambda change: self._apply(cat_file, *change), changes))
+        finally:
+            cat_file.close()
+
+
+def _sha256(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(largefiles.READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_marker(repo:git_utils.Repo, commit:str, paths:list, state:str):
+    marker = {"commit": commit, "paths": paths, "state": state, "pid": os.getpid(), "time": time.time()}
+    tmp = repo.restore_marker + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(marker, f)
+    os.replace(tmp, repo.restore_marker)
+
+
+def request_checkpoint(repo:git_utils.Repo, timeout:float=10) -> bool:
+    """
+    Ask the running watchdir to put every commit it made on the branch, see git_utils.Repo.answer_checkpoint.
+    :param repo: The repo of the watched directory
+    :param timeout: Seconds to wait for the answer
+    :return: True once the watcher checkpointed, False if it did not answer in time
+    """
+    with open(repo.checkpoint_request, "w") as f:
+        f.write(str(os.getpid()))
+
+    # the watcher looks for requests every second
+    deadline = time.time() + timeout
+    while os.path.exists(repo.checkpoint_request):
+        if time.time() >= deadline:
+            try:
+                os.unlink(repo.checkpoint_request)
+            except OSError:
+                pass
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def watcher_pid(repo:git_utils.Repo):
+    """
+    :return: The pid of the watchdir process watching the directory of repo, or None if it is not watched
+    """
+    try:
+        with open(os.path.join(os.path.dirname(repo.repo_dir), git_utils.PID_FILE)) as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    return pid if git_utils.process_alive(pid) else None
+
+
+def parse_args(argv:list):
+    parser = argparse.ArgumentParser(prog="main.py restore", description="Restore files of a watched directory to how they were at a commit or a time.")
+    parser.add_argument("directory", help="The watched directory")
+    parser.add_argument("paths", nargs="*", help="Files or directories to restore, relative to the watched directory (default: all of it)")
+    point = parser.add_mutually_exclusive_group(required=True)
+    point.add_argument("--commit", help="The commit to restore")
+    point.add_argument("--at", help="Restore the last commit before this time, e.g. \"2026-10-18 02:00\" or \"2 hours ago\"")
+    parser.add_argument("--workers", type=int, default=8, help="Threads comparing and writing files (default: 8)")
+    parser.add_argument("--keep-new", action="store_true", help="Don't delete files committed after the restored commit")
+    parser.add_argument("--from-backup", action="store_true", help="Read the commits from the backup snapshots instead of the repo")
+    parser.add_argument("--dry-run", action="store_true", help="Only list what would be restored")
+    return parser.parse_intermixed_args(argv)
+
+
+def main(argv:list):
+    args = parse_args(argv)
+    config.init(args.directory)
+    repo = git_utils.Repo(config.ROOTS[0])
+
+    paths = []
+    for path in args.paths:
+        path = os.path.relpath(os.path.join(repo.watch_dir, path), repo.watch_dir)
+        if path.startswith(".."):
+            exit_with_error("{} is outside of {}".format(path, repo.watch_dir))
+        paths.append(path)
+
+    restore = Restore(repo, args.workers, args.keep_new, args.from_backup)
+    pid = watcher_pid(repo)
+    if pid and not restore.from_backup and not request_checkpoint(repo):
+        log("watchdir (pid {}) did not checkpoint, the commits of the last {}s may be missing".format(
+            pid, config.GIT_CHECKPOINT_INTERVAL), "WARNING")
+    commit = restore.resolve(args.commit, args.at)
+    if not commit:
+        exit_with_error("No commit found for {}".format(args.commit or "before " + args.at))
+
+    start = time.time()
+    try:
+        changes = restore.plan(commit, paths)
+    except OSError as e:
+        exit_with_error("Failed to read commit {}: {}".format(commit, e))
+    log("Restoring {} to {}{}: {} files to write, {} to chmod, {} to delete, {} unchanged ({:.2f}s)".format(
+        repo.watch_dir, commit, " from the backups" if restore.from_backup else "",
+        sum(1 for change in changes if change[0] == "write"), sum(1 for change in changes if change[0] == "chmod"),
+        sum(1 for change in changes if change[0] == "delete"), restore.unchanged, time.time() - start))
+
+    if args.dry_run:
+        for change, relative, _ in changes:
+            print("{:<6} {}".format(change, relative))
+        return
+
+    if not changes:
+        log("Nothing to restore")
+        return
+
+    # a running watchdir leaves these files to the restore commit instead of committing every write
+    _write_marker(repo, commit, [relative for _, relative, _ in changes], "applying")
+    restore.apply(changes)
+    _write_marker(repo, commit, [relative for _, relative, _ in changes], "done")
+    log("Restored {} files, {} chmoded, {} deleted, {} skipped, {} failed in {:.2f}s".format(
+        restore.written, restore.chmoded, restore.deleted, restore.skipped, restore.failed, time.time() - start))
+
+    pid = watcher_pid(repo)
+    if pid:
+        log("watchdir (pid {}) commits the restore".format(pid))
+    elif restore.from_backup:
+        log("The repo can't be read, the restore is not committed", "WARNING")
+        os.unlink(repo.restore_marker)
+    else:
+        repo.commit_restore()
+        repo.close()
+
+    if restore.failed:
+        exit_with_error("{} files could not be restored".format(restore.failed))
@@ -1,37 +1,17 @@
-from console import run_command_sudo, check_command
+from console import run_command_sudo
+import capabilities
 import util
 
 
 def restart_service(service_name):
-    commands = [
-        ("systemctl", "systemctl restart {}"),
-        ("service", "service {} restart"),
-        ("initctl", "initctl restart {}"),
-        ("rc-service", "rc-service {} restart"),
-        ("sv", "sv restart {}"),
-        ("openrc-service", "openrc-service {} restart"),
-        ("launchctl", "launchctl stop {} && launchctl start {}"),
-        ("rcctl", "rcctl restart {}"),
-        ("s6-svc", "s6-svc -r /run/s6/services/{}"),
-        ("supervisorctl", "supervisorctl restart {}"),
-        ("runit", "sv restart {}"),
-        ("daemontools", "svc -t /service/{}"),
-        ("sysv-rc-conf", "sysv-rc-conf {} restart"),
-        ("update-rc.d", "update-rc.d {} defaults"),
-        ("chkconfig", "chkconfig {} on")
-    ]
+    manager = capabilities.service_manager()
 
-    for cmd, command in commands:
-        if check_command(cmd):
-            if "&&" in command:
-                parts = command.split(" && ")
-                for part in parts:
-                    if not run_command_sudo(part.format(service_name)):
-                        return False
-            else:
-                if not run_command_sudo(command.format(service_name)):
-                    return False
-            return True
+    if manager is None:
+        util.log("Service manager not supported. Please restart {} manually.".format(service_name), "ERROR")
+        return False
 
-    util.log("Service manager not supported. Please restart {} manually.".format(service_name), "ERROR")
-    return False
+    # launchctl needs two commands, run one after the other
+    for part in manager[1].split(" && "):
+        if not run_command_sudo([arg.format(service_name) for arg in part.split()]):
+            return False
+    return True
@@ -0,0 +1,139 @@
+"""
+Watched directories.
+
+A WatchRoot bundles everything that belongs to one watched directory: its settings, git repo,
+loggers and path filter. All roots share one event source and one pipeline, every event is
+routed to the root whose directory contains it (config.init makes sure roots are never nested).
+"""
+
+from util import log
+import config
+import git_utils
+import logger
+import os
+import pathfilter
+import threading
+
+
+# Events held back while the initial commit is imported, the directories of any further events are rescanned instead
+MAX_HELD = 100000
+
+
+class WatchRoot:
+    """
+    One watched directory.
+    """
+
+    def __init__(self, root:config.Root):
+        """
+        :param root: The settings of the directory, see config.Root
+        """
+        self.config = root
+        self.watch_dir = root.watch_dir
+        self.prefix = root.watch_dir.rstrip("/") + "/"
+        self.repo = git_utils.Repo(root)
+        self.path_filter = self._build_path_filter()
+        # two loggers, one for changes and one for access logs, to not mix them up, makes them easier to read
+        self.log = logger.Logger(2, log_to_console=True, log_file=root.log_file, **config.log_rotation())
+        self.access_log = logger.Logger(2, log_file=root.access_log_file, **config.log_rotation())
+
+        # set while the initial commit is imported, the changes seen meanwhile are held back, see hold
+        self.importing = False
+        self.held = []
+        self.held_resyncs = set()
+        self.hold_lock = threading.Lock()
+
+    def _build_path_filter(self) -> pathfilter.PathFilter:
+        """
+        Compile the path filter from the default rules, the global and per directory filter files and exclude/include patterns.
+        """
+        path_filter = pathfilter.PathFilter(self.watch_dir)
+
+        for filter_file in (config.FILTER_FILE, self.config.filter_file):
+            if not filter_file:
+                continue
+            try:
+                path_filter.add_file(filter_file)
+            except OSError as e:
+                log("Failed to read filter file {}: {}".format(filter_file, e), "ERROR")
+
+        for rule in config.FILTER_EXCLUDES + self.config.excludes:
+            path_filter.add_rule(rule)
+        for rule in config.FILTER_INCLUDES + self.config.includes:
+            path_filter.add_rule("!" + rule)
+
+        path_filter.compile()
+        return path_filter
+
+    def hold(self, event) -> bool:
+        """
+        Hold an event back until the initial commit is imported, it is handled once the commit exists.
+        :param event: The event_source.Event
+        :return: True if the event was held, False if it can be handled now
+        """
+        with self.hold_lock:
+            if not self.importing:
+                return False
+            if len(self.held) < MAX_HELD:
+                self.held.append(event)
+            else:
+                self.held_resyncs.add(os.path.dirname(event.path))
+            return True
+
+    def hold_resync(self, path:str) -> bool:
+        """
+        Hold a rescan back until the initial commit is imported.
+        :param path: The directory to rescan
+        :return: True if the rescan was held, False if it can run now
+        """
+        with self.hold_lock:
+            if not self.importing:
+                return False
+            self.held_resyncs.add(path)
+            return True
+
+    def release(self):
+        """
+        Stop holding events back.
+        :return: (events, directories to rescan) held since the import started
+        """
+        with self.hold_lock:
+            self.importing = False
+            events, resyncs = self.held, sorted(self.held_resyncs)
+            self.held = []
+            self.held_resyncs = set()
+        return events, resyncs
+
+    def contains(self, path:str) -> bool:
+        return path == self.watch_dir or path.startswith(self.prefix)
+
+    def close(self):
+        """
+        Commit anything still queued and flush the logs.
+        """
+        self.repo.close()
+        self.log.close()
+        self.access_log.close()
+
+
+def find(roots:list, path:str):
+    """
+    Find the root a path belongs to.
+    :param roots: The WatchRoots
+    :param path: An absolute path
+    :return: The WatchRoot, or None if the path is outside of every watched directory
+    """
+    for root in roots:
+        if root.contains(path):
+            return root
+    return None
+
+
+def init() -> list:
+    """
+    Create a WatchRoot for every directory in config.ROOTS.
+    :return: The WatchRoots, in the same order
+    """
+    roots = [WatchRoot(root) for root in config.ROOTS]
+    git_utils.repos = [root.repo for root in roots]
+    return roots